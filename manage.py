@@ -120,6 +120,42 @@ def purgehost(name):
     db.session.commit()
 
 
+@manager.command
+def purge_instance_logs():
+    """Compacts and prunes the instance logs according to the retention policy
+    in INSTANCE_LOG_RETENTION, a batch at a time until nothing is left"""
+    from collections import Counter
+    from pebbles.log_retention import apply_instance_log_retention
+    totals = Counter()
+    while True:
+        results = apply_instance_log_retention(
+            app.dynamic_config.get('INSTANCE_LOG_RETENTION'),
+            compaction_age_days=app.dynamic_config.get('INSTANCE_LOG_COMPACTION_AGE_DAYS')
+        )
+        more = results.pop('more')
+        totals.update(results)
+        if not more or not sum(results.values()):
+            break
+    for operation, count in sorted(totals.items()):
+        print('%s: %d' % (operation, count))
+
+
+@manager.command
+def rebuild_credits_ledger():
+    """Recalculates the settled credits of deleted instances and the credits
+    ledger of all users from scratch"""
+    from collections import defaultdict
+    from pebbles.models import User, Instance, db
+    settled_credits = defaultdict(float)
+    for instance in Instance.query.filter(Instance.state == Instance.STATE_DELETED):
+        instance.credits_settled = None
+        instance.credits_settled = instance.credits_spent()
+        settled_credits[instance.user_id] += instance.credits_settled
+    for user in User.query:
+        user.credits_spent_settled = settled_credits.get(user.id, 0.0)
+    db.session.commit()
+
+
 @manager.command
 def createuser_bulk(user_prefix=None, domain_name=None, admin=False):
     """Creates new demo users"""
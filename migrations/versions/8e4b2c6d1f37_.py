@@ -0,0 +1,26 @@
+"""empty message
+
+Revision ID: 8e4b2c6d1f37
+Revises: 5a8e1d3f7c29
+Create Date: 2018-02-15 13:27:05.841926
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8e4b2c6d1f37'
+down_revision = '5a8e1d3f7c29'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # failed instances cost nothing, settle the ones failed before they were settled on failure
+    instances = sa.table('instances', sa.column('errored', sa.Boolean), sa.column('credits_settled', sa.Float))
+    op.execute(instances.update()
+               .where(sa.and_(instances.c.errored == sa.true(), instances.c.credits_settled.is_(None)))
+               .values(credits_settled=0.0))
+
+
+def downgrade():
+    pass
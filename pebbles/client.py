@@ -1,19 +1,101 @@
 import base64
+import os
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from pebbles.config import BaseConfig
+
+# one pooled session per process and settings, see get_api_session()
+_api_sessions = {}
+_api_sessions_lock = threading.Lock()
+# the API client settings, read from the config once per process, see get_api_client_settings()
+_api_client_settings = {}
+
+API_CLIENT_SETTINGS = (
+    'API_CLIENT_POOL_SIZE',
+    'API_CLIENT_RETRIES',
+    'API_CLIENT_BACKOFF_FACTOR',
+    'API_CLIENT_CONNECT_TIMEOUT',
+    'API_CLIENT_READ_TIMEOUT',
+)
+
+
+def get_api_client_settings():
+    """ The API_CLIENT_* settings, read once as every read of BaseConfig parses the config file """
+    with _api_sessions_lock:
+        if not _api_client_settings:
+            config = BaseConfig()
+            _api_client_settings.update((name, config[name]) for name in API_CLIENT_SETTINGS)
+        return _api_client_settings
+
+
+def get_api_session(pool_size=None, retries=None, backoff_factor=None):
+    """ Returns a keep-alive session with a connection pool, shared by all the
+    API clients of the current process. Requests failing to connect or getting a
+    502/503/504 are retried with exponential backoff (idempotent methods only
+    for the latter).
+
+    The process id is part of the cache key, so that forked worker processes
+    do not share the sockets of their parent.
+    """
+    if pool_size is None or retries is None or backoff_factor is None:
+        settings = get_api_client_settings()
+        pool_size = pool_size if pool_size is not None else settings['API_CLIENT_POOL_SIZE']
+        retries = retries if retries is not None else settings['API_CLIENT_RETRIES']
+        backoff_factor = backoff_factor if backoff_factor is not None else settings['API_CLIENT_BACKOFF_FACTOR']
+
+    key = (os.getpid(), pool_size, retries, backoff_factor)
+    with _api_sessions_lock:
+        session = _api_sessions.get(key)
+        if not session:
+            session = requests.Session()
+            retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=(502, 503, 504))
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _api_sessions[key] = session
+    return session
+
+
+def get_api_timeout():
+    """ (connect, read) timeout tuple for the internal API calls """
+    settings = get_api_client_settings()
+    return settings['API_CLIENT_CONNECT_TIMEOUT'], settings['API_CLIENT_READ_TIMEOUT']
 
 
 class PBClient(object):
-    def __init__(self, token, api_base_url, ssl_verify=True):
-        self.token = token
+    def __init__(self, token, api_base_url, ssl_verify=True, session=None, timeout=None, token_refresher=None):
+        """ token_refresher, if given, is called with the rejected token when the
+        API responds with 401 and should return a new token to retry with.
+        """
         self.api_base_url = api_base_url
         self.ssl_verify = ssl_verify
-        self.auth = base64.encodestring('%s:%s' % (token, '')).replace('\n', '')
+        self.session = session if session else get_api_session()
+        self.timeout = timeout if timeout else get_api_timeout()
+        self.token_refresher = token_refresher
+        self.set_token(token)
+
+    def set_token(self, token):
+        self.token = token
+        self.auth = base64.b64encode(('%s:%s' % (token, '')).encode('utf-8')).decode('ascii')
+
+    def _send(self, method, url, headers, **kwargs):
+        resp = self.session.request(method, url, headers=headers, verify=self.ssl_verify, timeout=self.timeout, **kwargs)
+        if resp.status_code == 401 and self.token_refresher:
+            token = self.token_refresher(self.token)
+            if token and token != self.token:
+                self.set_token(token)
+                headers['Authorization'] = 'Basic %s' % self.auth
+                resp = self.session.request(method, url, headers=headers, verify=self.ssl_verify, timeout=self.timeout, **kwargs)
+        return resp
 
     def do_get(self, object_url, payload=None):
         headers = {'Accept': 'text/plain',
                    'Authorization': 'Basic %s' % self.auth}
         url = '%s/%s' % (self.api_base_url, object_url)
-        resp = requests.get(url, data=payload, headers=headers, verify=self.ssl_verify)
+        resp = self._send('GET', url, headers, data=payload)
         return resp
 
     def do_patch(self, object_url, payload):
@@ -21,7 +103,7 @@ class PBClient(object):
                    'Accept': 'text/plain',
                    'Authorization': 'Basic %s' % self.auth}
         url = '%s/%s' % (self.api_base_url, object_url)
-        resp = requests.patch(url, data=payload, headers=headers, verify=self.ssl_verify)
+        resp = self._send('PATCH', url, headers, data=payload)
         return resp
 
     def do_post(self, object_url, payload=None):
@@ -29,7 +111,7 @@ class PBClient(object):
                    'Accept': 'text/plain',
                    'Authorization': 'Basic %s' % self.auth}
         url = '%s/%s' % (self.api_base_url, object_url)
-        resp = requests.post(url, data=payload, headers=headers, verify=self.ssl_verify)
+        resp = self._send('POST', url, headers, data=payload)
         return resp
 
     def do_put(self, object_url, payload=None):
@@ -37,7 +119,7 @@ class PBClient(object):
                    'Accept': 'text/plain',
                    'Authorization': 'Basic %s' % self.auth}
         url = '%s/%s' % (self.api_base_url, object_url)
-        resp = requests.put(url, data=payload, headers=headers, verify=self.ssl_verify)
+        resp = self._send('PUT', url, headers, data=payload)
         return resp
 
     def do_delete(self, object_url):
@@ -45,7 +127,7 @@ class PBClient(object):
                    'Accept': 'text/plain',
                    'Authorization': 'Basic %s' % self.auth}
         url = '%s/%s' % (self.api_base_url, object_url)
-        resp = requests.delete(url, headers=headers, verify=self.ssl_verify)
+        resp = self._send('DELETE', url, headers)
         return resp
 
     def do_instance_patch(self, instance_id, payload):
@@ -74,6 +156,18 @@ class PBClient(object):
             raise RuntimeError('Cannot fetch data for instances, %s' % resp.reason)
         return resp.json()
 
+    def get_due_instances(self):
+        resp = self.do_get('instances/due_work')
+        if resp.status_code != 200:
+            raise RuntimeError('Cannot fetch data for due instances, %s' % resp.reason)
+        return resp.json()
+
+    def get_instance_demand(self, plugin, weeks=0):
+        resp = self.do_get('instances/demand?plugin=%s&weeks=%d' % (plugin, weeks))
+        if resp.status_code != 200:
+            raise RuntimeError('Cannot fetch the demand for instances of %s, %s' % (plugin, resp.reason))
+        return resp.json()
+
     def get_instance(self, instance_id):
         resp = self.do_get('instances/%s' % instance_id)
         if resp.status_code != 200:
@@ -94,7 +188,7 @@ class PBClient(object):
                    'Authorization': 'Basic %s' % self.auth}
         url = '%s/instances/%s/logs' % (self.api_base_url, instance_id)
         params = {'log_type': 'running'}
-        resp = requests.delete(url, params=params, headers=headers, verify=self.ssl_verify)
+        resp = self._send('DELETE', url, headers, params=params)
         if resp.status_code != 200:
             raise RuntimeError('Unable to delete running logs for instance %s, %s' % (instance_id, resp.reason))
         return resp
@@ -141,23 +235,38 @@ class PBClient(object):
         ns_record = self.get_namespaced_keyvalue(namespace, key)
         if not ns_record:
             url = '%s/%s' % (self.api_base_url, 'namespaced_keyvalues')
-            resp = requests.post(url, json=payload, headers=headers, verify=self.ssl_verify)
+            resp = self._send('POST', url, headers, json=payload)
         else:
             updated_version_ts = ns_record['updated_ts']
             payload['updated_version_ts'] = updated_version_ts
             url = '%s/%s/%s/%s' % (self.api_base_url, 'namespaced_keyvalues', namespace, key)
-            resp = requests.put(url, json=payload, headers=headers, verify=self.ssl_verify)
+            resp = self._send('PUT', url, headers, json=payload)
 
         if resp.status_code == 200:
             return resp.json()
         else:
             raise RuntimeError('Error creating / modifying namespaced record: %s %s, %s' % (namespace, key, resp.reason))
 
+    def modify_namespaced_keyvalue(self, namespace, key, payload, updated_version_ts):
+        """Modifies a namespaced record only if it has not been updated after updated_version_ts.
+        Returns False if it has."""
+        headers = {'Accept': 'text/plain',
+                   'Authorization': 'Basic %s' % self.auth}
+        payload['updated_version_ts'] = updated_version_ts
+        url = '%s/%s/%s/%s' % (self.api_base_url, 'namespaced_keyvalues', namespace, key)
+        resp = self._send('PUT', url, headers, json=payload)
+        if resp.status_code == 200:
+            return True
+        elif resp.status_code == 409:
+            return False
+        else:
+            raise RuntimeError('Error modifying namespaced record: %s %s, %s' % (namespace, key, resp.reason))
+
     def delete_namespaced_keyvalue(self, namespace, key):
         headers = {'Accept': 'text/plain',
                    'Authorization': 'Basic %s' % self.auth}
         url = '%s/%s/%s/%s' % (self.api_base_url, 'namespaced_keyvalues', namespace, key)
-        resp = requests.delete(url, headers=headers, verify=self.ssl_verify)
+        resp = self._send('DELETE', url, headers)
         if resp.status_code == 200:
             return resp.json()
         else:
@@ -145,6 +145,55 @@ class BaseConfig(object):
 
     PROVISIONING_NUM_WORKERS = 1
 
+    API_CLIENT_POOL_SIZE = (
+        10,
+        'Size of the keep-alive connection pool workers use for the internal API'
+    )
+    API_CLIENT_RETRIES = (
+        3,
+        'How many times workers retry failed internal API requests'
+    )
+    API_CLIENT_BACKOFF_FACTOR = (
+        0.5,
+        'Backoff factor in seconds between the retries of internal API requests'
+    )
+    API_CLIENT_CONNECT_TIMEOUT = 10
+    API_CLIENT_READ_TIMEOUT = 120
+
+    INSTANCE_LOG_RETENTION = (
+        {
+            'provisioning': {'max_age_days': 365, 'max_rows': 5000},
+            'deprovisioning': {'max_age_days': 365, 'max_rows': 1000},
+            'provisioning_compacted': {'max_age_days': 730},
+            'running': {'max_age_days': 90},
+        },
+        'Maximum age in days (max_age_days) and maximum number of rows per'
+        ' instance (max_rows) of instance logs by log type'
+    )
+    INSTANCE_LOG_COMPACTION_AGE_DAYS = (
+        30,
+        'Provisioning logs of deleted instances are compacted into one'
+        ' compressed row after this many days'
+    )
+
+    PERIODIC_UPDATE_TASKS_PER_WORKER = (
+        10,
+        'How many update tasks the periodic scheduler keeps in flight'
+        ' per provisioning worker'
+    )
+
+    AUTH_TOKEN_CACHE_TTL = (
+        30,
+        'How long in seconds an API process trusts a verified auth token'
+        ' and the access flags of its user, 0 disables the cache'
+    )
+
+    ETAG_TIME_BUCKET = (
+        30,
+        'How long in seconds the ETags of polled listings with time dependent'
+        ' fields, like the lifetime left of instances, stay valid'
+    )
+
     # enable access by []
 
     def __getitem__(self, item):
@@ -184,8 +184,10 @@ class ProvisioningDriverBase(object):
         """
         uploader = logging.getLogger('%s-%s' % (instance_id, log_type))
         uploader.setLevel(logging.INFO)
-        for handler in uploader.handlers:
+        for handler in list(uploader.handlers):
             uploader.removeHandler(handler)
+            # flushes the buffered records of the previous run
+            handler.close()
 
         if 'TEST_MODE' not in self.config:
             # check if the custom handler is already there
@@ -13,7 +13,10 @@ doesn't have the slots for it.
 
 The system maintains a number of hosts to reach DD_FREE_SLOT_TARGET unless
 DD_SHUTDOWN_MODE is True, in which case it waits for all containers on a host
-to finish and then shuts down the host.
+to finish and then shuts down the host. The target is raised by the slots of
+the queueing instances, the launches expected in the next hours based on the
+launch history of the past weeks and the course sessions in the session
+calendar that start soon. Several hosts are spawned at once when needed.
 
 DockerDriver configurations are available via the UI admin dashboard under
 "Driver Configs".
@@ -53,13 +56,41 @@ DockerDriver configurations are available via the UI admin dashboard under
 +----------------------------+--------------------------------------------------------------+
 | DD_HOST_ROOT_VOLUME_SIZE   | How large a volume to create to the hosts                    |
 +----------------------------+--------------------------------------------------------------+
+| DD_HOST_PRIORITY_IMAGES    | How many of the most used images a new host needs before it  |
+|                            | is activated. The rest are loaded later by housekeeping.     |
++----------------------------+--------------------------------------------------------------+
+| DD_IMAGE_REGISTRY          | A Docker registry to pull the images from, so that only the  |
+|                            | missing layers are transferred. If not set, the images are   |
+|                            | loaded from the files in /images.                            |
++----------------------------+--------------------------------------------------------------+
 | DD_SHUTDOWN_MODE           | Stop all hosts when they become free.                        |
 +----------------------------+--------------------------------------------------------------+
+| DD_MAX_SPAWN_PER_HOUSEKEEP | How many hosts can be spawned at once.                       |
++----------------------------+--------------------------------------------------------------+
+| DD_DEMAND_HISTORY_WEEKS    | How many weeks of launch history the expected launches are   |
+|                            | averaged from. 0 disables the prediction.                    |
++----------------------------+--------------------------------------------------------------+
+| DD_DEMAND_LOOKAHEAD_HOURS  | How many hours ahead the expected launches are reserved for. |
++----------------------------+--------------------------------------------------------------+
+| DD_SESSION_CALENDAR        | Scheduled course sessions as a JSON list like                |
+|                            | [{"start": "2018-02-05T10:00", "end": "2018-02-05T12:00",    |
+|                            | "slots": 300}], the times in UTC.                            |
++----------------------------+--------------------------------------------------------------+
+| DD_SESSION_PREWARM_MINUTES | How long before a course session its slots are made free.    |
++----------------------------+--------------------------------------------------------------+
+| DD_PLACEMENT_STRATEGY      | How the host of a new container is chosen, see               |
+|                            | PLACEMENT_STRATEGIES. The default is oldest_first.           |
++----------------------------+--------------------------------------------------------------+
 """
 
+import calendar
 import json
+import math
+import tarfile
 import time
 import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
 from docker.errors import APIError
 from docker.tls import TLSConfig
 from docker.utils import parse_bytes
@@ -93,12 +124,111 @@ DD_IMAGE_DIRECTORY = '/images'
 
 DD_CLIENT_TIMEOUT = 180  # seconds
 
+# listing the containers of the pool hosts is done in parallel with a short timeout
+DD_HOST_POLL_TIMEOUT = 10  # seconds
+DD_HOST_POLL_THREADS = 8
+# hosts with this many consecutive errors are polled again only after DD_HOST_CIRCUIT_RESET seconds
+# from the last failure, a successful poll clears the errors
+DD_HOST_CIRCUIT_ERRORS = 3
+DD_HOST_CIRCUIT_RESET = 60
+
+# slots are reserved on the host record for the duration of starting a container
+DD_SLOT_RESERVATION_TTL = 600  # seconds
+# compare-and-swap updates of a host record are retried this many times on concurrent modification
+DD_RECORD_UPDATE_ATTEMPTS = 5
+# when all the candidate hosts are locked, the locks are retried with a growing delay
+DD_LOCK_ATTEMPTS = 5
+DD_LOCK_RETRY_DELAY = 0.1  # seconds
+
+# images loaded to a host in parallel
+DD_IMAGE_LOAD_THREADS = 4
+# an image that failed to load to a host is retried after a delay doubling with each failure
+DD_IMAGE_RETRY_DELAY = 300  # seconds
+DD_IMAGE_RETRY_MAX_DELAY = 3600 * 2  # seconds
+
+# hosts spawned in one housekeeping run at most, unless set in the backend config
+DD_MAX_SPAWN_PER_HOUSEKEEP = 4
+# the launch history changes slowly, it is fetched again after this
+DD_DEMAND_CURVE_TTL = 3600  # seconds
+DD_HOURS_IN_WEEK = 7 * 24
+DD_SESSION_TIME_FORMAT = '%Y-%m-%dT%H:%M'
+
+DD_PLACEMENT_STRATEGY = 'oldest_first'
+
 PEBBLES_SSH_KEY_LOCATION = '/home/pebbles/.ssh/id_rsa'
 
 NAMESPACE = "DockerDriver"
 KEY_PREFIX_POOL = "pool_vm"
 KEY_CONFIG = "backend_config"
 
+# the latest container listing of the pool hosts polled by this process, by host id, the fallback
+# for the number of reserved slots of a host that cannot be polled, see _use_host_snapshot()
+host_snapshots = {}
+
+# image ids read from the image files, by file name and modification time
+image_file_ids = {}
+
+# the slots launched by hour of the week, averaged over the launch history of the past weeks
+demand_curve = {}
+
+
+def get_scheduled_slots(session_calendar, cur_ts, prewarm_secs):
+    """ The slots of the course sessions in a calendar (see DD_SESSION_CALENDAR) that are going on
+        or start in prewarm_secs
+    """
+    num_slots = 0
+    for session in json.loads(session_calendar):
+        start_ts = calendar.timegm(time.strptime(session['start'], DD_SESSION_TIME_FORMAT))
+        end_ts = calendar.timegm(time.strptime(session['end'], DD_SESSION_TIME_FORMAT))
+        if start_ts - prewarm_secs <= cur_ts < end_ts:
+            num_slots += int(session['slots'])
+    return num_slots
+
+
+def get_image_tag(image_name):
+    """ The name of an image as listed in the RepoTags of the Docker API """
+    if ':' in image_name.rsplit('/', 1)[-1]:
+        return image_name
+    return '%s:latest' % image_name
+
+
+def order_oldest_first(hosts):
+    """ The oldest hosts first """
+    return sorted(hosts, key=lambda host: host['spawn_ts'])
+
+
+def order_best_fit(hosts):
+    """ The hosts with the fewest free slots first, so that the free slots stay together on the
+        emptier hosts and those can be drained
+    """
+    return sorted(hosts, key=lambda host: (host['num_slots'] - host['num_reserved_slots'], host['spawn_ts']))
+
+
+def order_lifetime_packing(hosts):
+    """ The hosts in use with the most lifetime left first, the fullest of them first, and the
+        unused hosts last. The young hosts are kept dense while the old ones drain and expire.
+    """
+    return sorted(hosts, key=lambda host: (
+        not host.get('lifetime_tick_ts', 0),
+        -host['lifetime_left'],
+        host['num_slots'] - host['num_reserved_slots'],
+        host['spawn_ts'],
+    ))
+
+
+def order_spread(hosts):
+    """ The hosts with the most free slots first, so that losing a host affects the fewest containers """
+    return sorted(hosts, key=lambda host: (host['num_reserved_slots'] - host['num_slots'], host['spawn_ts']))
+
+
+# the orderings of the candidate hosts for a new container, by DD_PLACEMENT_STRATEGY
+PLACEMENT_STRATEGIES = {
+    'oldest_first': order_oldest_first,
+    'best_fit': order_best_fit,
+    'lifetime_packing': order_lifetime_packing,
+    'spread': order_spread,
+}
+
 
 class DockerDriverAccessProxy(object):
     """
@@ -106,7 +236,7 @@ class DockerDriverAccessProxy(object):
     This also helps in unit testing of the driver with mock objects.
     """
     @staticmethod
-    def get_docker_client(docker_url):
+    def get_docker_client(docker_url, timeout=DD_CLIENT_TIMEOUT):
         # TODO: figure out why server verification does not work (crls?)
         tls_config = TLSConfig(
             client_cert=(
@@ -114,7 +244,7 @@ class DockerDriverAccessProxy(object):
             #   ca_cert='%s/ca_cert.pem' % DD_RUNTIME_PATH,
             verify=False,
         )
-        docker_client = docker.Client(base_url=docker_url, tls=tls_config, timeout=DD_CLIENT_TIMEOUT)
+        docker_client = docker.Client(base_url=docker_url, tls=tls_config, timeout=timeout)
 
         return docker_client
 
@@ -163,6 +293,32 @@ class DockerDriverAccessProxy(object):
             elif host.get('state') == DD_STATE_REMOVED:  # DELETE
                 pbclient.delete_namespaced_keyvalue(NAMESPACE, _key)
 
+    @classmethod
+    def load_record(cls, token, url, host_id):
+        """ Loads the state of one pool vm host and the version of its record
+            for compare-and-swap updates, see update_record()
+        """
+        pbclient = cls.get_pb_client(token, url, ssl_verify=False)
+        ns_record = pbclient.get_namespaced_keyvalue(NAMESPACE, '%s_%s' % (KEY_PREFIX_POOL, host_id))
+        if not ns_record:
+            return None, None
+        return ns_record['value'], ns_record['updated_ts']
+
+    @classmethod
+    def update_record(cls, token, url, host, version):
+        """ Saves the state of a pool vm host if the record is still at the given version.
+            Returns False if it has been modified since.
+        """
+        pbclient = cls.get_pb_client(token, url, ssl_verify=False)
+        _key = '%s_%s' % (KEY_PREFIX_POOL, host['id'])
+        payload = {
+            'namespace': NAMESPACE,
+            'key': _key,
+            'schema': {},
+            'value': host
+        }
+        return pbclient.modify_namespaced_keyvalue(NAMESPACE, _key, payload, version)
+
     @classmethod
     def load_driver_config(cls, token, url):
         """ Loads the driver config from the database through REST API
@@ -356,6 +512,33 @@ class DockerDriverAccessProxy(object):
                 if os.path.isfile(os.path.join(DD_IMAGE_DIRECTORY, file_name)) and file_name.endswith('.img')
                 ]
 
+    @staticmethod
+    def get_image_file_name(image_name):
+        return '%s/%s.img' % (DD_IMAGE_DIRECTORY, image_name.replace('/', '.'))
+
+    @staticmethod
+    def open_image_file(image_name):
+        return open(DockerDriverAccessProxy.get_image_file_name(image_name), 'rb')
+
+    @staticmethod
+    def get_image_file_id(image_name):
+        """ The id of the image in an image file, from the manifest written by docker save, or None
+        """
+        file_name = DockerDriverAccessProxy.get_image_file_name(image_name)
+        try:
+            key = (file_name, os.path.getmtime(file_name))
+            if key not in image_file_ids:
+                with tarfile.open(file_name) as image_file:
+                    manifest = json.loads(image_file.extractfile('manifest.json').read().decode('utf-8'))
+                # the config is named after the image id, e.g. <id>.json or blobs/sha256/<id>
+                config_name = os.path.basename(manifest[0]['Config'])
+                if config_name.endswith('.json'):
+                    config_name = config_name[:-len('.json')]
+                image_file_ids[key] = 'sha256:%s' % config_name
+            return image_file_ids[key]
+        except (IOError, OSError, AttributeError, KeyError, IndexError, ValueError, tarfile.TarError):
+            return None
+
     @staticmethod
     def wait_for_port(ip_address, port, max_wait_secs=60):
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -441,26 +624,13 @@ class DockerDriver(base_driver.ProvisioningDriverBase):
             log_uploader.info("system is in shutdown mode, cannot provision new instances\n")
             raise RuntimeWarning('Shutdown mode, no provisioning')
 
-        ap = self._get_ap()
-        pbclient = ap.get_pb_client(token, self.config['INTERNAL_API_BASE_URL'], ssl_verify=False)
-        lock_id = 'dd_host:%s' % 'global'
         try:
-            lock_res = pbclient.obtain_lock(lock_id)
-            while not lock_res:
-                time.sleep(5)
-                lock_res = pbclient.obtain_lock(lock_id)
-
-            try:
-                self._do_provision(token, instance_id, int(time.time()))
-                return Instance.STATE_RUNNING
-            except (RuntimeWarning, ConnectionError) as e:
-                self.logger.info('_do_provision() failed for %s due to %s' % (instance_id, e))
-                log_uploader.info("provisioning failed, queueing again to retry\n")
-                return Instance.STATE_QUEUEING
-        finally:
-            pbclient.release_lock(lock_id)
-            # give proxy and container some time to initialize
-            time.sleep(2)
+            self._do_provision(token, instance_id, int(time.time()))
+            return Instance.STATE_RUNNING
+        except (RuntimeWarning, ConnectionError) as e:
+            self.logger.info('_do_provision() failed for %s due to %s' % (instance_id, e))
+            log_uploader.info("provisioning failed, queueing again to retry\n")
+            return Instance.STATE_QUEUEING
 
     def _do_provision(self, token, instance_id, cur_ts):
         ap = self._get_ap()
@@ -477,12 +647,25 @@ class DockerDriver(base_driver.ProvisioningDriverBase):
 
         log_uploader.info("selecting host...")
 
-        docker_hosts = self._select_hosts(blueprint_config['consumed_slots'], token, cur_ts)
-        selected_host = docker_hosts[0]
-
-        docker_client = ap.get_docker_client(selected_host['docker_url'])
+        docker_hosts = self._select_hosts(blueprint_config['consumed_slots'], token, cur_ts,
+                                          image_name=blueprint_config['docker_image'])
+        selected_host = self._reserve_host(token, docker_hosts, instance_id, blueprint_config['consumed_slots'], cur_ts)
 
         log_uploader.info("done\n")
+        try:
+            self._start_container(token, instance_id, instance, blueprint_config, selected_host)
+        finally:
+            # from now on the container itself takes the slots
+            self._release_slots(token, selected_host['id'], instance_id)
+
+    def _start_container(self, token, instance_id, instance, blueprint_config, selected_host):
+        ap = self._get_ap()
+
+        pbclient = ap.get_pb_client(token, self.config['INTERNAL_API_BASE_URL'], ssl_verify=False)
+
+        log_uploader = self.create_prov_log_uploader(token, instance_id, log_type='provisioning')
+
+        docker_client = ap.get_docker_client(selected_host['docker_url'])
 
         container_name = instance['name']
 
@@ -583,19 +766,8 @@ class DockerDriver(base_driver.ProvisioningDriverBase):
         log_uploader.info("provisioning done for %s\n" % instance_id)
 
     def do_deprovision(self, token, instance_id):
-        ap = self._get_ap()
-        pbclient = ap.get_pb_client(token, self.config['INTERNAL_API_BASE_URL'], ssl_verify=False)
-
-        lock_id = 'dd_host:%s' % 'global'
-        try:
-            lock_res = pbclient.obtain_lock(lock_id)
-            while not lock_res:
-                time.sleep(5)
-                lock_res = pbclient.obtain_lock(lock_id)
-
-            return self._do_deprovision(token, instance_id)
-        finally:
-            pbclient.release_lock(lock_id)
+        # removing a container only frees slots, so it needs no host lock
+        return self._do_deprovision(token, instance_id)
 
     def _do_deprovision(self, token, instance_id):
         self.logger.debug("do_deprovision %s" % instance_id)
@@ -648,6 +820,24 @@ class DockerDriver(base_driver.ProvisioningDriverBase):
         active_hosts = [x for x in hosts if x['state'] == DD_STATE_ACTIVE]
         return active_hosts
 
+    @staticmethod
+    def has_image(host, image_name):
+        # the hosts prepared before the images were recorded have them all
+        return not image_name or 'images' not in host or image_name in host['images']
+
+    @staticmethod
+    def count_container_slots(containers):
+        return sum(int(cont['Labels'].get('slots', 1)) for cont in containers)
+
+    @staticmethod
+    def get_active_reservations(host, cur_ts):
+        """ The slot reservations on a host record that have not expired, by instance id
+        """
+        return dict(
+            (instance_id, reservation) for instance_id, reservation in host.get('reservations', {}).items()
+            if cur_ts - reservation['ts'] < DD_SLOT_RESERVATION_TTL
+        )
+
     @staticmethod
     def calculate_allocated_slots(hosts):
         num_allocated_slots = sum(x['num_reserved_slots'] for x in hosts)
@@ -714,15 +904,19 @@ class DockerDriver(base_driver.ProvisioningDriverBase):
         elif self._remove_inactive_hosts(hosts=hosts, cur_ts=cur_ts):
             self.logger.debug('do_housekeep(): remove action taken')
 
-        # priority three: if we have less available slots than our target, spawn a new host
+        # priority three: if we have less available slots than the demand, spawn new hosts
         # in shutdown mode we skip this
-        elif not shutdown_mode and self._spawn_new_host(hosts=hosts, cur_ts=cur_ts):
+        elif not shutdown_mode and self._spawn_new_hosts(token=token, hosts=hosts, cur_ts=cur_ts):
             self.logger.debug('do_housekeep(): spawn action taken')
 
         # finally mark old hosts without instances inactive (one at a time)
         elif self._inactivate_old_hosts(hosts=hosts, cur_ts=cur_ts):
             self.logger.debug('do_housekeep(): inactivate action taken')
 
+        # when there is nothing else to do, load the rest of the images to the hosts activated early
+        elif self._load_remaining_images(hosts=hosts, cur_ts=cur_ts):
+            self.logger.debug('do_housekeep(): load images action taken')
+
         # save host state in the end
         self._save_host_state(hosts, token, cur_ts)
 
@@ -731,7 +925,7 @@ class DockerDriver(base_driver.ProvisioningDriverBase):
         for host in spawned_hosts:
             self.logger.info('do_housekeep(): preparing host %s' % host['id'])
             try:
-                self._prepare_host(host)
+                self._prepare_host(host, self._get_images_by_popularity(hosts), cur_ts)
                 host['state'] = DD_STATE_ACTIVE
                 self.logger.info('do_housekeep(): host %s now ACTIVE' % host['id'])
             except Exception as e:
@@ -741,9 +935,8 @@ class DockerDriver(base_driver.ProvisioningDriverBase):
                 if host['error_count'] > DD_MAX_HOST_ERRORS:
                     self.logger.warn('do_housekeep(): maximum error count exceeded for host %s' % host['id'])
                     host['state'] = DD_STATE_INACTIVE
-            return True
 
-        return False
+        return len(spawned_hosts) > 0
 
     def _remove_inactive_hosts(self, hosts, cur_ts):
         inactive_hosts = [x for x in hosts if x['state'] == DD_STATE_INACTIVE]
@@ -760,28 +953,82 @@ class DockerDriver(base_driver.ProvisioningDriverBase):
 
         return False
 
-    def _spawn_new_host(self, hosts, cur_ts):
+    def _spawn_new_hosts(self, token, hosts, cur_ts):
         # find projected free slots (only take active hosts with more than a minute to go)
         num_projected_free_slots = self.calculate_projected_free_slots(hosts)
         num_allocated_slots = self.calculate_allocated_slots(hosts)
+        num_missing_slots = self._get_free_slot_demand(token, hosts, cur_ts) - num_projected_free_slots
 
-        if num_projected_free_slots < self.driver_config['DD_FREE_SLOT_TARGET']:
-            if len(hosts) < self.driver_config['DD_MAX_HOSTS']:
-                # try to figure out if we need to use the larger flavor
-                # if we at some point can get the number of queueing instances that can be used
-                if num_allocated_slots > 0:
-                    ramp_up = True
-                else:
-                    ramp_up = False
-                self.logger.debug('do_housekeep(): too few free slots, spawning, ramp_up=%s' % ramp_up)
-                new_host = self._spawn_host(cur_ts, ramp_up)
-                self.logger.info('do_housekeep(): SPAWNED a new host %s' % new_host['id'])
-                hosts.append(new_host)
-                return True
-            else:
+        max_spawn = self.driver_config.get('DD_MAX_SPAWN_PER_HOUSEKEEP', DD_MAX_SPAWN_PER_HOUSEKEEP)
+        num_spawned = 0
+        while num_missing_slots > 0 and num_spawned < max_spawn:
+            if len(hosts) >= self.driver_config['DD_MAX_HOSTS']:
                 self.logger.info('do_housekeep(): too few free slots, but host limit reached')
+                break
+            # use the larger flavor when the pool is in use or a small host would not be enough
+            ramp_up = num_allocated_slots > 0 or num_missing_slots > self.driver_config['DD_HOST_FLAVOR_SLOTS_SMALL']
+            self.logger.debug('do_housekeep(): %d slots missing, spawning, ramp_up=%s' % (num_missing_slots, ramp_up))
+            try:
+                new_host = self._spawn_host(cur_ts, ramp_up)
+            except Exception as e:
+                if not num_spawned:
+                    raise
+                # the hosts spawned so far still need to be saved
+                self.logger.warn('do_housekeep(): spawning a host failed, %s' % e)
+                break
+            self.logger.info('do_housekeep(): SPAWNED a new host %s' % new_host['id'])
+            hosts.append(new_host)
+            num_missing_slots -= new_host['num_slots']
+            num_spawned += 1
 
-        return False
+        return num_spawned > 0
+
+    def _get_free_slot_demand(self, token, hosts, cur_ts):
+        """ The free slots the pool should have: the queueing instances on top of DD_FREE_SLOT_TARGET
+            or of the launches expected in the next DD_DEMAND_LOOKAHEAD_HOURS, whichever is larger,
+            or the slots of the sessions in DD_SESSION_CALENDAR that are not running yet
+        """
+        free_slot_target = self.driver_config['DD_FREE_SLOT_TARGET']
+        history_weeks = self.driver_config.get('DD_DEMAND_HISTORY_WEEKS', 0)
+
+        fetch_weeks = 0
+        if history_weeks and (demand_curve.get('weeks') != history_weeks or
+                              cur_ts - demand_curve.get('ts', 0) > DD_DEMAND_CURVE_TTL):
+            fetch_weeks = history_weeks
+        pbclient = self._get_ap().get_pb_client(token, self.config['INTERNAL_API_BASE_URL'], ssl_verify=False)
+        try:
+            demand = pbclient.get_instance_demand(NAMESPACE, fetch_weeks)
+        except Exception as e:
+            self.logger.warn('do_housekeep(): fetching the instance demand failed, %s' % e)
+            demand = {'queueing_slots': 0}
+        if fetch_weeks and 'hourly_launch_slots' in demand:
+            demand_curve.update(ts=cur_ts, weeks=fetch_weeks, hourly_launch_slots=demand['hourly_launch_slots'])
+
+        num_expected_slots = 0
+        if history_weeks and demand_curve.get('hourly_launch_slots'):
+            cur_time = time.gmtime(cur_ts)
+            hour_of_week = cur_time.tm_wday * 24 + cur_time.tm_hour
+            lookahead_hours = self.driver_config.get('DD_DEMAND_LOOKAHEAD_HOURS', 1)
+            num_expected_slots = int(math.ceil(sum(
+                demand_curve['hourly_launch_slots'][(hour_of_week + i) % DD_HOURS_IN_WEEK]
+                for i in range(lookahead_hours)
+            )))
+
+        num_scheduled_slots = 0
+        if self.driver_config.get('DD_SESSION_CALENDAR'):
+            prewarm_secs = self.driver_config.get('DD_SESSION_PREWARM_MINUTES', 30) * 60
+            try:
+                num_scheduled_slots = get_scheduled_slots(self.driver_config['DD_SESSION_CALENDAR'], cur_ts, prewarm_secs)
+            except (ValueError, KeyError, TypeError) as e:
+                self.logger.warn('do_housekeep(): invalid DD_SESSION_CALENDAR, %s' % e)
+            # the containers of a session already started are on the hosts
+            num_scheduled_slots = max(num_scheduled_slots - self.calculate_allocated_slots(hosts), 0)
+
+        self.logger.debug(
+            'do_housekeep(): slot demand: %d queueing, %d expected, %d scheduled' %
+            (demand['queueing_slots'], num_expected_slots, num_scheduled_slots)
+        )
+        return max(max(free_slot_target, num_expected_slots) + demand['queueing_slots'], num_scheduled_slots)
 
     def _inactivate_old_hosts(self, hosts, cur_ts):
         active_hosts = self.get_active_hosts(hosts)
@@ -817,26 +1064,20 @@ class DockerDriver(base_driver.ProvisioningDriverBase):
             host['lifetime_left'] = lifetime
             self.logger.debug('do_housekeep(): host %s has lifetime %d' % (host['id'], lifetime))
 
-    def _select_hosts(self, slots, token, cur_ts):
+    def _select_hosts(self, slots, token, cur_ts, image_name=None):
         """ Select pool vm host for provisioning a container.
-            First, oldest active hosts and then the fresh hosts
+            The hosts are ordered by DD_PLACEMENT_STRATEGY, see select_candidate_hosts().
+            Hosts that are still loading the image are left out.
         """
         hosts = self._get_hosts(token, cur_ts)
-        active_hosts = self.get_active_hosts(hosts)
+        active_hosts = [host for host in self.get_active_hosts(hosts) if self.has_image(host, image_name)]
 
-        # first try to use the oldest active host with space and lifetime left
-        active_hosts = sorted(active_hosts, key=lambda entry: entry['spawn_ts'])
-        selected_hosts = []
-        for host in active_hosts:
-            is_fresh = host['lifetime_left'] > DD_HOST_LIFETIME_LOW
-            has_enough_slots = host['num_slots'] - host['num_reserved_slots'] >= slots
-            if is_fresh and has_enough_slots:
-                selected_hosts.append(host)
-        if len(selected_hosts) == 0:
-            # try to use any active host with space
-            for host in active_hosts:
-                if host['num_slots'] - host['num_reserved_slots'] >= slots:
-                    selected_hosts.append(host)
+        strategy = self.driver_config.get('DD_PLACEMENT_STRATEGY', DD_PLACEMENT_STRATEGY)
+        if strategy not in PLACEMENT_STRATEGIES:
+            self.logger.warning('_select_host(): unknown placement strategy %s, using %s' %
+                                (strategy, DD_PLACEMENT_STRATEGY))
+            strategy = DD_PLACEMENT_STRATEGY
+        selected_hosts = self.select_candidate_hosts(active_hosts, slots, strategy)
 
         if len(selected_hosts) == 0:
             self.logger.debug('_select_host(): no space left, %d slots requested,'
@@ -847,44 +1088,210 @@ class DockerDriver(base_driver.ProvisioningDriverBase):
                                                                              len(selected_hosts)))
         return selected_hosts
 
+    @staticmethod
+    def select_candidate_hosts(active_hosts, slots, strategy=DD_PLACEMENT_STRATEGY):
+        """ The reachable active hosts with room for the slots, ordered by the placement strategy.
+            Hosts with lifetime left are used first, the rest only when there are none of those.
+        """
+        hosts_with_room = [
+            host for host in active_hosts
+            if host.get('reachable', True) and host['num_slots'] - host['num_reserved_slots'] >= slots
+        ]
+        fresh_hosts = [host for host in hosts_with_room if host['lifetime_left'] > DD_HOST_LIFETIME_LOW]
+        return PLACEMENT_STRATEGIES[strategy](fresh_hosts or hosts_with_room)
+
     def _get_hosts(self, token, cur_ts):
         """ Loads the state of the pool vm host through access proxy
         """
         ap = self._get_ap()
 
         hosts = ap.load_records(token, self.config['INTERNAL_API_BASE_URL'])
-        # populate hosts with container data
+        polled_hosts = []
         for host in hosts:
             if host['state'] not in (DD_STATE_ACTIVE, DD_STATE_INACTIVE):
                 self.logger.debug('_get_hosts(): skipping container data fetching for %s' % host['id'])
                 continue
-            docker_client = ap.get_docker_client(host['docker_url'])
-            try:
-                # update the number of reserved slots
-                containers = docker_client.containers()
-                host['num_reserved_slots'] = sum(int(cont['Labels'].get('slots', 1)) for cont in containers)
-                self.logger.debug('_get_hosts(): found %d instances with %d slots on %s' %
-                                  (len(containers), host['num_reserved_slots'], host['id']))
-
-                # update the accumulative usage
-                usage = host.get('usage', 0)
-                usage += host['num_reserved_slots']
-                host['usage'] = usage
-                # start lifetime ticking
-                if usage and not host.get('lifetime_tick_ts', 0):
-                    host['lifetime_tick_ts'] = cur_ts
-
-            except (ConnectionError, ReadTimeout):
+            if self._is_circuit_open(host, cur_ts):
+                self.logger.info('_get_hosts(): skipping failing host %s' % host['id'])
+                self._use_host_snapshot(host)
+                continue
+            polled_hosts.append(host)
+
+        # populate hosts with container data
+        for host, containers in zip(polled_hosts, self._poll_hosts(polled_hosts)):
+            if containers is None:
                 self.logger.warning('_get_hosts(): updating number of instances failed for %s' % host['id'])
                 host['error_count'] = host.get('error_count', 0) + 1
+                host['error_ts'] = cur_ts
+                self._use_host_snapshot(host)
+                continue
+
+            # update the number of reserved slots, the containers being started have reservations
+            reservations = self.get_active_reservations(host, cur_ts)
+            host['num_reserved_slots'] = self.count_container_slots(containers) + \
+                sum(reservation['slots'] for reservation in reservations.values())
+            host['reachable'] = True
+            host['poll_ts'] = cur_ts
+            # the circuit breaker and the inactivation count consecutive failures, not the lifetime total
+            host['error_count'] = 0
+            host['running_images'] = dict(Counter(cont.get('Image') for cont in containers))
+            host_snapshots[host['id']] = {'num_reserved_slots': host['num_reserved_slots'], 'poll_ts': cur_ts}
+            self.logger.debug('_get_hosts(): found %d instances with %d slots on %s' %
+                              (len(containers), host['num_reserved_slots'], host['id']))
+
+            # update the accumulative usage
+            usage = host.get('usage', 0)
+            usage += host['num_reserved_slots']
+            host['usage'] = usage
+            # start lifetime ticking
+            if usage and not host.get('lifetime_tick_ts', 0):
+                host['lifetime_tick_ts'] = cur_ts
 
         return hosts
 
+    @staticmethod
+    def _is_circuit_open(host, cur_ts):
+        return host.get('error_count', 0) >= DD_HOST_CIRCUIT_ERRORS and \
+            cur_ts - host.get('error_ts', 0) < DD_HOST_CIRCUIT_RESET
+
+    @staticmethod
+    def _use_host_snapshot(host):
+        """ Mark a host that could not be polled unreachable, so that no containers are placed on it,
+            and fall back to the latest number of reserved slots seen by this process if that is newer
+        """
+        host['reachable'] = False
+        snapshot = host_snapshots.get(host['id'])
+        if snapshot and snapshot['poll_ts'] > host.get('poll_ts', 0):
+            host['num_reserved_slots'] = snapshot['num_reserved_slots']
+
+    def _poll_hosts(self, hosts):
+        """ Lists the containers on the hosts in parallel. Returns the containers of each host in
+            the same order, or None for the hosts that did not answer in time.
+        """
+        if not hosts:
+            return []
+        ap = self._get_ap()
+
+        def list_containers(host):
+            return ap.get_docker_client(host['docker_url'], timeout=DD_HOST_POLL_TIMEOUT).containers()
+
+        executor = ThreadPoolExecutor(max_workers=min(len(hosts), DD_HOST_POLL_THREADS))
+        try:
+            futures = [executor.submit(list_containers, host) for host in hosts]
+            # the timeout of the client applies to connecting and reading separately
+            wait(futures, timeout=2 * DD_HOST_POLL_TIMEOUT)
+            for future in futures:
+                future.cancel()
+        finally:
+            # do not wait for the threads stuck on a host that does not answer
+            executor.shutdown(wait=False)
+
+        results = []
+        for future in futures:
+            if future.cancelled() or not future.done() or \
+                    isinstance(future.exception(), (ConnectionError, ReadTimeout)):
+                results.append(None)
+            else:
+                results.append(future.result())
+        return results
+
+    def _reserve_host(self, token, hosts, instance_id, slots, cur_ts):
+        """ Reserves slots on the first of the candidate hosts that has room for them.
+            The hosts are locked one at a time, a host locked by another provisioning
+            is skipped so that the instances are started on different hosts in parallel.
+        """
+        ap = self._get_ap()
+        pbclient = ap.get_pb_client(token, self.config['INTERNAL_API_BASE_URL'], ssl_verify=False)
+        retry_delay = DD_LOCK_RETRY_DELAY
+        for attempt in range(DD_LOCK_ATTEMPTS):
+            num_locked = 0
+            for host in hosts:
+                lock_id = 'dd_host:%s' % host['id']
+                if not pbclient.obtain_lock(lock_id):
+                    num_locked += 1
+                    continue
+                try:
+                    if self._reserve_slots(token, host, instance_id, slots, cur_ts):
+                        return host
+                finally:
+                    pbclient.release_lock(lock_id)
+            if num_locked == 0:
+                break
+            time.sleep(retry_delay)
+            retry_delay *= 2
+
+        raise RuntimeWarning('_reserve_host(): no space left for requested %d slots' % slots)
+
+    def _reserve_slots(self, token, host, instance_id, slots, cur_ts):
+        """ Reserves slots for an instance with compare-and-swap on the host record. The containers
+            are counted after the reservation is saved, so the slots of a concurrent provisioning are
+            either in its reservation or in its container by then. Returns False if there is no room.
+        """
+        ap = self._get_ap()
+        url = self.config['INTERNAL_API_BASE_URL']
+        for attempt in range(DD_RECORD_UPDATE_ATTEMPTS):
+            record, version = ap.load_record(token, url, host['id'])
+            if not record or record['state'] != DD_STATE_ACTIVE:
+                return False
+            reservations = self.get_active_reservations(record, cur_ts)
+            reservations[instance_id] = {'slots': slots, 'ts': cur_ts}
+            record['reservations'] = reservations
+            if ap.update_record(token, url, record, version):
+                break
+        else:
+            self.logger.info('_reserve_slots(): too many concurrent modifications of host %s' % host['id'])
+            return False
+
+        docker_client = ap.get_docker_client(host['docker_url'], timeout=DD_HOST_POLL_TIMEOUT)
+        try:
+            containers = docker_client.containers()
+        except (ConnectionError, ReadTimeout):
+            self.logger.info('_reserve_slots(): listing containers failed for %s' % host['id'])
+            self._release_slots(token, host['id'], instance_id)
+            return False
+        num_used_slots = self.count_container_slots(containers) + \
+            sum(reservation['slots'] for reservation in reservations.values())
+        if num_used_slots > record['num_slots']:
+            self.logger.debug('_reserve_slots(): host %s filled up, %d slots used' % (host['id'], num_used_slots))
+            self._release_slots(token, host['id'], instance_id)
+            return False
+        return True
+
+    def _release_slots(self, token, host_id, instance_id):
+        ap = self._get_ap()
+        url = self.config['INTERNAL_API_BASE_URL']
+        for attempt in range(DD_RECORD_UPDATE_ATTEMPTS):
+            record, version = ap.load_record(token, url, host_id)
+            if not record or instance_id not in record.get('reservations', {}):
+                return
+            del record['reservations'][instance_id]
+            if ap.update_record(token, url, record, version):
+                return
+        self.logger.warning('_release_slots(): could not release the slots of %s on %s, they expire in %d s' %
+                            (instance_id, host_id, DD_SLOT_RESERVATION_TTL))
+
     def _save_host_state(self, hosts, token, cur_ts):
-        """Saves the state of the pool vm host in the database via access proxy
+        """Saves the state of the pool vm host in the database via access proxy.
+           The slot reservations made after the hosts were loaded are kept.
         """
         ap = self._get_ap()
-        ap.save_records(token, self.config['INTERNAL_API_BASE_URL'], hosts)
+        url = self.config['INTERNAL_API_BASE_URL']
+        unsaved_hosts = []
+        for host in hosts:
+            if host['state'] == DD_STATE_REMOVED:
+                unsaved_hosts.append(host)
+                continue
+            for attempt in range(DD_RECORD_UPDATE_ATTEMPTS):
+                record, version = ap.load_record(token, url, host['id'])
+                if not record:
+                    unsaved_hosts.append(host)
+                    break
+                host['reservations'] = self.get_active_reservations(record, cur_ts)
+                if ap.update_record(token, url, host, version):
+                    break
+            else:
+                self.logger.warning('_save_host_state(): too many concurrent modifications of host %s' % host['id'])
+        ap.save_records(token, url, unsaved_hosts)
 
     def _spawn_host(self, cur_ts, ramp_up=False):
         instance_name = 'pb_dd_%s' % uuid.uuid4().hex
@@ -934,20 +1341,142 @@ class DockerDriver(base_driver.ProvisioningDriverBase):
             'error_count': 0,
         }
 
-    def _prepare_host(self, host):
+    def _prepare_host(self, host, image_names, cur_ts):
+        """ Runs ansible on a new host and loads the first DD_HOST_PRIORITY_IMAGES of
+            the images, the host is activated after that. The images that failed to load
+            are retried later by housekeeping, the host can take the other images meanwhile.
+        """
         ap = self._get_ap()
 
         ap.run_ansible_on_host(host, self.logger, self.driver_config)
 
-        docker_client = ap.get_docker_client(host['docker_url'])
+        num_priority_images = self.driver_config.get('DD_HOST_PRIORITY_IMAGES', len(image_names))
+        self._load_images(host, image_names[:num_priority_images], cur_ts)
 
-        dconf = self.get_configuration()
+    def _get_images_by_popularity(self, hosts):
+        """ The images of the blueprints, the ones with most containers running in the pool first
+        """
+        image_names = self.get_configuration()['schema']['properties']['docker_image']['enum']
+        num_containers = Counter()
+        for host in hosts:
+            num_containers.update(host.get('running_images', {}))
+        return sorted(image_names, key=lambda image_name: -num_containers[image_name])
 
-        for image_name in dconf['schema']['properties']['docker_image']['enum']:
-            filename = '%s/%s.img' % (DD_IMAGE_DIRECTORY, image_name.replace('/', '.'))
-            self.logger.debug("_prepare_host(): uploading image %s from file %s" % (image_name, filename))
-            with open(filename, 'r') as img_file:
-                docker_client.load_image(img_file)
+    def _load_remaining_images(self, hosts, cur_ts):
+        """ Loads the missing images to the active hosts, except the ones backing off after a failure.
+            A failing image does not count as a host error, the host is fine for the other images.
+        """
+        image_names = self._get_images_by_popularity(hosts)
+        action_taken = False
+        for host in self.get_active_hosts(hosts):
+            if not host.get('reachable', True):
+                continue
+            missing_images = [x for x in image_names
+                              if not self.has_image(host, x) and not self.is_image_backing_off(host, x, cur_ts)]
+            if not missing_images:
+                continue
+            self.logger.info('do_housekeep(): loading %d images to host %s' % (len(missing_images), host['id']))
+            action_taken = True
+            try:
+                self._load_images(host, missing_images, cur_ts)
+            except Exception as e:
+                # unreachable hosts are counted as errors by polling
+                self.logger.warn('do_housekeep(): loading images to host %s failed, %s' % (host['id'], e))
+
+        return action_taken
+
+    @staticmethod
+    def is_image_backing_off(host, image_name, cur_ts):
+        failure = host.get('image_failures', {}).get(image_name)
+        return failure is not None and failure['retry_ts'] > cur_ts
+
+    @staticmethod
+    def check_pull_output(chunks):
+        """ docker-py 1.4 pull() does not raise when the pull fails, the error is in the status stream
+        """
+        for chunk in chunks:
+            if isinstance(chunk, bytes):
+                chunk = chunk.decode('utf-8')
+            for line in chunk.splitlines():
+                try:
+                    status = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(status, dict) and status.get('error'):
+                    raise RuntimeError(status['error'])
+
+    def _load_images(self, host, image_names, cur_ts):
+        """ Loads the images to a host in parallel and records the ids of the images on the host
+            in host['images']. With DD_IMAGE_REGISTRY the images are pulled, so only the missing
+            layers are transferred. Otherwise the image files are loaded unless the host already
+            has the same image.
+
+            The images that failed to load are recorded in host['image_failures'] and skipped
+            until their retry time, the names of those are returned.
+        """
+        ap = self._get_ap()
+        registry = self.driver_config.get('DD_IMAGE_REGISTRY')
+        image_ids = self._get_host_image_ids(ap.get_docker_client(host['docker_url']))
+        image_names = [x for x in image_names if not self.is_image_backing_off(host, x, cur_ts)]
+        if registry:
+            images_to_load = image_names
+        else:
+            images_to_load = [x for x in image_names
+                              if not image_ids.get(get_image_tag(x)) or
+                              image_ids[get_image_tag(x)] != ap.get_image_file_id(x)]
+
+        def load_image(image_name):
+            # a client per thread, the clients are not thread safe
+            docker_client = ap.get_docker_client(host['docker_url'])
+            if registry:
+                remote_name = '%s/%s' % (registry, image_name)
+                self.logger.debug("_load_images(): pulling image %s from %s" % (image_name, registry))
+                self.check_pull_output(docker_client.pull(remote_name, stream=True))
+                docker_client.tag(remote_name, image_name, force=True)
+            else:
+                self.logger.debug("_load_images(): uploading image %s from file" % image_name)
+                with ap.open_image_file(image_name) as img_file:
+                    docker_client.load_image(img_file)
+
+        errors = {}
+        if images_to_load:
+            executor = ThreadPoolExecutor(max_workers=min(len(images_to_load), DD_IMAGE_LOAD_THREADS))
+            try:
+                futures = [(image_name, executor.submit(load_image, image_name)) for image_name in images_to_load]
+                errors = dict((image_name, future.exception()) for image_name, future in futures if future.exception())
+            finally:
+                executor.shutdown(wait=True)
+            image_ids = self._get_host_image_ids(ap.get_docker_client(host['docker_url']))
+            for image_name in images_to_load:
+                if image_name not in errors and get_image_tag(image_name) not in image_ids:
+                    errors[image_name] = 'image not found on host after loading'
+
+        host_images = host.get('images', {})
+        for image_name in image_names:
+            if get_image_tag(image_name) in image_ids:
+                host_images[image_name] = image_ids[get_image_tag(image_name)]
+        host['images'] = host_images
+
+        image_failures = host.get('image_failures', {})
+        for image_name in images_to_load:
+            if image_name in errors:
+                num_failures = image_failures.get(image_name, {}).get('count', 0) + 1
+                retry_delay = min(DD_IMAGE_RETRY_DELAY * 2 ** (num_failures - 1), DD_IMAGE_RETRY_MAX_DELAY)
+                image_failures[image_name] = {'count': num_failures, 'retry_ts': cur_ts + retry_delay}
+                self.logger.warn('_load_images(): loading image %s to host %s failed %d times, retry in %d s, %s' % (
+                    image_name, host['id'], num_failures, retry_delay, errors[image_name]))
+            else:
+                image_failures.pop(image_name, None)
+        host['image_failures'] = image_failures
+        return sorted(errors.keys())
+
+    @staticmethod
+    def _get_host_image_ids(docker_client):
+        image_ids = {}
+        for image in docker_client.images():
+            for tag in image.get('RepoTags') or ():
+                image_ids[tag] = image['Id']
+        return image_ids
 
     def _remove_host(self, host):
         self.logger.debug("_remove_host()")
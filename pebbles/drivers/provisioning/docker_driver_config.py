@@ -150,7 +150,24 @@ BACKEND_CONFIG = {
             'DD_HOST_DATA_VOLUME_FACTOR': {'type': 'integer'},
             'DD_HOST_DATA_VOLUME_DEVICE': {'type': 'string'},
             'DD_HOST_DATA_VOLUME_TYPE': {'type': 'string'},
-            'DD_HOST_NETWORK': {'type': 'string'}
+            'DD_HOST_NETWORK': {'type': 'string'},
+            'DD_HOST_PRIORITY_IMAGES': {'type': 'integer'},
+            'DD_IMAGE_REGISTRY': {'type': 'string'},
+            'DD_MAX_SPAWN_PER_HOUSEKEEP': {'type': 'integer'},
+            'DD_DEMAND_HISTORY_WEEKS': {'type': 'integer'},
+            'DD_DEMAND_LOOKAHEAD_HOURS': {'type': 'integer'},
+            'DD_SESSION_CALENDAR': {'type': 'string'},
+            'DD_SESSION_PREWARM_MINUTES': {'type': 'integer'},
+            'DD_PLACEMENT_STRATEGY': {
+                'type': 'string',
+                # the keys of docker_driver.PLACEMENT_STRATEGIES
+                'enum': [
+                    'best_fit',
+                    'lifetime_packing',
+                    'oldest_first',
+                    'spread',
+                ]
+            }
 
         },
         'required': [
@@ -185,6 +202,14 @@ BACKEND_CONFIG = {
         'DD_HOST_DATA_VOLUME_FACTOR': 4,
         'DD_HOST_DATA_VOLUME_DEVICE': '/dev/vdb',  # an optional ephemeral local volume on vm flavor
         'DD_HOST_DATA_VOLUME_TYPE': 'standard',
-        'DD_HOST_NETWORK': 'auto'
+        'DD_HOST_NETWORK': 'auto',
+        'DD_HOST_PRIORITY_IMAGES': 2,  # images loaded before a new host is activated
+        'DD_IMAGE_REGISTRY': '',  # e.g. registry.local:5000, images are loaded from files if not set
+        'DD_MAX_SPAWN_PER_HOUSEKEEP': 4,
+        'DD_DEMAND_HISTORY_WEEKS': 4,  # 0 to size the pool by DD_FREE_SLOT_TARGET and the queue only
+        'DD_DEMAND_LOOKAHEAD_HOURS': 1,
+        'DD_SESSION_CALENDAR': '',  # e.g. [{"start": "2018-02-05T10:00", "end": "2018-02-05T12:00", "slots": 300}]
+        'DD_SESSION_PREWARM_MINUTES': 30,
+        'DD_PLACEMENT_STRATEGY': 'oldest_first'  # or best_fit, lifetime_packing, spread
     }
 }
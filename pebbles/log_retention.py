@@ -0,0 +1,172 @@
+"""
+Retention and compaction of the instance logs.
+
+Instance logs are pruned by log type according to a policy like::
+
+    {
+        'provisioning': {'max_age_days': 365, 'max_rows': 2000},
+        'running': {'max_age_days': 30},
+    }
+
+where max_age_days removes the rows older than that and max_rows keeps
+only the newest rows per instance. Before that, the provisioning logs of
+deleted instances are compacted into a single row holding the zlib
+compressed JSON of the original records, see expand_compacted_log().
+The log views show the compacted rows expanded, see expand_instance_logs().
+
+A pass of apply_instance_log_retention() handles one bounded batch of each
+step, so that it fits in an API request, and tells whether more is left.
+"""
+import base64
+import json
+import time
+import zlib
+
+from sqlalchemy import func
+
+from pebbles.models import db, Instance, InstanceLog
+
+LOG_TYPE_COMPACTED = 'provisioning_compacted'
+
+# instances compacted or trimmed to max_rows per retention pass
+COMPACTION_BATCH_SIZE = 100
+# rows deleted by age per log type and retention pass
+PURGE_BATCH_SIZE = 5000
+# keep the IN clauses of the deletes within the bind parameter limits of the database
+DELETE_BATCH_SIZE = 500
+
+
+def compact_instance_logs(instance_id, log_type='provisioning'):
+    """Replace the logs of an instance with one row holding them compressed"""
+    instance_logs = InstanceLog.query.filter_by(instance_id=instance_id, log_type=log_type)\
+        .order_by(InstanceLog.timestamp).all()
+    if not instance_logs:
+        return 0
+
+    log_records = [{
+        'log_level': instance_log.log_level,
+        'timestamp': instance_log.timestamp,
+        'message': instance_log.message,
+    } for instance_log in instance_logs]
+    compacted_log = InstanceLog(instance_id)
+    compacted_log.log_type = LOG_TYPE_COMPACTED
+    compacted_log.log_level = 'INFO'
+    compacted_log.timestamp = instance_logs[-1].timestamp
+    compacted_log.message = base64.b64encode(zlib.compress(json.dumps(log_records).encode('utf-8'))).decode('ascii')
+    db.session.add(compacted_log)
+
+    for instance_log in instance_logs:
+        db.session.delete(instance_log)
+    return len(instance_logs)
+
+
+def expand_compacted_log(instance_log):
+    """Return the original log records stored in a compacted log row"""
+    return json.loads(zlib.decompress(base64.b64decode(instance_log.message)).decode('utf-8'))
+
+
+def expand_instance_logs(instance_logs, latest_only=False):
+    """Replace the compacted rows in a list of logs with the provisioning logs they hold,
+    only the latest one of those with latest_only set. The others are returned as they are."""
+    expanded_logs = []
+    for instance_log in instance_logs:
+        if instance_log.log_type != LOG_TYPE_COMPACTED:
+            expanded_logs.append(instance_log)
+            continue
+        log_records = expand_compacted_log(instance_log)
+        if latest_only:
+            log_records = log_records[-1:]
+        for i, log_record in enumerate(log_records):
+            expanded_logs.append(dict(
+                log_record,
+                id='%s-%d' % (instance_log.id, i),
+                instance_id=instance_log.instance_id,
+                log_type='provisioning',
+            ))
+    return expanded_logs
+
+
+def compact_deleted_instance_logs(min_age_days, now=None, batch_size=COMPACTION_BATCH_SIZE):
+    """Compact the provisioning logs of up to batch_size deleted instances that have not been
+    written to in min_age_days. Returns the number of log rows compacted and whether there
+    are more to compact."""
+    if now is None:
+        now = time.time()
+    cutoff = now - min_age_days * 86400
+    instance_ids = [row.instance_id for row in db.session.query(InstanceLog.instance_id)
+                    .join(Instance, Instance.id == InstanceLog.instance_id)
+                    .filter(Instance.state == Instance.STATE_DELETED)
+                    .filter(InstanceLog.log_type == 'provisioning')
+                    .group_by(InstanceLog.instance_id)
+                    .having(func.max(InstanceLog.timestamp) < cutoff)
+                    .limit(batch_size)]
+    compacted = 0
+    for instance_id in instance_ids:
+        compacted += compact_instance_logs(instance_id)
+    db.session.commit()
+    return compacted, len(instance_ids) == batch_size
+
+
+def purge_old_instance_logs(log_type, max_age_days, now=None, batch_size=PURGE_BATCH_SIZE):
+    """Delete up to batch_size logs of a type older than max_age_days. Returns the number of
+    rows deleted and whether there are more to delete."""
+    if now is None:
+        now = time.time()
+    log_ids = [row.id for row in db.session.query(InstanceLog.id)
+               .filter(InstanceLog.log_type == log_type)
+               .filter(InstanceLog.timestamp < now - max_age_days * 86400)
+               .limit(batch_size)]
+    deleted = 0
+    for batch_start in range(0, len(log_ids), DELETE_BATCH_SIZE):
+        deleted += InstanceLog.query\
+            .filter(InstanceLog.id.in_(log_ids[batch_start:batch_start + DELETE_BATCH_SIZE]))\
+            .delete(synchronize_session=False)
+    db.session.commit()
+    return deleted, len(log_ids) == batch_size
+
+
+def purge_excess_instance_logs(log_type, max_rows, batch_size=COMPACTION_BATCH_SIZE):
+    """Keep only the newest max_rows logs of a type for up to batch_size instances. Returns
+    the number of rows deleted and whether there are more instances to trim."""
+    instance_ids = [row.instance_id for row in db.session.query(InstanceLog.instance_id)
+                    .filter(InstanceLog.log_type == log_type)
+                    .group_by(InstanceLog.instance_id)
+                    .having(func.count(InstanceLog.id) > max_rows)
+                    .limit(batch_size)]
+    deleted = 0
+    for instance_id in instance_ids:
+        instance_query = InstanceLog.query.filter_by(instance_id=instance_id, log_type=log_type)
+        oldest_kept = db.session.query(InstanceLog.timestamp)\
+            .filter_by(instance_id=instance_id, log_type=log_type)\
+            .order_by(InstanceLog.timestamp.desc())\
+            .offset(max_rows - 1).limit(1).scalar()
+        deleted += instance_query.filter(InstanceLog.timestamp < oldest_kept)\
+            .delete(synchronize_session=False)
+    db.session.commit()
+    return deleted, len(instance_ids) == batch_size
+
+
+def apply_instance_log_retention(policy, compaction_age_days=None, now=None):
+    """Compact and prune a batch of the instance logs according to the policy, see the module
+    docstring. Returns the number of affected rows by operation and log type, and in 'more'
+    whether another pass is needed."""
+    if now is None:
+        now = time.time()
+    results = {}
+    more = False
+    if compaction_age_days:
+        results['compacted'], more = compact_deleted_instance_logs(compaction_age_days, now=now)
+
+    for log_type, limits in policy.items():
+        deleted = 0
+        if limits.get('max_age_days'):
+            num_deleted, more_left = purge_old_instance_logs(log_type, limits['max_age_days'], now=now)
+            deleted += num_deleted
+            more = more or more_left
+        if limits.get('max_rows'):
+            num_deleted, more_left = purge_excess_instance_logs(log_type, limits['max_rows'])
+            deleted += num_deleted
+            more = more or more_left
+        results[log_type] = deleted
+    results['more'] = more
+    return results
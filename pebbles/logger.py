@@ -1,7 +1,16 @@
 import base64
 import logging
-import requests
+import sys
+import threading
 import time
+import traceback
+
+from pebbles.client import get_api_session, get_api_timeout
+
+LOG_BUFFER_CAPACITY = 100
+LOG_FLUSH_INTERVAL = 2.0
+# the flusher thread exits after this long without records and is restarted by the next record
+LOG_FLUSHER_IDLE_TIMEOUT = 60.0
 
 
 class PBInstanceLogHandler(logging.Handler):
@@ -9,24 +18,93 @@ class PBInstanceLogHandler(logging.Handler):
     Custom log handler which uploads provisioning logs through ReST interface.
     Could be replaced with HTTPHandler from standard library's logging package once it
     supports HTTPS and authentication header.
+
+    Records are buffered and uploaded in batches by a background thread when the
+    buffer reaches its capacity, every flush_interval seconds and on close, so that
+    logging does not block the provisioning on an API call per line.
     """
-    def __init__(self, api_base_url, instance_id, token, ssl_verify=True):
+    def __init__(self, api_base_url, instance_id, token, ssl_verify=True,
+                 capacity=LOG_BUFFER_CAPACITY, flush_interval=LOG_FLUSH_INTERVAL):
         logging.Handler.__init__(self)
-        auth = base64.encodestring('%s:%s' % (token, '')).replace('\n', '')
+        auth = base64.b64encode(('%s:%s' % (token, '')).encode('utf-8')).decode('ascii')
         self.ssl_verify = ssl_verify
         self.headers = {
             'Accept': 'text/plain',
             'Authorization': 'Basic %s' % auth}
         self.url = '%s/instances/%s/logs' % (api_base_url, instance_id)
+        self.session = get_api_session()
+        self.timeout = get_api_timeout()
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self._buffer_lock = threading.Lock()
+        # serializes the uploads so that the batches arrive in order
+        self._send_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._flusher = None
+        self._closed = False
 
     def emit(self, record):
-        log_record = self.format(record)
-        payload = {'log_record': log_record}
         try:
-            requests.patch(
-                self.url, json=payload, headers=self.headers, verify=self.ssl_verify)
+            log_record = self.format(record)
         except Exception:
             self.handleError(record)
+            return
+        with self._buffer_lock:
+            self.buffer.append(log_record)
+            buffer_full = len(self.buffer) >= self.capacity
+            if not self._closed and (not self._flusher or not self._flusher.is_alive()):
+                self._flusher = threading.Thread(target=self._flush_loop)
+                self._flusher.daemon = True
+                self._flusher.start()
+        if self._closed:
+            # late records after close are sent right away
+            self.flush()
+        elif buffer_full:
+            self._wakeup.set()
+
+    def _flush_loop(self):
+        idle_since = time.time()
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            if self.upload():
+                idle_since = time.time()
+            elif time.time() - idle_since > LOG_FLUSHER_IDLE_TIMEOUT:
+                with self._buffer_lock:
+                    # re-check under the lock, emit() starts a new thread if this one is gone
+                    if not self.buffer:
+                        self._flusher = None
+                        return
+
+    def upload(self):
+        """ Uploads the buffered records in one request, returns the number of records sent.
+        """
+        with self._send_lock:
+            with self._buffer_lock:
+                log_records, self.buffer = self.buffer, []
+            if not log_records:
+                return 0
+            try:
+                self.session.patch(
+                    self.url, json={'log_records': log_records}, headers=self.headers,
+                    verify=self.ssl_verify, timeout=self.timeout)
+            except Exception:
+                if logging.raiseExceptions:
+                    traceback.print_exc(file=sys.stderr)
+            return len(log_records)
+
+    def flush(self):
+        self.upload()
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        flusher = self._flusher
+        if flusher and flusher is not threading.current_thread():
+            flusher.join()
+        self.flush()
+        logging.Handler.close(self)
 
 
 class PBInstanceLogFormatter(logging.Formatter):
@@ -2,15 +2,16 @@ import string
 import random
 from flask.ext.bcrypt import Bcrypt
 import names
-from flask.ext.sqlalchemy import SQLAlchemy
-from sqlalchemy import func
+from flask.ext.sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, func
 from sqlalchemy.ext.hybrid import hybrid_property, Comparator
 from sqlalchemy.schema import MetaData
-from sqlalchemy.orm import backref
+from sqlalchemy.orm import attributes, backref, object_mapper
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 import uuid
 import json
 import datetime
+import itertools
 import six
 
 from pebbles.utils import validate_ssh_pubkey, get_full_blueprint_config, get_blueprint_fields_from_config
@@ -77,6 +78,7 @@ class User(db.Model):
     is_deleted = db.Column(db.Boolean, default=False)
     is_blocked = db.Column(db.Boolean, default=False)
     credits_quota = db.Column(db.Float, default=1.0)
+    credits_spent_settled = db.Column(db.Float, default=0.0)
     latest_seen_notification_ts = db.Column(db.DateTime)
     instances = db.relationship('Instance', backref='user', lazy='dynamic')
     activation_tokens = db.relationship('ActivationToken', backref='user', lazy='dynamic')
@@ -127,7 +129,10 @@ class User(db.Model):
         return s.dumps({'id': self.id}).decode('utf-8')
 
     def calculate_credits_spent(self):
-        return sum(instance.credits_spent() for instance in self.instances.all())
+        # finished instances have been added to the ledger already, only price the unsettled ones
+        unsettled_instances = self.instances.filter(Instance.credits_settled.is_(None)).all()
+        unsettled_credits = sum(instance.credits_spent() for instance in unsettled_instances)
+        return (self.credits_spent_settled or 0.0) + unsettled_credits
 
     def quota_exceeded(self):
         return self.calculate_credits_spent() >= self.credits_quota
@@ -176,6 +181,10 @@ group_banned_user = db.Table(  # Secondary Table for many-to-many mapping
 
 class GroupUserAssociation(db.Model):  # Association Object for many-to-many mapping
     __tablename__ = 'groups_users_association'
+    __table_args__ = (
+        # the primary key starts with group_id, memberships of a user are looked up by these
+        db.Index('ix_groups_users_association_user_id_manager', 'user_id', 'manager'),
+    )
     group_id = db.Column(db.String(32), db.ForeignKey('groups.id'), primary_key=True)
     user_id = db.Column(db.String(32), db.ForeignKey('users.id'), primary_key=True)
     manager = db.Column(db.Boolean, default=False)
@@ -216,7 +225,7 @@ class Notification(db.Model):
     __tablename__ = 'notifications'
 
     id = db.Column(db.String(32), primary_key=True)
-    broadcasted = db.Column(db.DateTime)
+    broadcasted = db.Column(db.DateTime, index=True)
     subject = db.Column(db.String(MAX_NOTIFICATION_SUBJECT_LENGTH))
     message = db.Column(db.Text)
 
@@ -359,7 +368,7 @@ class Blueprint(db.Model):
     _config = db.Column('config', db.Text)
     is_enabled = db.Column(db.Boolean, default=False)
     instances = db.relationship('Instance', backref='blueprint', lazy='dynamic')
-    group_id = db.Column(db.String(32), db.ForeignKey('groups.id'))
+    group_id = db.Column(db.String(32), db.ForeignKey('groups.id'), index=True)
     current_status = db.Column(db.String(32), default='active')
 
     def __init__(self):
@@ -417,6 +426,18 @@ class Instance(db.Model):
     )
 
     __tablename__ = 'instances'
+    __table_args__ = (
+        db.Index('ix_instances_user_id_blueprint_id_state', 'user_id', 'blueprint_id', 'state'),
+        db.Index('ix_instances_blueprint_id_state', 'blueprint_id', 'state'),
+        # deleted instances pile up over time, the scheduler and the listings only care about the rest
+        db.Index(
+            'ix_instances_active_provisioned_at', 'provisioned_at',
+            postgresql_where=db.text("state NOT IN ('deleted', 'failed')"),
+            sqlite_where=db.text("state NOT IN ('deleted', 'failed')")
+        ),
+        # serves the order and the cursor of the paginated instance listings
+        db.Index('ix_instances_created_at_id', 'created_at', 'id'),
+    )
     id = db.Column(db.String(32), primary_key=True)
     user_id = db.Column(db.String(32), db.ForeignKey('users.id'))
     blueprint_id = db.Column(db.String(32), db.ForeignKey('blueprints.id'))
@@ -430,6 +451,10 @@ class Instance(db.Model):
     to_be_deleted = db.Column(db.Boolean, default=False)
     error_msg = db.Column(db.String(256))
     _instance_data = db.Column('instance_data', db.Text)
+    credits_settled = db.Column(db.Float)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    # the instance listings are versioned by the latest update of the rows they show
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
 
     def __init__(self, blueprint, user):
         self.id = uuid.uuid4().hex
@@ -439,6 +464,9 @@ class Instance(db.Model):
         self._state = Instance.STATE_QUEUEING
 
     def credits_spent(self, duration=None):
+        if not duration and self.credits_settled is not None:
+            return self.credits_settled
+
         if self.errored:
             return 0.0
 
@@ -454,6 +482,27 @@ class Instance(db.Model):
             cost_multiplier = 1.0
         return cost_multiplier * duration / 3600
 
+    def settle_credits(self):
+        """Freezes the cost of a finished instance and adds it to the credits ledger of the user.
+        Returns True if this call settled the instance."""
+        if self.credits_settled is not None:
+            return False
+        credits_settled = self.credits_spent()
+        # claim the settlement in the database, a concurrent request settling the same
+        # instance finds it claimed and does not charge the user again
+        num_claimed = Instance.query\
+            .filter(Instance.id == self.id, Instance.credits_settled.is_(None))\
+            .update({Instance.credits_settled: credits_settled}, synchronize_session=False)
+        if num_claimed != 1:
+            return False
+        attributes.set_committed_value(self, 'credits_settled', credits_settled)
+        # increment in the database to not lose concurrent settlements for the same user
+        User.query.filter_by(id=self.user_id).update(
+            {User.credits_spent_settled: func.coalesce(User.credits_spent_settled, 0.0) + credits_settled},
+            synchronize_session=False
+        )
+        return True
+
     @hybrid_property
     def runtime(self):
         if not self.provisioned_at:
@@ -492,8 +541,13 @@ class Instance(db.Model):
 
 class InstanceLog(db.Model):
     __tablename__ = 'instance_logs'
+    __table_args__ = (
+        db.Index('ix_instance_logs_instance_id_log_type_timestamp', 'instance_id', 'log_type', 'timestamp'),
+        # for the retention purges by age
+        db.Index('ix_instance_logs_log_type_timestamp', 'log_type', 'timestamp'),
+    )
     id = db.Column(db.String(32), primary_key=True)
-    instance_id = db.Column(db.String(32), db.ForeignKey('instances.id'), index=True, unique=False)
+    instance_id = db.Column(db.String(32), db.ForeignKey('instances.id'))
     log_level = db.Column(db.String(8))
     log_type = db.Column(db.String(64))
     timestamp = db.Column(db.Float)
@@ -515,6 +569,90 @@ class Lock(db.Model):
         self.acquired_at = datetime.datetime.utcnow()
 
 
+# tables whose changes are counted for the ETags of the polled list views,
+# a new table needs its counter row in the migration that creates it. The tables
+# written on every instance change (instances, instance_logs, users) are left out,
+# the views version those by the rows they show.
+CHANGE_COUNTER_TABLES = (
+    'blueprint_templates',
+    'blueprints',
+    'groups',
+    'groups_banned_users',
+    'groups_users_association',
+    'notifications',
+)
+
+
+class ChangeCounter(db.Model):
+    """ Version of the contents of a table, incremented after a transaction
+        that changed the table commits. See get_table_versions().
+    """
+    __tablename__ = 'change_counters'
+
+    table_name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+@event.listens_for(ChangeCounter.__table__, 'after_create')
+def _create_change_counters(target, connection, **kw):
+    connection.execute(target.insert(), [{'table_name': name, 'version': 0} for name in CHANGE_COUNTER_TABLES])
+
+
+def get_table_versions(table_names):
+    """Return the change counters of the given tables in one query"""
+    if not table_names:
+        return []
+    versions = dict(db.session.query(ChangeCounter.table_name, ChangeCounter.version)
+                    .filter(ChangeCounter.table_name.in_(table_names)))
+    return [versions.get(name, 0) for name in table_names]
+
+
+def bump_table_versions(table_names):
+    """Increment the change counters of the given tables, each in its own short transaction
+    in a fixed order, so that the counter rows are never locked for long or in a cycle"""
+    for table_name in sorted(set(table_names).intersection(CHANGE_COUNTER_TABLES)):
+        db.engine.execute(ChangeCounter.__table__.update()
+                          .where(ChangeCounter.table_name == table_name)
+                          .values(version=ChangeCounter.version + 1))
+
+
+def _record_changed_tables(session, table_names):
+    session.info.setdefault('changed_tables', set()).update(table_names)
+
+
+@event.listens_for(SignallingSession, 'after_flush')
+def _record_flushed_tables(session, flush_context):
+    table_names = set()
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        mapper = object_mapper(obj)
+        # a row referencing another one, like a new instance of a blueprint, does not change the other row
+        if obj not in session.dirty or session.is_modified(obj, include_collections=False):
+            table_names.update(table.name for table in mapper.tables)
+        for relationship in mapper.relationships:
+            if relationship.secondary is None:
+                continue
+            history = attributes.get_history(obj, relationship.key, passive=attributes.PASSIVE_NO_INITIALIZE)
+            if obj in session.deleted or history.has_changes():
+                table_names.add(relationship.secondary.name)
+    _record_changed_tables(session, table_names)
+
+
+@event.listens_for(SignallingSession, 'after_bulk_update')
+@event.listens_for(SignallingSession, 'after_bulk_delete')
+def _record_bulk_tables(update_context):
+    _record_changed_tables(update_context.session, [table.name for table in update_context.mapper.tables])
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def _bump_committed_table_versions(session):
+    bump_table_versions(session.info.pop('changed_tables', ()))
+
+
+@event.listens_for(SignallingSession, 'after_rollback')
+def _forget_changed_tables(session):
+    session.info.pop('changed_tables', None)
+
+
 class NamespacedKeyValue(db.Model):
     """ Stores key/value pair data, separated by namespaces
         This model should be initialized by providing namespace and key as mandatory arguments.
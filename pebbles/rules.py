@@ -1,9 +1,7 @@
-from pebbles.models import Blueprint, BlueprintTemplate, Instance, GroupUserAssociation
+from pebbles.models import db, Blueprint, BlueprintTemplate, Instance, GroupUserAssociation, group_banned_user
 from pebbles.views.commons import is_group_manager
 from sqlalchemy import or_, and_
-from sqlalchemy.orm import load_only
 from sqlalchemy.sql.expression import true
-import itertools
 # import logging
 
 
@@ -21,24 +19,20 @@ def apply_rules_blueprint_templates(user, args=None):
 def apply_rules_blueprints(user, args=None):
     q = Blueprint.query
     if not user.is_admin:
-        group_user_objs = GroupUserAssociation.query.filter_by(user_id=user.id, manager=False).all()
-        user_group_ids = [group_user_obj.group.id for group_user_obj in group_user_objs]
-        banned_group_ids = [banned_group_item.id for banned_group_item in user.banned_groups.all()]
-        allowed_group_ids = set(user_group_ids) - set(banned_group_ids)  # do not allow the banned users
-
-        # Start building query expressions based on the condition that :
-        # a group manager can see all of his blueprints and only enabled ones of other groups
-        query_exp = Blueprint.is_enabled == true()
-        allowed_group_ids_exp = None
-        if allowed_group_ids:
-            allowed_group_ids_exp = Blueprint.group_id.in_(allowed_group_ids)
-        query_exp = and_(allowed_group_ids_exp, query_exp)
-
-        manager_group_ids = get_manager_group_ids(user)
-        manager_group_ids_exp = None
-        if manager_group_ids:
-            manager_group_ids_exp = Blueprint.group_id.in_(manager_group_ids)
-        query_exp = or_(query_exp, manager_group_ids_exp)
+        # the memberships are resolved in the same statement, so the cost does not grow with the groups
+        user_group_ids = get_group_ids_query(user, manager=False).subquery()
+        banned_group_ids = db.session.query(group_banned_user.c.group_id)\
+            .filter(group_banned_user.c.user_id == user.id).subquery()
+        manager_group_ids = get_group_ids_query(user, manager=True).subquery()
+
+        # a group manager can see all of his blueprints and only enabled ones of other groups,
+        # the banned users do not see the blueprints of the group
+        query_exp = and_(
+            Blueprint.is_enabled == true(),
+            Blueprint.group_id.in_(user_group_ids),
+            ~Blueprint.group_id.in_(banned_group_ids)
+        )
+        query_exp = or_(query_exp, Blueprint.group_id.in_(manager_group_ids))
         q = q.filter(query_exp)
 
     if args is not None and 'blueprint_id' in args:
@@ -61,13 +55,12 @@ def apply_rules_export_blueprints(user):
 def apply_rules_instances(user, args=None):
     q = Instance.query
     if not user.is_admin:
-        q1 = q.filter_by(user_id=user.id)
         if is_group_manager(user):  # show only the instances of the blueprints which the group manager holds
-            group_blueprints_id = get_group_blueprint_ids_for_instances(user, manager=True)
-            q2 = q.filter(Instance.blueprint_id.in_(group_blueprints_id))
-            q = q1.union(q2)
+            group_blueprints_id = get_group_blueprint_ids_query(user, manager=True).subquery()
+            # a disjunction instead of a UNION keeps the query filterable and orderable for paging
+            q = q.filter(or_(Instance.user_id == user.id, Instance.blueprint_id.in_(group_blueprints_id)))
         else:
-            q = q1
+            q = q.filter_by(user_id=user.id)
     if args is None or not args.get('show_deleted'):
         q = q.filter(Instance.state != Instance.STATE_DELETED)
     if args is not None:
@@ -75,9 +68,9 @@ def apply_rules_instances(user, args=None):
             q = q.filter_by(id=args.get('instance_id'))
         if args.get('show_only_mine'):
             q = q.filter_by(user_id=user.id)
-        if 'offset' in args:
+        if args.get('offset') is not None:
             q = q.offset(args.get('offset'))
-        if 'limit' in args:
+        if args.get('limit') is not None:
             q = q.limit(args.get('limit'))
     return q
 
@@ -85,24 +78,30 @@ def apply_rules_instances(user, args=None):
 # all the helper functions for the rules go here
 
 
+def get_group_ids_query(user, manager=None):
+    """Return a query for the ids of the user's groups, only the managed or the other ones if manager is given"""
+    q = db.session.query(GroupUserAssociation.group_id).filter(GroupUserAssociation.user_id == user.id)
+    if manager is not None:
+        q = q.filter(GroupUserAssociation.manager == manager)
+    return q
+
+
 def get_manager_group_ids(user):
     """Return the group ids for the user's managed groups"""
     # the result shall contain the owners of the groups too as they are managers by default
-    group_manager_objs = GroupUserAssociation.query.filter_by(user_id=user.id, manager=True).all()
-    manager_group_ids = [group_manager_obj.group.id for group_manager_obj in group_manager_objs]
-    return manager_group_ids
+    return [row.group_id for row in get_group_ids_query(user, manager=True)]
+
+
+def get_group_blueprint_ids_query(user, manager=None):
+    """Return a query for the ids of the blueprints in the user's groups, or only in the managed ones"""
+    q = db.session.query(Blueprint.id)\
+        .join(GroupUserAssociation, GroupUserAssociation.group_id == Blueprint.group_id)\
+        .filter(GroupUserAssociation.user_id == user.id)
+    if manager:  # if we require only managed groups
+        q = q.filter(GroupUserAssociation.manager == true())
+    return q
 
 
 def get_group_blueprint_ids_for_instances(user, manager=None):
     """Return the valid blueprint ids based on user's groups to be used in instances view"""
-    group_user_query = GroupUserAssociation.query
-    if manager:  # if we require only managed groups
-        group_user_objs = group_user_query.filter_by(user_id=user.id, manager=True).all()
-    else:  # get the normal user groups
-        group_user_objs = group_user_query.filter_by(user_id=user.id).all()
-    groups = [group_user_obj.group for group_user_obj in group_user_objs]
-    # loading only id column rest will be deferred
-    group_blueprints = [group_item.blueprints.options(load_only("id")).all() for group_item in groups]
-    group_blueprints_flat = list(itertools.chain.from_iterable(group_blueprints))  # merge the list of lists into one list
-    group_blueprints_id = [blueprint_item.id for blueprint_item in group_blueprints_flat]  # Get the ids in a list
-    return group_blueprints_id
+    return [row.id for row in get_group_blueprint_ids_query(user, manager)]
@@ -18,7 +18,7 @@ from pebbles.views.plugins import plugins, PluginList, PluginView
 from pebbles.views.users import users, UserList, UserView, UserActivationUrl, UserBlacklist, UserGroupOwner, KeypairList, CreateKeyPair, UploadKeyPair
 from pebbles.views.groups import groups, GroupList, GroupView, GroupJoin, GroupListExit, GroupExit, GroupUsersList
 from pebbles.views.notifications import NotificationList, NotificationView
-from pebbles.views.instances import instances, InstanceList, InstanceView, InstanceLogs
+from pebbles.views.instances import instances, InstanceList, InstanceDueWork, InstanceDemand, InstanceView, InstanceLogs, InstanceLogRetention
 from pebbles.views.activations import activations, ActivationList, ActivationView
 from pebbles.views.firstuser import firstuser, FirstUserView
 from pebbles.views.myip import myip, WhatIsMyIp
@@ -59,6 +59,9 @@ api.add_resource(BlueprintList, api_root + '/blueprints')
 api.add_resource(BlueprintView, api_root + '/blueprints/<string:blueprint_id>')
 api.add_resource(BlueprintCopy, api_root + '/blueprints/blueprint_copy/<string:blueprint_id>')
 api.add_resource(InstanceList, api_root + '/instances')
+api.add_resource(InstanceDueWork, api_root + '/instances/due_work')
+api.add_resource(InstanceDemand, api_root + '/instances/demand')
+api.add_resource(InstanceLogRetention, api_root + '/instances/log_retention')
 api.add_resource(
     InstanceView,
     api_root + '/instances/<string:instance_id>',
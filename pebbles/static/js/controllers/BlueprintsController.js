@@ -23,7 +23,8 @@ app.controller('BlueprintsController', ['$q', '$scope', '$http', '$interval', '$
 
          var groups = Restangular.all('groups');
 
-         groups.getList().then(function (response) {
+         // the blueprint modals only list the group names
+         groups.getList({fields: 'id,name'}).then(function (response) {
              $scope.groups = response;
          });
 
@@ -166,7 +167,7 @@ app.controller('BlueprintsController', ['$q', '$scope', '$http', '$interval', '$
     
 	$scope.deleteBlueprint = function(blueprint) {
             blueprint.get().then(function(response){ 
-	        instances.getList().then(function (response) {
+	        instances.getList({include_logs: 'false'}).then(function (response) {
 		     var blueprint_instances = _.filter(response,function(user) { return user.blueprint_id === blueprint.id });
 		     if(_.isEmpty(blueprint_instances.length)) {
                        $uibModal.open({
@@ -71,7 +71,7 @@ app.controller('DashboardController', ['$q', '$scope', '$routeParams', '$interva
 
         var instances = Restangular.all('instances');
 
-        var limit = undefined, offset = undefined, include_deleted = undefined;
+        var limit = undefined, offset = undefined, include_deleted = undefined, cursor = undefined;
 
         $scope.limit = LIMIT_DEFAULT;
         $scope.offset = OFFSET_DEFAULT;
@@ -112,14 +112,17 @@ app.controller('DashboardController', ['$q', '$scope', '$routeParams', '$interva
 
 
         $scope.updateInstanceList = function(option) {
-            var queryParams = {};
+            // the dashboard does not show logs, full logs are fetched in the instance details view
+            var queryParams = {include_logs: 'false'};
             if (include_deleted) {
                 queryParams.show_deleted = true;
             }
             if (limit) {
                 queryParams.limit = $scope.limit;
             }
-            if (offset) {
+            if (cursor) {
+                queryParams.cursor = cursor;
+            } else if (offset) {
                 queryParams.offset = $scope.offset;
             }
             if (AuthService.isGroupOwnerOrAdmin() && isUserDashboard) {
@@ -134,6 +137,7 @@ app.controller('DashboardController', ['$q', '$scope', '$routeParams', '$interva
                     }
                 }
                 $scope.instances = response;
+                $scope.next_cursor = response.nextCursor;
             });
             var own_instances = _.filter($scope.instances, {'user_id': AuthService.getUserId(), 'state': 'running'});
 	    DesktopNotifications.notifyInstanceLifetime(own_instances);
@@ -150,6 +154,12 @@ app.controller('DashboardController', ['$q', '$scope', '$routeParams', '$interva
             include_deleted = $scope.include_deleted;
             limit = $scope.limit;
             offset = $scope.offset;
+            cursor = undefined;
+            $scope.updateInstanceList();
+        };
+
+        $scope.nextPage = function() {
+            cursor = $scope.next_cursor;
             $scope.updateInstanceList();
         };
 
@@ -158,7 +168,7 @@ app.controller('DashboardController', ['$q', '$scope', '$routeParams', '$interva
             $scope.limit = LIMIT_DEFAULT;
             $scope.offset = OFFSET_DEFAULT;
             $scope.query = undefined;
-            limit = offset = include_deleted = undefined;
+            limit = offset = include_deleted = cursor = undefined;
             $scope.updateInstanceList();
         };
 
@@ -22,27 +22,53 @@ app.controller('UsersController', ['$q', '$scope', '$interval', '$uibModal', '$f
                 $scope.quotas = response;
             });
 
-            users.getList().then(function (response) {
-                $scope.users = response;
-            });
+            var USERS_PAGE_SIZE = 500;
+
+            // the filter is applied on the server, the loaded pages are only a part of the users
+            var user_query_params = function(cursor) {
+                var params = {limit: USERS_PAGE_SIZE};
+                if ($scope.query) {
+                    params.filter = $scope.query;
+                }
+                if (cursor) {
+                    params.cursor = cursor;
+                }
+                return params;
+            };
+
+            var load_users = function() {
+                users.getList(user_query_params()).then(function (response) {
+                    $scope.users = response;
+                    $scope.next_cursor = response.nextCursor;
+                });
+            };
+
+            $scope.filter_users = function() {
+                load_users();
+            };
+
+            $scope.load_more_users = function() {
+                users.getList(user_query_params($scope.next_cursor)).then(function (response) {
+                    $scope.users = $scope.users.concat(response);
+                    $scope.next_cursor = response.nextCursor;
+                });
+            };
+
+            load_users();
 
             $scope.new_user = '';
             $scope.add_user = function(email) {
                 if ($scope.add_user_form.$valid){
                     var user_parameters = {email: email};
                     users.post(user_parameters).then(function() {
-                        users.getList().then(function (response) {
-                            $scope.users = response;
-                        });
+                        load_users();
                     });
                 }
             };
 
             $scope.remove_user = function(user) {
                 user.remove().then(function () {
-                    users.getList().then(function (response) {
-                        $scope.users = response;
-                    });
+                    load_users();
                 });
             };
 
@@ -50,9 +76,7 @@ app.controller('UsersController', ['$q', '$scope', '$interval', '$uibModal', '$f
                 var block = !user.is_blocked
                 var user_blacklist = Restangular.one('users', user.id).all('user_blacklist').customPUT({'block': block});
                 user_blacklist.then(function () {
-                    users.getList().then(function (response) {
-                        $scope.users = response;
-                    });
+                    load_users();
                 });
 
             };
@@ -61,9 +85,7 @@ app.controller('UsersController', ['$q', '$scope', '$interval', '$uibModal', '$f
                 var make_group_owner = !user.is_group_owner
                 var user_group_owner = Restangular.one('users', user.id).all('user_group_owner').customPUT({'make_group_owner': make_group_owner});
                 user_group_owner.then(function () {
-                    users.getList().then(function (response) {
-                        $scope.users = response;
-                    });
+                    load_users();
                 });
 
             };
@@ -93,9 +115,7 @@ app.controller('UsersController', ['$q', '$scope', '$interval', '$uibModal', '$f
                 });
                 modalQuota.result.then(function (changed) {
                     if (changed) {
-                        $scope.users.getList().then(function (response) {
-                            $scope.users = response;
-                        });
+                        load_users();
                     }
                 });
             };
@@ -111,9 +131,7 @@ app.controller('UsersController', ['$q', '$scope', '$interval', '$uibModal', '$f
                     }
                 });
                 modalInviteUsers.result.then(function() {
-                    $scope.users.getList().then(function (response) {
-                        $scope.users = response;
-                    });
+                    load_users();
                 });
             };
         }
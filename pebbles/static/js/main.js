@@ -12,6 +12,14 @@ app.run(function($location, Restangular, AuthService) {
         };
     });
 
+    // paginated lists return the cursor of their next page in a header
+    Restangular.addResponseInterceptor(function(data, operation, what, url, response) {
+        if (operation === 'getList') {
+            data.nextCursor = response.headers('X-Next-Cursor');
+        }
+        return data;
+    });
+
     Restangular.setErrorInterceptor(function(response) {
         if (response.config.bypassErrorInterceptor) {
             return true;
@@ -1,6 +1,8 @@
 import base64
 import json
 import logging
+import threading
+import time
 from celery import Celery
 from kombu import Queue
 from celery.schedules import crontab
@@ -8,47 +10,81 @@ from celery.signals import worker_process_init
 import requests
 from celery.utils.log import get_task_logger
 from pebbles.config import BaseConfig
+from pebbles.client import get_api_session, get_api_timeout
 
 local_config = BaseConfig()
 
 
-def get_token():
-    """ returns a session token from te internal API.
+# tokens from User.generate_auth_token() are valid for 12 hours, renew them an hour
+# early so that a task does not run out of token in the middle
+TOKEN_LIFETIME = 43200
+TOKEN_RENEWAL_MARGIN = 3600
+
+_token_cache = {'token': None, 'expires_at': 0}
+_token_lock = threading.Lock()
+
+
+def fetch_token():
+    """ logs in to the internal API and returns a new session token.
     """
     auth_url = '%s/sessions' % local_config['INTERNAL_API_BASE_URL']
     auth_credentials = {'email': 'worker@pebbles',
                         'password': local_config['SECRET_KEY']}
     try:
-        r = requests.post(auth_url, auth_credentials, verify=local_config['SSL_VERIFY'])
+        r = get_api_session().post(auth_url, auth_credentials, verify=local_config['SSL_VERIFY'], timeout=get_api_timeout())
         return json.loads(r.text).get('token')
     except:
         return None
 
 
+def get_token(expired_token=None):
+    """ returns a session token from te internal API.
+
+    The token is shared by all the tasks of the worker process and renewed
+    shortly before it expires. Passing a token the API has rejected as
+    expired_token forces a renewal, unless another task has already renewed it.
+    """
+    with _token_lock:
+        now = time.time()
+        token = _token_cache['token']
+        if token and token != expired_token and now < _token_cache['expires_at'] - TOKEN_RENEWAL_MARGIN:
+            return token
+        token = fetch_token()
+        _token_cache['token'] = token
+        _token_cache['expires_at'] = now + TOKEN_LIFETIME if token else 0
+        return token
+
+
+def get_auth_headers(token):
+    auth = base64.b64encode(('%s:%s' % (token, '')).encode('utf-8')).decode('ascii')
+    return {'Accept': 'text/plain',
+            'Authorization': 'Basic %s' % auth}
+
+
 def do_get(token, object_url):
     """ wrapper to use the GET method with authentication token against the
-    internal api url.
+    internal api url. A rejected token is renewed and the request retried once.
     """
-    auth = base64.encodestring('%s:%s' % (token, '')).replace('\n', '')
-    headers = {'Accept': 'text/plain',
-               'Authorization': 'Basic %s' % auth}
     url = '%s/%s' % (local_config['INTERNAL_API_BASE_URL'], object_url)
-    resp = requests.get(url, headers=headers, verify=local_config['SSL_VERIFY'])
+    resp = get_api_session().get(url, headers=get_auth_headers(token), verify=local_config['SSL_VERIFY'], timeout=get_api_timeout())
+    if resp.status_code == 401:
+        new_token = get_token(expired_token=token)
+        if new_token and new_token != token:
+            resp = get_api_session().get(url, headers=get_auth_headers(new_token), verify=local_config['SSL_VERIFY'], timeout=get_api_timeout())
     return resp
 
 
 def do_post_or_put(token, api_path, data, method='POST'):
     """ wrapper to use the POST method with uthentication token against the
-    internal api url.
+    internal api url. A rejected token is renewed and the request retried once.
     """
-    auth = base64.encodestring('%s:%s' % (token, '')).replace('\n', '')
-    headers = {'Accept': 'text/plain',
-               'Authorization': 'Basic %s' % auth}
     url = '%s/%s' % (local_config['INTERNAL_API_BASE_URL'], api_path)
-    if method == 'POST':
-        resp = requests.post(url, json=data, headers=headers, verify=local_config['SSL_VERIFY'])
-    elif method == 'PUT':
-        resp = requests.put(url, json=data, headers=headers, verify=local_config['SSL_VERIFY'])
+    session = get_api_session()
+    resp = session.request(method, url, json=data, headers=get_auth_headers(token), verify=local_config['SSL_VERIFY'], timeout=get_api_timeout())
+    if resp.status_code == 401:
+        new_token = get_token(expired_token=token)
+        if new_token and new_token != token:
+            resp = session.request(method, url, json=data, headers=get_auth_headers(new_token), verify=local_config['SSL_VERIFY'], timeout=get_api_timeout())
     return resp
 
 
@@ -86,6 +122,8 @@ celery_app.conf.CELERY_QUEUES = (
     Queue('celery', routing_key='task.#'),
     Queue('proxy_tasks', routing_key='proxy_task.#'),
     Queue('system_tasks', routing_key='system_task.#'),
+    # consumed by a single worker process, see UpdateScheduler
+    Queue('update_scheduling_tasks', routing_key='update_scheduling_task.#'),
 )
 celery_app.conf.CELERY_ROUTES = (
     'pebbles.tasks.celery_app.TaskRouter',
@@ -95,7 +133,7 @@ celery_app.conf.CELERYBEAT_SCHEDULE = {
     'periodic-update-every-minute': {
         'task': 'pebbles.tasks.periodic_update',
         'schedule': crontab(minute='*/1'),
-        'options': {'expires': 60, 'queue': 'system_tasks'},
+        'options': {'expires': 60, 'queue': 'update_scheduling_tasks'},
     },
     'check-plugins-every-minute': {
         'task': 'pebbles.tasks.publish_plugins_and_configs',
@@ -106,6 +144,11 @@ celery_app.conf.CELERYBEAT_SCHEDULE = {
         'task': 'pebbles.tasks.housekeeping',
         'schedule': crontab(minute='*/1'),
         'options': {'expires': 60, 'queue': 'system_tasks'},
+    },
+    'purge-instance-logs-daily': {
+        'task': 'pebbles.tasks.purge_instance_logs',
+        'schedule': crontab(hour=3, minute=30),
+        'options': {'expires': 3600, 'queue': 'system_tasks'},
     }
 }
 
@@ -118,12 +161,15 @@ class TaskRouter(object):
         return 'provisioning_tasks-%d' % queue_num
 
     def route_for_task(self, task, args=None, kwargs=None):
+        if task == "pebbles.tasks.periodic_update":
+            return {'queue': 'update_scheduling_tasks'}
+
         if task in (
                 "pebbles.tasks.send_mails",
-                "pebbles.tasks.periodic_update",
                 "pebbles.tasks.send_mails",
                 "pebbles.tasks.publish_plugins_and_configs",
                 "pebbles.tasks.housekeeping",
+                "pebbles.tasks.purge_instance_logs",
         ):
             return {'queue': 'system_tasks'}
 
@@ -1,15 +1,118 @@
 from email.mime.text import MIMEText
-import random
 import smtplib
+import time
 import jinja2
 
 from pebbles.client import PBClient
 from pebbles.models import Instance
-from pebbles.tasks.celery_app import logger, get_token, local_config, get_dynamic_config
+from pebbles.tasks.celery_app import logger, get_token, local_config, get_dynamic_config, do_post_or_put
 from pebbles.tasks.provisioning_tasks import run_update
 from pebbles.tasks.celery_app import celery_app
 
 
+ACTION_DEPROVISION = 'deprovision'
+ACTION_UPDATE = 'update'
+
+
+class UpdateScheduler(object):
+    """ Keeps track of the instances that need an update and hands them out
+    in priority order, up to the number of update tasks the provisioning
+    workers can take.
+
+    Instances run out of lifetime first and, among equals, the ones that
+    have waited longest in their current state go first. An instance with
+    an update task still in flight is not dispatched again until the task
+    has finished or in_flight_timeout has passed.
+
+    The state is kept in the memory of the worker process, so periodic_update
+    is routed to the update_scheduling_tasks queue, which is consumed by a
+    single worker process without a task limit per child. With more processes
+    each round would see different state: in-flight instances would be
+    dispatched again, the capacity would be exceeded and the waiting times
+    would restart. After a worker restart the state is rebuilt in a round or
+    two; tasks dispatched before the restart are not counted as in flight.
+    """
+
+    def __init__(self, capacity, in_flight_timeout=600):
+        self.capacity = capacity
+        self.in_flight_timeout = in_flight_timeout
+        # instance_id -> (async result, dispatch time)
+        self.in_flight = {}
+        # instance_id -> ((state, action), time first seen in that state)
+        self.due_since = {}
+        self.metrics = {}
+
+    @staticmethod
+    def get_action(instance):
+        state = instance.get('state')
+        if state == Instance.STATE_RUNNING:
+            if not instance.get('lifetime_left') and instance.get('maximum_lifetime'):
+                return ACTION_DEPROVISION
+            return None
+        if state == Instance.STATE_FAILED:
+            return None
+        return ACTION_UPDATE
+
+    def prune_in_flight(self, now):
+        for instance_id, (result, dispatched_at) in list(self.in_flight.items()):
+            if result is None or result.ready() or now - dispatched_at > self.in_flight_timeout:
+                del self.in_flight[instance_id]
+
+    def schedule(self, instances, now=None):
+        """ Returns the list of (action, instance) tuples to dispatch in this round
+        """
+        if now is None:
+            now = time.time()
+        self.prune_in_flight(now)
+
+        due_since = {}
+        due_work = []
+        for instance in instances:
+            action = self.get_action(instance)
+            if not action:
+                continue
+            instance_id = instance['id']
+            key = (instance.get('state'), action)
+            previous = self.due_since.get(instance_id)
+            due_ts = previous[1] if previous and previous[0] == key else now
+            due_since[instance_id] = (key, due_ts)
+            if instance_id in self.in_flight:
+                continue
+            due_work.append((instance.get('lifetime_left') or 0, due_ts, action, instance))
+        # forget instances that do not need any action anymore
+        self.due_since = due_since
+
+        due_work.sort(key=lambda item: (item[0], item[1]))
+        free_slots = max(self.capacity - len(self.in_flight), 0)
+        dispatch = due_work[:free_slots]
+        waiting = due_work[free_slots:]
+
+        self.metrics = {
+            'queue_depth': len(waiting),
+            'lag': max(now - min(item[1] for item in waiting), 0) if waiting else 0.0,
+            'in_flight': len(self.in_flight) + len(dispatch),
+            'dispatched': len(dispatch),
+        }
+        return [(action, instance) for _, _, action, instance in dispatch]
+
+    def mark_dispatched(self, instance_id, result, now=None):
+        if now is None:
+            now = time.time()
+        self.in_flight[instance_id] = (result, now)
+
+
+update_scheduler = None
+
+
+def get_update_scheduler():
+    global update_scheduler
+    capacity = local_config['PROVISIONING_NUM_WORKERS'] * local_config['PERIODIC_UPDATE_TASKS_PER_WORKER']
+    if not update_scheduler:
+        update_scheduler = UpdateScheduler(capacity)
+    update_scheduler.capacity = capacity
+    return update_scheduler
+
+
 @celery_app.task(name="pebbles.tasks.periodic_update")
 def periodic_update():
     """ Runs periodic updates.
@@ -17,42 +120,46 @@ def periodic_update():
     In particular sets old instances up for deprovisioning after they are past
     their maximum_lifetime and sets instances up for up updates.
 
-    Both deletion and update events are not guaranteed to take place
-    immediately. If there are more than 10 instances a random sample of 10
-    updates and deletions will take place to ensure task is safe to run and
-    won't slow down other tasks.
+    The work is prioritized by UpdateScheduler, which remembers between runs
+    how long each instance has been waiting and which update tasks are still
+    in flight. Queue depth and lag are logged and returned as the task result.
     """
     token = get_token()
-    pbclient = PBClient(token, local_config['INTERNAL_API_BASE_URL'], ssl_verify=False)
-    instances = pbclient.get_instances()
-
-    deprovision_list = []
-    update_list = []
-    for instance in instances:
-        logger.debug('checking instance for actions %s' % instance['name'])
-        deprovision_required = False
-        if instance.get('state') in [Instance.STATE_RUNNING]:
-            if not instance.get('lifetime_left') and instance.get('maximum_lifetime'):
-                deprovision_required = True
-
-            if deprovision_required:
-                deprovision_list.append(instance)
-
-        elif instance.get('state') not in [Instance.STATE_FAILED]:
-            update_list.append(instance)
-
-    # ToDo: refactor magic number to variable
-    if len(deprovision_list) > 10:
-        deprovision_list = random.sample(deprovision_list, 10)
-    for instance in deprovision_list:
-        logger.info('deprovisioning triggered for %s (reason: maximum lifetime exceeded)' % instance.get('id'))
-        pbclient.do_instance_patch(instance['id'], {'to_be_deleted': True})
-        run_update.delay(instance.get('id'))
-
-    if len(update_list) > 10:
-        update_list = random.sample(update_list, 10)
-    for instance in update_list:
-        run_update.delay(instance.get('id'))
+    pbclient = PBClient(token, local_config['INTERNAL_API_BASE_URL'], ssl_verify=False, token_refresher=get_token)
+    instances = pbclient.get_due_instances()
+
+    scheduler = get_update_scheduler()
+    for action, instance in scheduler.schedule(instances):
+        if action == ACTION_DEPROVISION:
+            logger.info('deprovisioning triggered for %s (reason: maximum lifetime exceeded)' % instance.get('id'))
+            if not instance.get('to_be_deleted'):
+                pbclient.do_instance_patch(instance['id'], {'to_be_deleted': True})
+        scheduler.mark_dispatched(instance['id'], run_update.delay(instance.get('id')))
+
+    metrics = scheduler.metrics
+    logger.info('periodic update: dispatched %d, in flight %d, queue depth %d, lag %.1fs' % (
+        metrics['dispatched'], metrics['in_flight'], metrics['queue_depth'], metrics['lag']))
+    return metrics
+
+
+@celery_app.task(name="pebbles.tasks.purge_instance_logs")
+def purge_instance_logs():
+    """ Compacts and prunes the instance logs according to the retention
+    policy in INSTANCE_LOG_RETENTION.
+
+    The API handles one batch per request, the requests are repeated until
+    nothing is left or a batch makes no progress.
+    """
+    token = get_token()
+    while True:
+        resp = do_post_or_put(token, 'instances/log_retention', {})
+        if resp.status_code != 200:
+            raise RuntimeError('Instance log retention failed, %s' % resp.reason)
+        results = resp.json()
+        logger.info('instance log retention batch done: %s' % results)
+        num_affected = sum(value for key, value in results.items() if key != 'more')
+        if not results.get('more') or not num_affected:
+            break
 
 
 @celery_app.task(name="pebbles.tasks.send_mails")
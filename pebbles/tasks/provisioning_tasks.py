@@ -1,38 +1,73 @@
 import json
+import os
+import threading
 
 from pebbles.client import PBClient
+from pebbles.config import CONFIG_FILE
 from pebbles.tasks.celery_app import celery_app, get_token, do_get, do_post_or_put, logger
 from pebbles.tasks.celery_app import local_config, get_dynamic_config
 
 
+# the provisioning manager and its driver instances are kept for the lifetime of the worker process
+_provisioning_manager = {'manager': None, 'key': None}
+_provisioning_manager_lock = threading.Lock()
+
+
+def get_provisioning_manager_key(dynamic_config):
+    """ Returns what the provisioning manager has to be rebuilt on: the process, the plugin
+    whitelist and the modification times of the configuration and m2m credential files
+    (drivers cache the credentials).
+    """
+    def get_mtime(path):
+        if path and os.path.isfile(path):
+            return os.path.getmtime(path)
+
+    return (
+        os.getpid(),
+        dynamic_config.get('PLUGIN_WHITELIST'),
+        get_mtime(CONFIG_FILE),
+        get_mtime(dynamic_config.get('M2M_CREDENTIAL_STORE')),
+    )
+
+
 def get_provisioning_manager():
     """ Gets a stevedore provisioning manager which controls access to all the
     possible drivers.
 
-    Manager is used to call a method on one or more of the drivers.
+    Manager is used to call a method on one or more of the drivers. It is
+    cached per worker process, so that the drivers can keep their state and
+    connections between tasks, and rebuilt only when the plugin whitelist or
+    the configuration file changes.
     """
     from stevedore import dispatch
 
     dynamic_config = get_dynamic_config()
-    if dynamic_config.get('PLUGIN_WHITELIST'):
-        plugin_whitelist = dynamic_config.get('PLUGIN_WHITELIST').split()
-        mgr = dispatch.NameDispatchExtensionManager(
-            namespace='pebbles.drivers.provisioning',
-            check_func=lambda x: x.name in plugin_whitelist,
-            invoke_on_load=True,
-            invoke_args=(logger, dynamic_config),
-        )
-    else:
-        # ahem, load all plugins if string is empty or not available?
-        # is this wise? -jyrsa 2016-11-28
-        mgr = dispatch.NameDispatchExtensionManager(
-            namespace='pebbles.drivers.provisioning',
-            check_func=lambda x: True,
-            invoke_on_load=True,
-            invoke_args=(logger, dynamic_config),
-        )
-
-    logger.debug('provisioning manager loaded, extensions: %s ' % mgr.names())
+    key = get_provisioning_manager_key(dynamic_config)
+    with _provisioning_manager_lock:
+        if _provisioning_manager['manager'] and _provisioning_manager['key'] == key:
+            return _provisioning_manager['manager']
+
+        if dynamic_config.get('PLUGIN_WHITELIST'):
+            plugin_whitelist = dynamic_config.get('PLUGIN_WHITELIST').split()
+            mgr = dispatch.NameDispatchExtensionManager(
+                namespace='pebbles.drivers.provisioning',
+                check_func=lambda x: x.name in plugin_whitelist,
+                invoke_on_load=True,
+                invoke_args=(logger, dynamic_config),
+            )
+        else:
+            # ahem, load all plugins if string is empty or not available?
+            # is this wise? -jyrsa 2016-11-28
+            mgr = dispatch.NameDispatchExtensionManager(
+                namespace='pebbles.drivers.provisioning',
+                check_func=lambda x: True,
+                invoke_on_load=True,
+                invoke_args=(logger, dynamic_config),
+            )
+
+        logger.debug('provisioning manager loaded, extensions: %s ' % mgr.names())
+        _provisioning_manager['manager'] = mgr
+        _provisioning_manager['key'] = key
 
     return mgr
 
@@ -40,7 +75,7 @@ def get_provisioning_manager():
 def get_provisioning_type(token, instance_id):
     """ gets the name of the plugin (driver) that an instance uses.
     """
-    pbclient = PBClient(token, local_config['INTERNAL_API_BASE_URL'], ssl_verify=False)
+    pbclient = PBClient(token, local_config['INTERNAL_API_BASE_URL'], ssl_verify=False, token_refresher=get_token)
 
     blueprint = pbclient.get_instance_parent_data(instance_id)
     plugin_id = blueprint['plugin']
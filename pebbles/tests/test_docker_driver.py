@@ -1,3 +1,4 @@
+import copy
 import json
 import logging
 import docker.errors
@@ -38,9 +39,21 @@ def raise_on_failure_mode(func):
     return inner
 
 
+class MockImageFile(object):
+    def __init__(self, image_name):
+        self.image_name = image_name
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
 class MockResponse(object):
-    def __init__(self, status_code):
+    def __init__(self, status_code, reason=''):
         self.status_code = status_code
+        self.reason = reason
 
 
 class OpenStackServiceMock(object):
@@ -92,13 +105,32 @@ class DockerClientMock(object):
         self._containers = []
         self.spawn_count = 0
         self.failure_mode = False
+        self.num_listings = 0
+        self.delay = 0
+        self._images = {}
+        self.loaded_images = []
+        # images that are missing from the registry or have a corrupt image file
+        self.failing_images = set()
 
     @raise_on_failure_mode
-    def pull(self, image):
-        pass
+    def pull(self, image, stream=False):
+        # like docker-py 1.4, a failed pull does not raise but reports the error in the status stream
+        if image.split('/', 1)[1] in self.failing_images:
+            return iter([json.dumps({'error': 'image %s not found' % image}).encode('utf-8')])
+        self._images[image + ':latest'] = 'sha256:%s' % image
+        return iter([json.dumps({'status': 'Downloaded newer image for %s' % image}).encode('utf-8')])
+
+    def tag(self, image, repository, force=False):
+        self._images[repository + ':latest'] = self._images[image + ':latest']
+
+    def images(self):
+        return [dict(Id=image_id, RepoTags=[tag]) for tag, image_id in self._images.items()]
 
     @raise_on_failure_mode
     def containers(self):
+        self.num_listings += 1
+        if self.delay:
+            time.sleep(self.delay)
         return self._containers[:]
 
     def create_host_config(self, *args, **kwargs):
@@ -110,6 +142,7 @@ class DockerClientMock(object):
         container = dict(
             Id='%s' % self.spawn_count,
             Name=name,
+            Image=kwargs.get('image'),
             Labels=dict(slots='1')
         )
         self._containers.append(container)
@@ -135,13 +168,19 @@ class DockerClientMock(object):
     def port(self, *args):
         return [{'HostPort': 32768 + self.spawn_count % 32768}]
 
-    def load_image(self, *args):
-        pass
+    def load_image(self, img_file):
+        if img_file.image_name in self.failing_images:
+            raise docker.errors.APIError('corrupt image file', response=MockResponse(status_code=500), explanation='')
+        self.loaded_images.append(img_file.image_name)
+        self._images[img_file.image_name + ':latest'] = 'sha256:%s' % img_file.image_name
 
 
 class PBClientMock(object):
     def __init__(self):
         self.instance_data = {}
+        self.locks = set()
+        self.instance_demand = dict(queueing_slots=0, hourly_launch_slots=[0.0] * docker_driver.DD_HOURS_IN_WEEK)
+        self.num_demand_history_fetches = 0
         config = dict(
             memory_limit='512m',
             environment_vars=''
@@ -196,6 +235,13 @@ class PBClientMock(object):
     def get_blueprint_description(self, blueprint_id):
         return self.blueprint_data[blueprint_id]
 
+    def get_instance_demand(self, plugin, weeks=0):
+        demand = dict(queueing_slots=self.instance_demand['queueing_slots'], weeks=weeks, hourly_launch_slots=[])
+        if weeks:
+            self.num_demand_history_fetches += 1
+            demand['hourly_launch_slots'] = list(self.instance_demand['hourly_launch_slots'])
+        return demand
+
     def do_instance_patch(self, instance_id, payload):
         data = self.instance_data[instance_id]
         data.update(payload)
@@ -230,11 +276,29 @@ class PBClientMock(object):
             filtered_record[0]['value'] = payload['value']
             filtered_record[0]['updated_ts'] = time.time()
 
+    def modify_namespaced_keyvalue(self, namespace, key, payload, updated_version_ts):
+        filtered_record = self._filter_namespaced_records(namespace, key)[0]
+        if filtered_record['updated_ts'] != updated_version_ts:
+            return False
+        filtered_record['value'] = copy.deepcopy(payload['value'])
+        filtered_record['updated_ts'] += 1
+        return True
+
     def delete_namespaced_keyvalue(self, namespace, key):
         filtered_record = self._filter_namespaced_records(namespace, key)
         if filtered_record:
             self.namespaced_records.remove(filtered_record[0])
 
+    def obtain_lock(self, lock_id):
+        if lock_id in self.locks:
+            return None
+        self.locks.add(lock_id)
+        return lock_id
+
+    def release_lock(self, lock_id):
+        self.locks.remove(lock_id)
+        return lock_id
+
 
 # noinspection PyUnusedLocal
 class DockerDriverAccessMock(object):
@@ -266,12 +330,23 @@ class DockerDriverAccessMock(object):
             elif host.get('state') == DD_STATE_REMOVED:
                 self.pbc_mock.delete_namespaced_keyvalue(NAMESPACE, _key)
 
+    def load_record(self, token, url, host_id):
+        namespaced_records = self.pbc_mock.get_namespaced_keyvalues(
+            {'namespace': NAMESPACE, 'key': '%s_%s' % (KEY_PREFIX_POOL, host_id)})
+        if not namespaced_records:
+            return None, None
+        return copy.deepcopy(namespaced_records[0]['value']), namespaced_records[0]['updated_ts']
+
+    def update_record(self, token, url, host, version):
+        _key = '%s_%s' % (KEY_PREFIX_POOL, host['id'])
+        return self.pbc_mock.modify_namespaced_keyvalue(NAMESPACE, _key, {'value': host}, version)
+
     def load_driver_config(self, token, url):
         namespaced_record = self.pbc_mock.get_namespaced_keyvalue(NAMESPACE, KEY_CONFIG)
         driver_config = namespaced_record['value']
         return driver_config
 
-    def get_docker_client(self, docker_url):
+    def get_docker_client(self, docker_url, timeout=None):
         if docker_url not in self.dc_mocks.keys():
             self.dc_mocks[docker_url] = DockerClientMock()
 
@@ -305,7 +380,15 @@ class DockerDriverAccessMock(object):
 
     @staticmethod
     def get_image_names():
-        return ['test/test1']
+        return ['csc/test_image', 'test/test1', 'test/test2']
+
+    @staticmethod
+    def open_image_file(image_name):
+        return MockImageFile(image_name)
+
+    @staticmethod
+    def get_image_file_id(image_name):
+        return 'sha256:%s' % image_name
 
     @staticmethod
     def wait_for_port(ip_address, port, max_wait_secs=60):
@@ -317,6 +400,8 @@ class DockerDriverTestCase(BaseTestCase):
     def setUp(self):
         # set up a constants to known values for tests
         docker_driver.DD_HOST_LIFETIME = 900
+        docker_driver.host_snapshots.clear()
+        docker_driver.demand_curve.clear()
 
     @staticmethod
     def create_docker_driver():
@@ -330,6 +415,8 @@ class DockerDriverTestCase(BaseTestCase):
         )
         dd = docker_driver.DockerDriver(logger, config)
         dd._ap = DockerDriverAccessMock(config)
+        # the public entry points load the backend config before anything else
+        dd._set_driver_backend_config('foo')
 
         return dd
 
@@ -648,6 +735,353 @@ class DockerDriverTestCase(BaseTestCase):
         hosts_data = ddam.load_records()
         self.assertSetEqual({x['state'] for x in hosts_data}, {DD_STATE_ACTIVE})
 
+    @staticmethod
+    def create_active_hosts(ddam, num_hosts, cur_ts):
+        hosts = [dict(
+            id='host-%d' % i,
+            docker_url='https://192.168.1.%d:2376' % i,
+            private_ip='192.168.1.%d' % i,
+            spawn_ts=cur_ts + i,
+            state=DD_STATE_ACTIVE,
+            num_slots=4,
+            num_reserved_slots=0,
+            lifetime_left=docker_driver.DD_HOST_LIFETIME,
+            error_count=0,
+        ) for i in range(num_hosts)]
+        ddam.save_records(token='foo', url=None, hosts=hosts)
+        return hosts
+
+    def test_get_hosts_slow_host(self):
+        dd = self.create_docker_driver()
+        ddam = dd._get_ap()
+        cur_ts = 1000000
+        hosts = self.create_active_hosts(ddam, 3, cur_ts)
+        ddam.get_docker_client(hosts[0]['docker_url']).delay = 1.0
+
+        with mock.patch.object(docker_driver, 'DD_HOST_POLL_TIMEOUT', 0.1):
+            start = time.time()
+            hosts = dd._get_hosts(token='foo', cur_ts=cur_ts)
+            self.assertLess(time.time() - start, 1.0)
+
+        self.assertEqual([host['reachable'] for host in hosts], [False, True, True])
+        self.assertEqual(hosts[0]['error_count'], 1)
+        self.assertEqual(hosts[1]['error_count'], 0)
+        with mock.patch.object(dd, '_get_hosts', return_value=hosts):
+            selected_hosts = dd._select_hosts(1, token='foo', cur_ts=cur_ts)
+        self.assertEqual([host['id'] for host in selected_hosts], ['host-1', 'host-2'])
+
+    def test_get_hosts_circuit_breaker(self):
+        dd = self.create_docker_driver()
+        ddam = dd._get_ap()
+        cur_ts = 1000000
+        hosts = self.create_active_hosts(ddam, 1, cur_ts)
+        docker_client = ddam.get_docker_client(hosts[0]['docker_url'])
+        docker_client.create_container('pb-1000')
+        dd._get_hosts(token='foo', cur_ts=cur_ts)
+        self.assertEqual(docker_client.num_listings, 1)
+
+        # the host is not polled until the circuit is reset, the slots seen by this process
+        # are newer than the saved ones
+        hosts[0]['num_reserved_slots'] = 0
+        hosts[0]['poll_ts'] = cur_ts - 60
+        hosts[0]['error_count'] = docker_driver.DD_HOST_CIRCUIT_ERRORS
+        hosts[0]['error_ts'] = cur_ts + 10
+        hosts = dd._get_hosts(token='foo', cur_ts=cur_ts + 20)
+        self.assertEqual(docker_client.num_listings, 1)
+        self.assertFalse(hosts[0]['reachable'])
+        self.assertEqual(hosts[0]['num_reserved_slots'], 1)
+
+        hosts = dd._get_hosts(token='foo', cur_ts=cur_ts + 10 + docker_driver.DD_HOST_CIRCUIT_RESET)
+        self.assertEqual(docker_client.num_listings, 2)
+        self.assertTrue(hosts[0]['reachable'])
+        self.assertEqual(hosts[0]['error_count'], 0)
+
+    def test_get_hosts_occasional_errors(self):
+        dd = self.create_docker_driver()
+        ddam = dd._get_ap()
+        cur_ts = 1000000
+        hosts = self.create_active_hosts(ddam, 1, cur_ts)
+        docker_client = ddam.get_docker_client(hosts[0]['docker_url'])
+
+        # a host that is slow now and then never trips the circuit or gets inactivated
+        with mock.patch.object(docker_driver, 'DD_HOST_POLL_TIMEOUT', 0.05):
+            for i in range(docker_driver.DD_MAX_HOST_ERRORS + 1):
+                cur_ts += 60
+                docker_client.delay = 0.2
+                hosts = dd._get_hosts(token='foo', cur_ts=cur_ts)
+                self.assertEqual(hosts[0]['error_count'], 1)
+                dd._save_host_state(hosts, 'foo', cur_ts)
+                cur_ts += 60
+                docker_client.delay = 0
+                hosts = dd._get_hosts(token='foo', cur_ts=cur_ts)
+                self.assertTrue(hosts[0]['reachable'])
+                dd._save_host_state(hosts, 'foo', cur_ts)
+        self.assertEqual(hosts[0]['error_count'], 0)
+        self.assertFalse(dd._inactivate_old_hosts(hosts, cur_ts))
+
+    def test_provision_skips_locked_host(self):
+        dd = self.create_docker_driver()
+        ddam = dd._get_ap()
+        cur_ts = 1000000
+        self.create_active_hosts(ddam, 2, cur_ts)
+        ddam.pbc_mock.add_instance_data('1000')
+
+        # another worker is starting a container on the oldest host
+        ddam.pbc_mock.obtain_lock('dd_host:host-0')
+        with mock.patch('time.sleep') as sleep:
+            dd._do_provision(token='foo', instance_id='1000', cur_ts=cur_ts)
+        self.assertFalse(sleep.called)
+        instance_data = ddam.pbc_mock.get_instance_description('1000')['instance_data']
+        self.assertEqual(instance_data['docker_host_id'], 'host-1')
+        # the reservation is released once the container is running
+        record, version = ddam.load_record('foo', None, 'host-1')
+        self.assertEqual(record['reservations'], {})
+        self.assertEqual(ddam.pbc_mock.locks, {'dd_host:host-0'})
+
+    def test_placement_strategies(self):
+        hosts = [
+            # an old host about to expire, a young host in use and two unused ones
+            dict(id='old', spawn_ts=0, num_slots=8, num_reserved_slots=6, lifetime_left=600, lifetime_tick_ts=1),
+            dict(id='young', spawn_ts=1, num_slots=8, num_reserved_slots=2, lifetime_left=3000, lifetime_tick_ts=2),
+            dict(id='unused', spawn_ts=2, num_slots=8, num_reserved_slots=0, lifetime_left=3600),
+            dict(id='unused-small', spawn_ts=3, num_slots=4, num_reserved_slots=0, lifetime_left=3600),
+            dict(id='full', spawn_ts=4, num_slots=4, num_reserved_slots=4, lifetime_left=3600, lifetime_tick_ts=3),
+        ]
+
+        def candidates(strategy, slots=1):
+            return [host['id'] for host in docker_driver.DockerDriver.select_candidate_hosts(hosts, slots, strategy)]
+
+        self.assertEqual(candidates('oldest_first'), ['old', 'young', 'unused', 'unused-small'])
+        self.assertEqual(candidates('best_fit'), ['old', 'unused-small', 'young', 'unused'])
+        self.assertEqual(candidates('lifetime_packing'), ['young', 'old', 'unused-small', 'unused'])
+        self.assertEqual(candidates('spread'), ['unused', 'young', 'unused-small', 'old'])
+        self.assertEqual(candidates('best_fit', slots=7), ['unused'])
+
+        # hosts about to expire are used only when there is no room elsewhere
+        hosts[0]['lifetime_left'] = docker_driver.DD_HOST_LIFETIME_LOW
+        self.assertEqual(candidates('best_fit'), ['unused-small', 'young', 'unused'])
+        self.assertEqual(candidates('best_fit', slots=2), ['unused-small', 'young', 'unused'])
+        hosts[0]['num_reserved_slots'] = 0
+        hosts[2]['num_reserved_slots'] = 1
+        self.assertEqual(candidates('best_fit', slots=8), ['old'])
+
+    def test_select_hosts_with_strategy(self):
+        dd = self.create_docker_driver()
+        ddam = dd._get_ap()
+        cur_ts = 1000000
+        hosts = self.create_active_hosts(ddam, 3, cur_ts)
+        ddam.get_docker_client(hosts[1]['docker_url']).create_container('pb-1')
+
+        self.assertEqual([host['id'] for host in dd._select_hosts(1, token='foo', cur_ts=cur_ts)],
+                         ['host-0', 'host-1', 'host-2'])
+        dd.driver_config['DD_PLACEMENT_STRATEGY'] = 'best_fit'
+        self.assertEqual([host['id'] for host in dd._select_hosts(1, token='foo', cur_ts=cur_ts)],
+                         ['host-1', 'host-0', 'host-2'])
+        dd.driver_config['DD_PLACEMENT_STRATEGY'] = 'no_such_strategy'
+        self.assertEqual([host['id'] for host in dd._select_hosts(1, token='foo', cur_ts=cur_ts)],
+                         ['host-0', 'host-1', 'host-2'])
+
+    def test_placement_strategies_in_schema(self):
+        from pebbles.drivers.provisioning.docker_driver_config import BACKEND_CONFIG
+        schema = BACKEND_CONFIG['schema']['properties']['DD_PLACEMENT_STRATEGY']
+        self.assertEqual(schema['enum'], sorted(docker_driver.PLACEMENT_STRATEGIES.keys()))
+        self.assertIn(BACKEND_CONFIG['model']['DD_PLACEMENT_STRATEGY'], schema['enum'])
+
+    def test_reserve_slots(self):
+        dd = self.create_docker_driver()
+        ddam = dd._get_ap()
+        cur_ts = 1000000
+        host = self.create_active_hosts(ddam, 1, cur_ts)[0]
+        ddam.get_docker_client(host['docker_url']).create_container('pb-1000')
+
+        # a concurrent provisioning has reserved two of the slots, an expired reservation does not count
+        record, version = ddam.load_record('foo', None, host['id'])
+        record['reservations'] = {
+            '1001': {'slots': 2, 'ts': cur_ts},
+            '1002': {'slots': 2, 'ts': cur_ts - docker_driver.DD_SLOT_RESERVATION_TTL},
+        }
+        self.assertTrue(ddam.update_record('foo', None, record, version))
+
+        self.assertTrue(dd._reserve_slots('foo', host, '1003', 1, cur_ts))
+        self.assertFalse(dd._reserve_slots('foo', host, '1004', 1, cur_ts))
+        record, version = ddam.load_record('foo', None, host['id'])
+        self.assertEqual(set(record['reservations'].keys()), {'1001', '1003'})
+
+        # housekeeping counts the reservations and keeps the ones made after it loaded the hosts
+        hosts = dd._get_hosts('foo', cur_ts)
+        self.assertEqual(hosts[0]['num_reserved_slots'], 4)
+        dd._release_slots('foo', host['id'], '1001')
+        dd._save_host_state(hosts, 'foo', cur_ts)
+        record, version = ddam.load_record('foo', None, host['id'])
+        self.assertEqual(set(record['reservations'].keys()), {'1003'})
+
+    def test_load_images(self):
+        dd = self.create_docker_driver()
+        ddam = dd._get_ap()
+        dd._set_driver_backend_config('foo')
+        host = self.create_active_hosts(ddam, 1, 1000000)[0]
+        docker_client = ddam.get_docker_client(host['docker_url'])
+
+        # an up to date image is not loaded again, an outdated one is
+        docker_client._images['test/test1:latest'] = 'sha256:test/test1'
+        docker_client._images['test/test2:latest'] = 'sha256:outdated'
+        dd._load_images(host, ['csc/test_image', 'test/test1', 'test/test2'], 1000000)
+        self.assertEqual(sorted(docker_client.loaded_images), ['csc/test_image', 'test/test2'])
+        self.assertEqual(host['images'], {
+            'csc/test_image': 'sha256:csc/test_image',
+            'test/test1': 'sha256:test/test1',
+            'test/test2': 'sha256:test/test2',
+        })
+
+        # with a registry the images are pulled
+        dd.driver_config['DD_IMAGE_REGISTRY'] = 'registry.local:5000'
+        host = self.create_active_hosts(ddam, 2, 1000000)[1]
+        dd._load_images(host, ['test/test1'], 1000000)
+        self.assertEqual(host['images'], {'test/test1': 'sha256:registry.local:5000/test/test1'})
+        self.assertEqual(ddam.get_docker_client(host['docker_url']).loaded_images, [])
+
+    def test_load_failing_images(self):
+        dd = self.create_docker_driver()
+        ddam = dd._get_ap()
+        dd._set_driver_backend_config('foo')
+        cur_ts = 1000000
+        hosts = self.create_active_hosts(ddam, 2, cur_ts)
+        for host in hosts:
+            host['images'] = {}
+            ddam.get_docker_client(host['docker_url']).failing_images.add('test/test1')
+
+        # the other images are loaded to all the hosts, the host errors are not counted
+        self.assertTrue(dd._load_remaining_images(hosts, cur_ts))
+        for host in hosts:
+            self.assertEqual(set(host['images'].keys()), {'csc/test_image', 'test/test2'})
+            self.assertEqual(host['image_failures']['test/test1']['count'], 1)
+            self.assertEqual(host['error_count'], 0)
+
+        # the failing image is retried with a growing delay
+        self.assertFalse(dd._load_remaining_images(hosts, cur_ts + 60))
+        cur_ts += docker_driver.DD_IMAGE_RETRY_DELAY
+        self.assertTrue(dd._load_remaining_images(hosts, cur_ts))
+        self.assertEqual(hosts[0]['image_failures']['test/test1'], {
+            'count': 2, 'retry_ts': cur_ts + 2 * docker_driver.DD_IMAGE_RETRY_DELAY})
+
+        # with a registry the failure is read from the status of the pull
+        dd.driver_config['DD_IMAGE_REGISTRY'] = 'registry.local:5000'
+        cur_ts += 2 * docker_driver.DD_IMAGE_RETRY_DELAY
+        self.assertEqual(dd._load_images(hosts[0], ['test/test1', 'test/test2'], cur_ts), ['test/test1'])
+        self.assertEqual(hosts[0]['image_failures']['test/test1']['count'], 3)
+        self.assertFalse(dd.has_image(hosts[0], 'test/test1'))
+
+        # once the image can be loaded, the failures are forgotten
+        ddam.get_docker_client(hosts[0]['docker_url']).failing_images.clear()
+        cur_ts += docker_driver.DD_IMAGE_RETRY_MAX_DELAY
+        self.assertEqual(dd._load_images(hosts[0], ['test/test1'], cur_ts), [])
+        self.assertEqual(hosts[0]['image_failures'], {})
+        self.assertTrue(dd.has_image(hosts[0], 'test/test1'))
+
+    @mock_open_context
+    def test_activate_with_popular_images(self):
+        dd = self.create_docker_driver()
+        ddam = dd._get_ap()
+        ddam.load_driver_config('foo', None)['DD_HOST_PRIORITY_IMAGES'] = 1
+        cur_ts = 1000000
+        hosts = self.create_active_hosts(ddam, 1, cur_ts)
+        ddam.get_docker_client(hosts[0]['docker_url']).create_container('pb-1', image='test/test2')
+
+        # spawn a second host and activate it with the most used image only
+        for i in range(2):
+            cur_ts += 60
+            dd._do_housekeep(token='foo', cur_ts=cur_ts)
+        hosts_data = dict((host['id'], host) for host in ddam.load_records())
+        self.assertEqual(len(hosts_data), 2)
+        new_host = [host for host in hosts_data.values() if host['id'] != 'host-0'][0]
+        self.assertEqual(new_host['state'], DD_STATE_ACTIVE)
+        self.assertEqual(list(new_host['images'].keys()), ['test/test2'])
+        self.assertFalse(dd.has_image(new_host, 'csc/test_image'))
+
+        # the rest are loaded when there is nothing else to do
+        cur_ts += 60
+        dd._do_housekeep(token='foo', cur_ts=cur_ts)
+        hosts_data = dict((host['id'], host) for host in ddam.load_records())
+        self.assertEqual(set(hosts_data[new_host['id']]['images'].keys()), {'csc/test_image', 'test/test1', 'test/test2'})
+
+    @mock_open_context
+    def test_spawn_for_queueing_instances(self):
+        dd = self.create_docker_driver()
+        ddam = dd._get_ap()
+        ddam.pbc_mock.instance_demand['queueing_slots'] = 20
+
+        # the queue and the free slot target need two large hosts, spawned at once
+        cur_ts = 1000000
+        dd._do_housekeep(token='foo', cur_ts=cur_ts)
+        hosts_data = ddam.load_records()
+        self.assertEqual(len(hosts_data), 2)
+        self.assertEqual([host['num_slots'] for host in hosts_data], [16, 16])
+
+        # and activated at once
+        cur_ts += 60
+        dd._do_housekeep(token='foo', cur_ts=cur_ts)
+        self.assertEqual([host['state'] for host in ddam.load_records()], [DD_STATE_ACTIVE, DD_STATE_ACTIVE])
+
+    @mock_open_context
+    def test_spawn_for_expected_launches(self):
+        dd = self.create_docker_driver()
+        ddam = dd._get_ap()
+        driver_config = ddam.load_driver_config('foo', None)
+        driver_config['DD_DEMAND_HISTORY_WEEKS'] = 4
+        driver_config['DD_MAX_SPAWN_PER_HOUSEKEEP'] = 2
+        cur_ts = 1000000
+        cur_time = time.gmtime(cur_ts)
+        ddam.pbc_mock.instance_demand['hourly_launch_slots'][cur_time.tm_wday * 24 + cur_time.tm_hour] = 40.0
+
+        # 40 slots are expected to be launched within the hour, two hosts at most are spawned at a time
+        dd._do_housekeep(token='foo', cur_ts=cur_ts)
+        self.assertEqual(len(ddam.load_records()), 2)
+        for i in range(2):
+            cur_ts += 60
+            dd._do_housekeep(token='foo', cur_ts=cur_ts)
+        self.assertEqual(len(ddam.load_records()), 3)
+
+        # the launch history is fetched once per DD_DEMAND_CURVE_TTL
+        self.assertEqual(ddam.pbc_mock.num_demand_history_fetches, 1)
+        cur_ts += docker_driver.DD_DEMAND_CURVE_TTL + 1
+        dd._get_free_slot_demand('foo', ddam.load_records(), cur_ts)
+        self.assertEqual(ddam.pbc_mock.num_demand_history_fetches, 2)
+
+    @mock_open_context
+    def test_spawn_for_scheduled_session(self):
+        dd = self.create_docker_driver()
+        ddam = dd._get_ap()
+        driver_config = ddam.load_driver_config('foo', None)
+        cur_ts = 1000000
+        driver_config['DD_SESSION_CALENDAR'] = json.dumps([dict(
+            start=time.strftime(docker_driver.DD_SESSION_TIME_FORMAT, time.gmtime(cur_ts + 3600)),
+            end=time.strftime(docker_driver.DD_SESSION_TIME_FORMAT, time.gmtime(cur_ts + 3 * 3600)),
+            slots=30,
+        )])
+        dd._set_driver_backend_config('foo')
+
+        # an hour before the session only the free slot target is kept
+        self.assertEqual(dd._get_free_slot_demand('foo', [], cur_ts), 4)
+
+        # the session is pre-warmed 30 minutes before it starts
+        cur_ts += 1800
+        self.assertEqual(dd._get_free_slot_demand('foo', [], cur_ts), 30)
+        dd._do_housekeep(token='foo', cur_ts=cur_ts)
+        self.assertEqual(len(ddam.load_records()), 2)
+
+        # the slots already allocated to the session are not needed again
+        hosts = self.create_active_hosts(ddam, 1, cur_ts)
+        hosts[0]['num_reserved_slots'] = 4
+        self.assertEqual(dd._get_free_slot_demand('foo', hosts, cur_ts), 26)
+
+        # after the session the calendar no longer matters
+        self.assertEqual(dd._get_free_slot_demand('foo', [], cur_ts + 3 * 3600), 4)
+
+        # a broken calendar is ignored
+        driver_config['DD_SESSION_CALENDAR'] = '[{"start": "tomorrow"}]'
+        dd._set_driver_backend_config('foo')
+        self.assertEqual(dd._get_free_slot_demand('foo', [], cur_ts), 4)
+
     @mock_open_context
     def test_docker_comm_probs(self):
         dd = self.create_docker_driver()
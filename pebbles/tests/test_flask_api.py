@@ -5,11 +5,15 @@ import json
 import uuid
 import time
 
+import mock
+from sqlalchemy import event
+
 from pebbles.tests.base import db, BaseTestCase
 from pebbles.models import (
     User, Group, GroupUserAssociation, BlueprintTemplate, Blueprint,
-    ActivationToken, Instance, NamespacedKeyValue)
+    ActivationToken, Instance, InstanceLog, NamespacedKeyValue)
 from pebbles.views import activations
+from pebbles.views.commons import AuthTokenCache
 
 from pebbles.tests.fixtures import primary_test_setup
 
@@ -291,6 +295,21 @@ class FlaskApiTestCase(BaseTestCase):
         user = User.query.filter_by(id=u.id).first()
         self.assertFalse(user.is_blocked)
 
+    def count_request_statements(self, make_request, path):
+        """Return the number of SQL statements a request runs and the response"""
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            response = make_request(path=path)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assert_200(response)
+        return len(statements), response
+
     def test_get_users(self):
         # Anonymous
         response = self.make_request(path='/api/v1/users')
@@ -303,6 +322,89 @@ class FlaskApiTestCase(BaseTestCase):
         response = self.make_authenticated_admin_request(path='/api/v1/users')
         self.assert_200(response)
 
+    def test_get_users_paginated(self):
+        for i in range(5):
+            db.session.add(User("user-%d@example.org" % i, "user", is_admin=False))
+        db.session.commit()
+        response = self.make_authenticated_admin_request(path='/api/v1/users')
+        self.assert_200(response)
+        expected_ids = [u['id'] for u in response.json]
+        self.assertTrue(response.json[0]['is_admin'])
+
+        user_ids = []
+        path = '/api/v1/users?limit=2'
+        while path:
+            response = self.make_authenticated_admin_request(path=path)
+            self.assert_200(response)
+            user_ids.extend(u['id'] for u in response.json)
+            next_cursor = response.headers.get('X-Next-Cursor')
+            path = '/api/v1/users?limit=2&cursor=%s' % next_cursor if next_cursor else None
+        self.assertEqual(user_ids, expected_ids)
+
+    def test_auth_token_cache(self):
+        response = self.make_authenticated_user_request(path='/api/v1/users')
+        self.assert_200(response)
+        # the verified token is served from the cache
+        with mock.patch.object(User, 'verify_auth_token') as verify_auth_token:
+            response = self.make_authenticated_user_request(path='/api/v1/users')
+            self.assert_200(response)
+            self.assertEqual(response.json[0]['email'], self.known_user_email)
+            self.assertFalse(verify_auth_token.called)
+
+        # demoting and blocking drops the cached tokens of the user
+        response = self.make_authenticated_admin_request(path='/api/v1/quota')
+        self.assert_200(response)
+        admin = User.query.filter_by(id=self.known_admin_id).first()
+        admin.is_admin = False
+        db.session.commit()
+        response = self.make_authenticated_admin_request(path='/api/v1/quota')
+        self.assert_403(response)
+
+        user = User.query.filter_by(id=self.known_user_id).first()
+        user.is_blocked = True
+        db.session.commit()
+        response = self.make_authenticated_user_request(path='/api/v1/users')
+        self.assert_401(response)
+
+    def test_auth_token_cache_expiry(self):
+        cache = AuthTokenCache(max_size=2)
+        user = User.query.filter_by(id=self.known_user_id).first()
+        cache.put('token-1', user, ttl=30, now=1000)
+        self.assertEqual(cache.get('token-1', now=1029)['id'], self.known_user_id)
+        self.assertIsNone(cache.get('token-1', now=1031))
+        self.assertEqual(len(cache), 0)
+
+        for i in range(3):
+            cache.put('token-%d' % i, user, ttl=30, now=1000)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('token-0', now=1000))
+        cache.invalidate(self.known_user_id)
+        self.assertEqual(len(cache), 0)
+
+    def test_get_users_filtered(self):
+        for i in range(3):
+            db.session.add(User("filtered-%d@example.org" % i, "user", is_admin=False))
+        db.session.commit()
+        response = self.make_authenticated_admin_request(path='/api/v1/users?filter=FILTERED&limit=2')
+        self.assert_200(response)
+        self.assertEqual(len(response.json), 2)
+        emails = [u['email'] for u in response.json]
+        response = self.make_authenticated_admin_request(
+            path='/api/v1/users?filter=FILTERED&limit=2&cursor=%s' % response.headers['X-Next-Cursor'])
+        self.assert_200(response)
+        self.assertNotIn('X-Next-Cursor', response.headers)
+        emails.extend(u['email'] for u in response.json)
+        self.assertEqual(sorted(emails), ['filtered-%d@example.org' % i for i in range(3)])
+
+        # wildcards match only themselves
+        db.session.add(User("under_score@example.org", "user", is_admin=False))
+        db.session.add(User("underxscore@example.org", "user", is_admin=False))
+        db.session.commit()
+        response = self.make_authenticated_admin_request(path='/api/v1/users?filter=r_s')
+        self.assertEqual([u['email'] for u in response.json], ['under_score@example.org'])
+        response = self.make_authenticated_admin_request(path='/api/v1/users?filter=%25')
+        self.assertEqual(response.json, [])
+
     def test_get_groups(self):
         # Anonymous
         response = self.make_request(path='/api/v1/groups')
@@ -322,6 +424,35 @@ class FlaskApiTestCase(BaseTestCase):
         response = self.make_authenticated_admin_request(path='/api/v1/groups/%s' % self.known_group_id)
         self.assert_200(response)
 
+    def test_get_groups_batched(self):
+        def count_statements(path):
+            return self.count_request_statements(self.make_authenticated_admin_request, path)
+
+        # warm up the token cache
+        self.make_authenticated_admin_request(path='/api/v1/groups')
+        num_statements, _ = count_statements('/api/v1/groups')
+        group_owner = User.query.filter_by(id=self.known_group_owner_id).first()
+        for i in range(5):
+            group = Group('Course%d' % i)
+            group.users.append(GroupUserAssociation(user=group_owner, group=group, manager=True, owner=True))
+            group.banned_users.append(User.query.filter_by(id=self.known_user_id).first())
+            db.session.add(group)
+        db.session.commit()
+        num_statements_more_groups, response = count_statements('/api/v1/groups')
+        self.assertEqual(num_statements_more_groups, num_statements)
+        self.assertEqual(len(response.json), 10)
+        course_group = [group for group in response.json if group['name'] == 'Course0'][0]
+        self.assertEqual(course_group['owner_email'], 'group_owner@example.org')
+        self.assertEqual(course_group['user_config']['banned_users'], [{'id': self.known_user_id}])
+
+        # names only, skipping the user configs
+        num_statements_projection, response = count_statements('/api/v1/groups?fields=id,name')
+        self.assertLess(num_statements_projection, num_statements)
+        self.assertEqual(set(response.json[0].keys()), set(['id', 'name']))
+
+        response = self.make_authenticated_admin_request(path='/api/v1/groups?fields=id,password')
+        self.assertStatus(response, 422)
+
     def test_create_group(self):
 
         data = {
@@ -951,6 +1082,53 @@ class FlaskApiTestCase(BaseTestCase):
         self.assert_200(response)
         self.assertEqual(len(response.json), 5)
 
+    def test_get_blueprints_batched(self):
+        def count_statements():
+            return self.count_request_statements(self.make_authenticated_group_owner_request, '/api/v1/blueprints')
+
+        # warm up the token cache
+        self.make_authenticated_group_owner_request(path='/api/v1/blueprints')
+        num_statements, response = count_statements()
+        self.assertEqual(len(response.json), 4)
+        for i in range(5):
+            blueprint = Blueprint()
+            blueprint.name = 'MoreBlueprints%d' % i
+            blueprint.template_id = self.known_template_id
+            blueprint.group_id = self.known_group_id
+            blueprint.is_enabled = True
+            blueprint.config = {'maximum_lifetime': '1h'}
+            db.session.add(blueprint)
+        db.session.commit()
+
+        num_statements_more_blueprints, response = count_statements()
+        self.assertEqual(num_statements_more_blueprints, num_statements)
+        self.assertEqual(len(response.json), 9)
+        blueprint_json = [bp for bp in response.json if bp['name'] == 'MoreBlueprints0'][0]
+        self.assertTrue(blueprint_json['manager'])
+        self.assertEqual(blueprint_json['config'], {'name': 'MoreBlueprints0', 'maximum_lifetime': '1h'})
+        # the name is only added to the response
+        blueprint = Blueprint.query.filter_by(name='MoreBlueprints0').first()
+        self.assertEqual(blueprint.config, {'maximum_lifetime': '1h'})
+
+    def test_get_blueprints_not_modified(self):
+        response = self.make_authenticated_user_request(path='/api/v1/blueprints')
+        self.assert_200(response)
+        etag = response.headers['ETag']
+        response = self.make_authenticated_user_request(path='/api/v1/blueprints', headers={'If-None-Match': etag})
+        self.assertStatus(response, 304)
+        self.assertEqual(response.data, b'')
+        # the same ETag from someone else does not match
+        response = self.make_authenticated_admin_request(path='/api/v1/blueprints', headers={'If-None-Match': etag})
+        self.assert_200(response)
+
+        # changes to the association tables count
+        group = Group.query.filter_by(id=self.known_group_id).first()
+        group.banned_users.append(User.query.filter_by(id=self.known_user_id).first())
+        db.session.commit()
+        response = self.make_authenticated_user_request(path='/api/v1/blueprints', headers={'If-None-Match': etag})
+        self.assert_200(response)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
     def test_get_blueprint(self):
         # Existing blueprint
         # Anonymous
@@ -1386,6 +1564,33 @@ class FlaskApiTestCase(BaseTestCase):
             data=json.dumps(data))
         self.assert_200(response)
 
+    def test_user_create_instance_name_collision(self):
+        instance = Instance.query.filter_by(id=self.known_instance_id).first()
+        instance.name = 'pb-taken-name'
+        db.session.commit()
+        data = {'blueprint': self.known_blueprint_id}
+
+        # only the generated candidates are checked, the taken one is skipped
+        candidates = ['pb-taken-name'] * 10 + ['pb-free-name-1'] * 10
+        with mock.patch.object(Instance, 'generate_name', side_effect=candidates):
+            response = self.make_authenticated_user_request(
+                method='POST',
+                path='/api/v1/instances',
+                data=json.dumps(data))
+        self.assert_200(response)
+        self.assertEqual(response.json['name'], 'pb-free-name-1')
+
+        # a name taken by a concurrent launch between the check and the insert
+        with mock.patch('pebbles.views.instances.choose_instance_name',
+                        side_effect=['pb-taken-name', 'pb-free-name-2']):
+            response = self.make_authenticated_user_request(
+                method='POST',
+                path='/api/v1/instances',
+                data=json.dumps(data))
+        self.assert_200(response)
+        self.assertEqual(response.json['name'], 'pb-free-name-2')
+        self.assertEqual(Instance.query.filter_by(name='pb-taken-name').count(), 1)
+
     def test_user_create_instance_blueprint_disabled(self):
         response = self.make_authenticated_user_request(
             method='POST',
@@ -1451,6 +1656,166 @@ class FlaskApiTestCase(BaseTestCase):
         self.assert_200(response)
         self.assertEqual(len(response.json), 1)
 
+    def test_get_instances_paginated(self):
+        # the oldest two were created at the same time, the id breaks the tie
+        created_at = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        for instance_id in (self.known_instance_id, self.known_instance_id_2):
+            Instance.query.filter_by(id=instance_id).first().created_at = created_at
+        db.session.commit()
+        expected_ids = [i['id'] for i in self.make_authenticated_admin_request(path='/api/v1/instances').json]
+
+        for limit in (1, 3):
+            instance_ids = []
+            path = '/api/v1/instances?limit=%d' % limit
+            while True:
+                response = self.make_authenticated_admin_request(path=path)
+                self.assert_200(response)
+                self.assertLessEqual(len(response.json), limit)
+                instance_ids.extend(i['id'] for i in response.json)
+                next_cursor = response.headers.get('X-Next-Cursor')
+                if not next_cursor:
+                    break
+                path = '/api/v1/instances?limit=%d&cursor=%s' % (limit, next_cursor)
+            self.assertEqual(instance_ids, expected_ids)
+        # oldest first
+        self.assertEqual(expected_ids[:2], sorted([self.known_instance_id, self.known_instance_id_2]))
+
+        # group manager sees a disjunction of own and managed instances
+        response = self.make_authenticated_group_owner_request(path='/api/v1/instances?limit=2')
+        self.assert_200(response)
+        self.assertEqual(len(response.json), 2)
+        response = self.make_authenticated_group_owner_request(
+            path='/api/v1/instances?limit=2&cursor=%s' % response.headers['X-Next-Cursor'])
+        self.assert_200(response)
+        self.assertEqual(len(response.json), 1)
+        self.assertNotIn('X-Next-Cursor', response.headers)
+
+        response = self.make_authenticated_admin_request(path='/api/v1/instances?cursor=invalid')
+        self.assertStatus(response, 422)
+
+    def test_get_instances_not_modified(self):
+        response = self.make_authenticated_admin_request(path='/api/v1/instances')
+        self.assert_200(response)
+        etag = response.headers['ETag']
+        # the lifetimes drift until the ETag changes, so it is weak
+        self.assertTrue(etag.startswith('W/'))
+        response = self.make_authenticated_admin_request(path='/api/v1/instances', headers={'If-None-Match': etag})
+        self.assertStatus(response, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        response = self.make_authenticated_admin_request(path='/api/v1/instances?show_deleted=true',
+                                                         headers={'If-None-Match': etag})
+        self.assert_200(response)
+
+        instance = Instance.query.filter_by(id=self.known_instance_id).first()
+        instance.state = Instance.STATE_RUNNING
+        db.session.commit()
+        response = self.make_authenticated_admin_request(path='/api/v1/instances', headers={'If-None-Match': etag})
+        self.assert_200(response)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        etag = response.headers['ETag']
+
+        # bulk updates count as well
+        Instance.query.filter_by(id=self.known_instance_id).update({'public_ip': '10.0.0.1'})
+        db.session.commit()
+        response = self.make_authenticated_admin_request(path='/api/v1/instances', headers={'If-None-Match': etag})
+        self.assert_200(response)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_get_instances_not_modified_by_others(self):
+        path = '/api/v1/instances'
+        etag = self.make_authenticated_user_request(path=path).headers['ETag']
+        path_without_logs = '/api/v1/instances?include_logs=false'
+        etag_without_logs = self.make_authenticated_user_request(path=path_without_logs).headers['ETag']
+
+        # the instances of other users do not change the listing of a user
+        others_instance = Instance.query.filter(Instance.user_id != self.known_user_id).first()
+        others_instance.state = Instance.STATE_RUNNING
+        db.session.commit()
+        response = self.make_authenticated_user_request(path=path, headers={'If-None-Match': etag})
+        self.assertStatus(response, 304)
+
+        # new logs change the listing only when the logs are included
+        instance_log = InstanceLog(self.known_instance_id)
+        instance_log.log_type = 'provisioning'
+        instance_log.log_level = 'INFO'
+        instance_log.timestamp = time.time()
+        instance_log.message = 'provisioning'
+        db.session.add(instance_log)
+        db.session.commit()
+        response = self.make_authenticated_user_request(path=path, headers={'If-None-Match': etag})
+        self.assert_200(response)
+        response = self.make_authenticated_user_request(path=path_without_logs,
+                                                        headers={'If-None-Match': etag_without_logs})
+        self.assertStatus(response, 304)
+
+    def test_get_due_instances(self):
+        response = self.make_authenticated_user_request(path='/api/v1/instances/due_work')
+        self.assert_403(response)
+
+        # all the fixture instances are still queueing
+        response = self.make_authenticated_admin_request(path='/api/v1/instances/due_work')
+        self.assert_200(response)
+        self.assertEqual(len(response.json), 4)
+
+        fresh = Instance.query.filter_by(id=self.known_instance_id).first()
+        fresh.state = Instance.STATE_RUNNING
+        fresh.provisioned_at = datetime.datetime.utcnow()
+        expired = Instance.query.filter_by(id=self.known_instance_id_2).first()
+        expired.state = Instance.STATE_RUNNING
+        expired.provisioned_at = datetime.datetime.utcnow() - datetime.timedelta(days=30)
+        db.session.commit()
+
+        response = self.make_authenticated_admin_request(path='/api/v1/instances/due_work')
+        self.assert_200(response)
+        due = dict((instance['id'], instance) for instance in response.json)
+        self.assertEqual(len(due), 3)
+        self.assertNotIn(self.known_instance_id, due)
+        self.assertEqual(due[self.known_instance_id_2]['state'], Instance.STATE_RUNNING)
+        self.assertEqual(due[self.known_instance_id_2]['lifetime_left'], 0)
+        self.assertGreater(due[self.known_instance_id_2]['maximum_lifetime'], 0)
+
+        # instances marked for deletion are reported as deleting
+        fresh.to_be_deleted = True
+        db.session.commit()
+        response = self.make_authenticated_admin_request(path='/api/v1/instances/due_work')
+        due = dict((instance['id'], instance) for instance in response.json)
+        self.assertEqual(due[self.known_instance_id]['state'], Instance.STATE_DELETING)
+
+    def test_get_instance_demand(self):
+        response = self.make_authenticated_user_request(path='/api/v1/instances/demand')
+        self.assert_403(response)
+
+        # all the fixture instances but one deleted are queueing
+        response = self.make_authenticated_admin_request(path='/api/v1/instances/demand?plugin=TestPlugin')
+        self.assert_200(response)
+        self.assertEqual(response.json['queueing_slots'], 4)
+        self.assertEqual(sum(response.json['hourly_launch_slots']), 0)
+        response = self.make_authenticated_admin_request(path='/api/v1/instances/demand?plugin=OtherPlugin')
+        self.assertEqual(response.json['queueing_slots'], 0)
+
+        # the launches of the past weeks are averaged by hour of the week
+        blueprint = Blueprint.query.filter_by(id=self.known_blueprint_id).first()
+        user = User.query.filter_by(id=self.known_user_id).first()
+        launch_time = datetime.datetime.utcnow() - datetime.timedelta(days=3)
+        for weeks_ago in range(3):
+            instance = Instance(blueprint, user)
+            instance.state = Instance.STATE_DELETED
+            instance.provisioned_at = launch_time - datetime.timedelta(weeks=weeks_ago)
+            db.session.add(instance)
+        db.session.commit()
+        response = self.make_authenticated_admin_request(
+            path='/api/v1/instances/demand?plugin=TestPlugin&weeks=2')
+        self.assert_200(response)
+        hourly_launch_slots = response.json['hourly_launch_slots']
+        self.assertEqual(len(hourly_launch_slots), 7 * 24)
+        self.assertEqual(hourly_launch_slots[launch_time.weekday() * 24 + launch_time.hour], 1.0)
+        self.assertEqual(sum(hourly_launch_slots), 1.0)
+
+        # the history is left out with weeks=0
+        response = self.make_authenticated_admin_request(path='/api/v1/instances/demand?weeks=0')
+        self.assertEqual(response.json['hourly_launch_slots'], [])
+        self.assertEqual(response.json['queueing_slots'], 4)
+
     def test_get_instance(self):
         # Anonymous
         response = self.make_request(path='/api/v1/instances/%s' % self.known_instance_id)
@@ -1564,6 +1929,162 @@ class FlaskApiTestCase(BaseTestCase):
         self.assert_200(response_instance_get)
         self.assertEquals(response_instance_get.json['logs'][0]['timestamp'], epoch_time)
 
+    def test_instance_logs_bulk(self):
+        epoch_time = time.time()
+        log_records = [
+            {'log_level': 'INFO', 'log_type': 'provisioning', 'timestamp': epoch_time + i, 'message': 'line %d' % i}
+            for i in range(5)
+        ]
+        log_records.append({'log_level': 'INFO', 'log_type': 'running', 'timestamp': epoch_time, 'message': 'first'})
+        log_records.append({'log_level': 'INFO', 'log_type': 'running', 'timestamp': epoch_time + 1, 'message': 'second'})
+        response_patch = self.make_authenticated_admin_request(
+            method='PATCH',
+            path='/api/v1/instances/%s/logs' % self.known_instance_id,
+            data=json.dumps({'log_records': log_records})
+        )
+        self.assert_200(response_patch)
+
+        provisioning_logs = InstanceLog.query.filter_by(instance_id=self.known_instance_id, log_type='provisioning').all()
+        self.assertEqual(len(provisioning_logs), 5)
+        # the running log is kept up to date in a single row
+        running_logs = InstanceLog.query.filter_by(instance_id=self.known_instance_id, log_type='running').all()
+        self.assertEqual(len(running_logs), 1)
+        self.assertEqual(running_logs[0].message, 'second')
+
+        response_patch = self.make_authenticated_admin_request(
+            method='PATCH',
+            path='/api/v1/instances/%s/logs' % self.known_instance_id,
+            data=json.dumps({'log_records': [
+                {'log_level': 'INFO', 'log_type': 'running', 'timestamp': epoch_time + 2, 'message': 'third'}
+            ]})
+        )
+        self.assert_200(response_patch)
+        running_logs = InstanceLog.query.filter_by(instance_id=self.known_instance_id, log_type='running').all()
+        self.assertEqual(len(running_logs), 1)
+        self.assertEqual(running_logs[0].message, 'third')
+
+    def test_instance_log_retention(self):
+        from pebbles.log_retention import LOG_TYPE_COMPACTED, expand_compacted_log
+        now = time.time()
+        blueprint = Blueprint.query.filter_by(id=self.known_blueprint_id).first()
+        user = User.query.filter_by(id=self.known_user_id).first()
+        deleted_instance = Instance(blueprint, user)
+        deleted_instance.state = Instance.STATE_DELETED
+        db.session.add(deleted_instance)
+        db.session.commit()
+
+        def add_log(instance_id, log_type, timestamp, message):
+            instance_log = InstanceLog(instance_id)
+            instance_log.log_type = log_type
+            instance_log.log_level = 'INFO'
+            instance_log.timestamp = timestamp
+            instance_log.message = message
+            db.session.add(instance_log)
+
+        for i in range(3):
+            add_log(deleted_instance.id, 'provisioning', now - 40 * 86400 + i, 'old line %d' % i)
+        for i in range(5):
+            add_log(self.known_instance_id, 'provisioning', now - 10 + i, 'line %d' % i)
+        add_log(self.known_instance_id, 'running', now - 100 * 86400, 'stale')
+        db.session.commit()
+
+        response = self.make_authenticated_user_request(method='POST', path='/api/v1/instances/log_retention')
+        self.assert_403(response)
+
+        from pebbles.log_retention import apply_instance_log_retention
+        results = apply_instance_log_retention(
+            {'provisioning': {'max_rows': 2}, 'running': {'max_age_days': 30}},
+            compaction_age_days=30
+        )
+        self.assertEqual(results, {'compacted': 3, 'provisioning': 3, 'running': 1, 'more': False})
+
+        compacted = InstanceLog.query.filter_by(instance_id=deleted_instance.id).all()
+        self.assertEqual(len(compacted), 1)
+        self.assertEqual(compacted[0].log_type, LOG_TYPE_COMPACTED)
+        self.assertEqual([r['message'] for r in expand_compacted_log(compacted[0])],
+                         ['old line 0', 'old line 1', 'old line 2'])
+
+        kept = InstanceLog.query.filter_by(instance_id=self.known_instance_id).order_by(InstanceLog.timestamp).all()
+        self.assertEqual([instance_log.message for instance_log in kept], ['line 3', 'line 4'])
+
+        # the log views show the compacted logs expanded
+        logs_path = '/api/v1/instances/%s/logs' % deleted_instance.id
+        response = self.make_authenticated_admin_request(path=logs_path, data=json.dumps({}))
+        self.assert_200(response)
+        self.assertEqual([(r['log_type'], r['message']) for r in response.json],
+                         [('provisioning', 'old line %d' % i) for i in range(3)])
+        response = self.make_authenticated_admin_request(path=logs_path, data=json.dumps({'log_type': 'provisioning'}))
+        self.assertEqual(len(response.json), 3)
+        response = self.make_authenticated_admin_request(
+            path='/api/v1/instances?show_deleted=true&include_logs=summary')
+        instance_data = [i for i in response.json if i['id'] == deleted_instance.id][0]
+        self.assertEqual([r['message'] for r in instance_data['logs']], ['old line 2'])
+
+        # the endpoint applies the configured policy
+        response = self.make_authenticated_admin_request(method='POST', path='/api/v1/instances/log_retention')
+        self.assert_200(response)
+        self.assertEqual(response.json['compacted'], 0)
+        self.assertFalse(response.json['more'])
+
+    def test_instance_log_retention_batches(self):
+        from pebbles.log_retention import apply_instance_log_retention, purge_old_instance_logs
+        now = time.time()
+        for i in range(5):
+            instance_log = InstanceLog(self.known_instance_id)
+            instance_log.log_type = 'running'
+            instance_log.log_level = 'INFO'
+            instance_log.timestamp = now - 100 * 86400 + i
+            instance_log.message = 'stale %d' % i
+            db.session.add(instance_log)
+        db.session.commit()
+
+        # a batch at a time, until nothing is left
+        results = [purge_old_instance_logs('running', 30, now=now, batch_size=2) for i in range(2)]
+        self.assertEqual(results, [(2, True), (2, True)])
+        results = apply_instance_log_retention({'running': {'max_age_days': 30}}, now=now)
+        self.assertEqual(results, {'running': 1, 'more': False})
+        self.assertEqual(InstanceLog.query.filter_by(log_type='running').count(), 0)
+
+    def test_get_instances_include_logs(self):
+        epoch_time = time.time()
+        for i, instance_id in enumerate((self.known_instance_id, self.known_instance_id, self.known_instance_id_2)):
+            log_record = {
+                'log_level': 'INFO',
+                'log_type': 'provisioning',
+                'timestamp': epoch_time + i,
+                'message': 'log line %d' % i
+            }
+            response_patch = self.make_authenticated_admin_request(
+                method='PATCH',
+                path='/api/v1/instances/%s/logs' % instance_id,
+                data=json.dumps({'log_record': log_record})
+            )
+            self.assert_200(response_patch)
+
+        # full logs are returned by default
+        response = self.make_authenticated_user_request(path='/api/v1/instances')
+        self.assert_200(response)
+        logs = dict((instance['id'], instance['logs']) for instance in response.json)
+        self.assertEqual(len(logs[self.known_instance_id]), 2)
+        self.assertEqual(logs[self.known_instance_id][0]['message'], 'log line 0')
+        self.assertEqual(len(logs[self.known_instance_id_2]), 1)
+
+        # summary only has the latest entry per log type
+        response = self.make_authenticated_user_request(path='/api/v1/instances?include_logs=summary')
+        self.assert_200(response)
+        logs = dict((instance['id'], instance['logs']) for instance in response.json)
+        self.assertEqual(len(logs[self.known_instance_id]), 1)
+        self.assertEqual(logs[self.known_instance_id][0]['message'], 'log line 1')
+        self.assertEqual(len(logs[self.known_instance_id_2]), 1)
+
+        response = self.make_authenticated_user_request(path='/api/v1/instances?include_logs=false')
+        self.assert_200(response)
+        for instance in response.json:
+            self.assertEqual(instance['logs'], [])
+
+        response = self.make_authenticated_user_request(path='/api/v1/instances?include_logs=bogus')
+        self.assert_400(response)
+
     def test_get_activation_url(self):
 
         t1 = ActivationToken(User.query.filter_by(id=self.known_user_id).first())
@@ -1628,6 +2149,49 @@ class FlaskApiTestCase(BaseTestCase):
             data=json.dumps(data))
         self.assertEqual(response2.status_code, 409)
 
+    def test_deleted_instance_credits_are_settled(self):
+        blueprint = Blueprint.query.filter_by(id=self.known_blueprint_id).first()
+        user = User.query.filter_by(id=self.known_user_id).first()
+        i1 = Instance(blueprint, user)
+        i1.provisioned_at = datetime.datetime(2015, 1, 1, 0, 0, 0)
+        i1.deprovisioned_at = datetime.datetime(2015, 1, 1, 0, 30, 0)
+        db.session.add(i1)
+        db.session.commit()
+        credits_before = user.calculate_credits_spent()
+
+        response = self.make_authenticated_admin_request(
+            method='PATCH',
+            path='/api/v1/instances/%s' % i1.id,
+            data=json.dumps({'state': Instance.STATE_DELETED}))
+        self.assert_200(response)
+
+        instance = Instance.query.filter_by(id=i1.id).first()
+        user = User.query.filter_by(id=self.known_user_id).first()
+        self.assertAlmostEqual(instance.credits_settled, instance.credits_spent())
+        self.assertAlmostEqual(user.credits_spent_settled, instance.credits_settled)
+        self.assertAlmostEqual(user.calculate_credits_spent(), credits_before)
+
+        # the instance is settled only once
+        response = self.make_authenticated_admin_request(
+            method='PATCH',
+            path='/api/v1/instances/%s' % i1.id,
+            data=json.dumps({'state': Instance.STATE_DELETED}))
+        self.assert_200(response)
+        user = User.query.filter_by(id=self.known_user_id).first()
+        self.assertAlmostEqual(user.credits_spent_settled, instance.credits_settled)
+
+    def test_failed_instance_credits_are_settled(self):
+        response = self.make_authenticated_admin_request(
+            method='PATCH',
+            path='/api/v1/instances/%s' % self.known_instance_id,
+            data=json.dumps({'state': Instance.STATE_FAILED}))
+        self.assert_200(response)
+
+        instance = Instance.query.filter_by(id=self.known_instance_id).first()
+        self.assertEqual(instance.credits_settled, 0.0)
+        user = User.query.filter_by(id=instance.user_id).first()
+        self.assertNotIn(instance, user.instances.filter(Instance.credits_settled.is_(None)).all())
+
     def test_update_admin_quota_relative(self):
         response = self.make_authenticated_admin_request(
             path='/api/v1/users'
@@ -1703,6 +2267,48 @@ class FlaskApiTestCase(BaseTestCase):
         )
         self.assert_200(response)
 
+    def test_admin_get_quota_list_credits(self):
+        blueprint = Blueprint.query.filter_by(id=self.known_blueprint_id).first()
+        user = User.query.filter_by(id=self.known_user_id).first()
+        i1 = Instance(blueprint, user)
+        i1.provisioned_at = datetime.datetime(2015, 1, 1, 0, 0, 0)
+        i1.deprovisioned_at = datetime.datetime(2015, 1, 1, 0, 30, 0)
+        db.session.add(i1)
+        i2 = Instance(blueprint, user)
+        i2.provisioned_at = datetime.datetime(2015, 1, 1, 0, 0, 0)
+        i2.deprovisioned_at = datetime.datetime(2015, 1, 1, 1, 0, 0)
+        db.session.add(i2)
+        db.session.commit()
+        i2.settle_credits()
+        db.session.commit()
+
+        expected = dict((u.id, u.calculate_credits_spent()) for u in User.query.all())
+
+        response = self.make_authenticated_admin_request(path='/api/v1/quota')
+        self.assert_200(response)
+        self.assertEqual(len(response.json), len(expected))
+        for row in response.json:
+            self.assertAlmostEqual(row['credits_spent'], expected[row['id']])
+        self.assertGreater(expected[self.known_user_id], 0.0)
+
+        paged_ids = []
+        for page in range(len(expected)):
+            response = self.make_authenticated_admin_request(path='/api/v1/quota?page=%d&page_size=1' % page)
+            self.assert_200(response)
+            self.assertEqual(len(response.json), 1)
+            paged_ids.append(response.json[0]['id'])
+        self.assertEqual(sorted(paged_ids), sorted(expected.keys()))
+
+        response = self.make_authenticated_admin_request(path='/api/v1/quota?format=csv')
+        self.assert_200(response)
+        self.assertEqual(response.mimetype, 'text/csv')
+        lines = response.data.decode('utf-8').splitlines()
+        self.assertEqual(lines[0], 'id,credits_quota,credits_spent')
+        self.assertEqual(len(lines), len(expected) + 1)
+        for line in lines[1:]:
+            user_id, credits_quota, credits_spent = line.split(',')
+            self.assertAlmostEqual(float(credits_spent), expected[user_id])
+
     def test_anonymous_cannot_see_user_quota(self):
         response2 = self.make_request(
             path='/api/v1/quota/%s' % self.known_user_id
@@ -2035,6 +2641,30 @@ class FlaskApiTestCase(BaseTestCase):
         self.assert_200(response)
         self.assertEqual(len(response.json), 0)
 
+    def test_get_notifications_not_modified(self):
+        response = self.make_authenticated_user_request(path='/api/v1/notifications')
+        self.assert_200(response)
+        etag = response.headers['ETag']
+        self.assertFalse(etag.startswith('W/'))
+        response = self.make_authenticated_user_request(path='/api/v1/notifications', headers={'If-None-Match': etag})
+        self.assertStatus(response, 304)
+
+        response = self.make_authenticated_user_request(
+            method='PATCH',
+            path='/api/v1/notifications/%s' % self.known_notification_id,
+            data=json.dumps({'send_mail': False})
+        )
+        self.assert_200(response)
+        response = self.make_authenticated_user_request(path='/api/v1/notifications', headers={'If-None-Match': etag})
+        self.assert_200(response)
+        self.assertEqual(len(response.json), 1)
+
+    def test_get_config_not_modified(self):
+        response = self.make_request(path='/api/v1/config')
+        self.assert_200(response)
+        response = self.make_request(path='/api/v1/config', headers={'If-None-Match': response.headers['ETag']})
+        self.assertStatus(response, 304)
+
     def test_admin_update_notification(self):
         subject_topic = 'NotificationABC'
         response = self.make_authenticated_admin_request(
@@ -2074,6 +2704,30 @@ class FlaskApiTestCase(BaseTestCase):
 
         self.assertEqual(response.json['overall_running_instances'], 4)
 
+    def test_admin_fetch_instance_usage_stats_filters(self):
+        instance = Instance.query.filter_by(id=self.known_instance_id).first()
+        instance.provisioned_at = datetime.datetime(2017, 1, 1, 12, 0)
+        db.session.commit()
+
+        response = self.make_authenticated_admin_request(
+            path='/api/v1/stats?start=2017-01-01T00:00:00Z&end=2017-01-02T00:00:00Z')
+        self.assertStatus(response, 200)
+        self.assertEqual(len(response.json['blueprints']), 1)
+        self.assertEqual(response.json['blueprints'][0]['name'], 'EnabledTestBlueprint')
+        self.assertEqual(response.json['blueprints'][0]['launched_instances'], 1)
+        self.assertEqual(response.json['overall_running_instances'], 1)
+
+        # only b4 of the known blueprints with instances belongs to Group2
+        response = self.make_authenticated_admin_request(
+            path='/api/v1/stats?group_id=%s' % self.known_group_id_2)
+        self.assertStatus(response, 200)
+        self.assertEqual(len(response.json['blueprints']), 1)
+        self.assertEqual(response.json['blueprints'][0]['name'], 'EnabledTestBlueprintOtherGroup')
+        self.assertEqual(response.json['overall_running_instances'], 1)
+
+        response = self.make_authenticated_admin_request(path='/api/v1/stats?start=yesterday')
+        self.assert_400(response)
+
     def test_user_fetch_instance_usage_stats(self):
         response = self.make_authenticated_user_request(
             method='GET',
@@ -2111,6 +2765,22 @@ class FlaskApiTestCase(BaseTestCase):
         self.assert_200(get_response)
         self.assertEqual(len(get_response.json), 1)
 
+    def test_get_namespaced_data_paginated(self):
+        for namespace in ('DriverA', 'DriverB'):
+            for i in range(3):
+                db.session.add(NamespacedKeyValue(namespace, 'key_%d' % i))
+        db.session.commit()
+
+        keys = []
+        path = '/api/v1/namespaced_keyvalues?limit=4'
+        while path:
+            response = self.make_authenticated_admin_request(path=path, data=json.dumps({}))
+            self.assert_200(response)
+            keys.extend((kv['namespace'], kv['key']) for kv in response.json)
+            next_cursor = response.headers.get('X-Next-Cursor')
+            path = '/api/v1/namespaced_keyvalues?limit=4&cursor=%s' % next_cursor if next_cursor else None
+        self.assertEqual(keys, [(ns, 'key_%d' % i) for ns in ('DriverA', 'DriverB') for i in range(3)])
+
     def test_create_duplicate_namespaced_data(self):
         response = self.make_authenticated_admin_request(
             method='POST',
@@ -2217,6 +2887,32 @@ class FlaskApiTestCase(BaseTestCase):
         )
         self.assertStatus(invalid_response, 409)
 
+    def test_update_namespaced_data_within_same_timestamp(self):
+        namespace = "TestDriver"
+        key = "test_pool_vm_7"
+        namespace_keyvalue_obj = NamespacedKeyValue(namespace, key)
+        namespace_keyvalue_obj.value = {'attribute': 'value'}
+        ts = 1000000000
+        namespace_keyvalue_obj.created_ts = ts
+        namespace_keyvalue_obj.updated_ts = ts
+        db.session.add(namespace_keyvalue_obj)
+        db.session.commit()
+
+        # the version changes even if the clock does not
+        with mock.patch('time.time', return_value=ts):
+            response = self.make_authenticated_admin_request(
+                method='PUT',
+                path='/api/v1/namespaced_keyvalues/%s/%s' % (namespace, key),
+                data=json.dumps({'namespace': namespace, 'key': key, 'value': json.dumps({"attr": "val"}), 'updated_version_ts': ts})
+            )
+            self.assert_200(response)
+            invalid_response = self.make_authenticated_admin_request(
+                method='PUT',
+                path='/api/v1/namespaced_keyvalues/%s/%s' % (namespace, key),
+                data=json.dumps({'namespace': namespace, 'key': key, 'value': json.dumps({"attr": "val2"}), 'updated_version_ts': ts})
+            )
+            self.assertStatus(invalid_response, 409)
+
     def test_delete_namespaced_data(self):
         namespace = "TestDriver"
         key = "test_pool_vm_6"
@@ -46,3 +46,101 @@ class TestMisc(TestCase):
         assert _parse_env_value("5.0") == 5.0
         assert _parse_env_value("-5.0") == -5.0
         assert _parse_env_value("5.0f") == "5.0f"
+
+    def test_api_session_is_shared(self):
+        from pebbles.client import PBClient, get_api_session
+        session = get_api_session(pool_size=2, retries=1, backoff_factor=0.1)
+        assert get_api_session(pool_size=2, retries=1, backoff_factor=0.1) is session
+        assert get_api_session(pool_size=3, retries=1, backoff_factor=0.1) is not session
+        adapter = session.get_adapter('https://api:1443/api/v1')
+        assert adapter.max_retries.total == 1
+
+        c1 = PBClient('token', 'https://api:1443/api/v1')
+        c2 = PBClient('token', 'https://api:1443/api/v1')
+        assert c1.session is c2.session
+        assert c1.timeout == (10, 120)
+
+    def test_api_client_settings_are_read_once(self):
+        from pebbles import client
+        client._api_client_settings.clear()
+        with patch('pebbles.client.BaseConfig', wraps=client.BaseConfig) as base_config:
+            for i in range(3):
+                client.get_api_session()
+                assert client.get_api_timeout() == (10, 120)
+                client.PBClient('token', 'https://api:1443/api/v1')
+        assert base_config.call_count == 1
+
+    @patch("pebbles.tasks.celery_app.time")
+    @patch("pebbles.tasks.celery_app.fetch_token")
+    def test_worker_token_is_cached(self, fetch_token, mock_time):
+        from pebbles.tasks import celery_app
+        celery_app._token_cache.update(token=None, expires_at=0)
+        fetch_token.side_effect = ['token1', 'token2', 'token3']
+        mock_time.time.return_value = 1000
+
+        assert celery_app.get_token() == 'token1'
+        assert celery_app.get_token() == 'token1'
+        assert fetch_token.call_count == 1
+
+        # renewed when the token is rejected, but only once for the same token
+        assert celery_app.get_token(expired_token='token1') == 'token2'
+        assert celery_app.get_token(expired_token='token1') == 'token2'
+        assert fetch_token.call_count == 2
+
+        # renewed before the token runs out
+        mock_time.time.return_value = 1000 + celery_app.TOKEN_LIFETIME - celery_app.TOKEN_RENEWAL_MARGIN
+        assert celery_app.get_token() == 'token3'
+        celery_app._token_cache.update(token=None, expires_at=0)
+
+    def test_client_renews_rejected_token(self):
+        from pebbles.client import PBClient
+        session = Mock()
+        session.request.side_effect = [Mock(status_code=401), Mock(status_code=200)]
+        refresher = Mock(return_value='new_token')
+        pbclient = PBClient('old_token', 'https://api:1443/api/v1', session=session, token_refresher=refresher)
+
+        resp = pbclient.do_get('instances')
+        assert resp.status_code == 200
+        refresher.assert_called_once_with('old_token')
+        assert pbclient.token == 'new_token'
+        headers = session.request.call_args[1]['headers']
+        assert headers['Authorization'] == 'Basic %s' % pbclient.auth
+
+    @patch("pebbles.tasks.provisioning_tasks.get_dynamic_config")
+    @patch("stevedore.dispatch.NameDispatchExtensionManager")
+    def test_provisioning_manager_is_cached(self, manager_class, get_dynamic_config):
+        from pebbles.tasks import provisioning_tasks
+        provisioning_tasks._provisioning_manager.update(manager=None, key=None)
+        get_dynamic_config.return_value = {'PLUGIN_WHITELIST': 'DummyDriver'}
+
+        mgr = provisioning_tasks.get_provisioning_manager()
+        assert provisioning_tasks.get_provisioning_manager() is mgr
+        assert manager_class.call_count == 1
+
+        # rebuilt when the whitelist changes
+        get_dynamic_config.return_value = {'PLUGIN_WHITELIST': 'DummyDriver DockerDriver'}
+        provisioning_tasks.get_provisioning_manager()
+        assert manager_class.call_count == 2
+        provisioning_tasks._provisioning_manager.update(manager=None, key=None)
+
+    def test_instance_log_handler_batches_records(self):
+        import logging
+        from pebbles.logger import PBInstanceLogHandler, PBInstanceLogFormatter
+        handler = PBInstanceLogHandler('https://api:1443/api/v1', 'instance_id', 'token', flush_interval=60)
+        handler.session = Mock()
+        handler.setFormatter(PBInstanceLogFormatter('provisioning'))
+        uploader = logging.getLogger('instance_id-provisioning-test')
+        uploader.setLevel(logging.INFO)
+        uploader.addHandler(handler)
+
+        for i in range(3):
+            uploader.info('line %d' % i)
+        # nothing is sent before the buffer is full or the interval has passed
+        assert not handler.session.patch.called
+
+        uploader.removeHandler(handler)
+        handler.close()
+        handler.session.patch.assert_called_once()
+        args, kwargs = handler.session.patch.call_args
+        assert args[0] == 'https://api:1443/api/v1/instances/instance_id/logs'
+        assert [r['message'] for r in kwargs['json']['log_records']] == ['line 0', 'line 1', 'line 2']
@@ -1,6 +1,7 @@
 import datetime
 from pebbles.tests.base import db, BaseTestCase
-from pebbles.models import User, Group, Blueprint, BlueprintTemplate, Plugin, Instance, NamespacedKeyValue
+from pebbles.models import User, Group, Blueprint, BlueprintTemplate, Plugin, Instance, NamespacedKeyValue, \
+    get_table_versions
 
 
 class ModelsTestCase(BaseTestCase):
@@ -68,6 +69,76 @@ class ModelsTestCase(BaseTestCase):
         expected_cost = (1.5 * 5 * 60 / 3600)
         assert (expected_cost - 0.01) < i1.credits_spent() < (expected_cost + 0.01)
 
+    def test_settle_instance_credits(self):
+        i1 = Instance(self.known_blueprint, self.known_user)
+        i1.provisioned_at = datetime.datetime(2015, 1, 1, 12, 0)
+        i1.deprovisioned_at = datetime.datetime(2015, 1, 1, 12, 5)
+        i2 = Instance(self.known_blueprint, self.known_user)
+        i2.provisioned_at = datetime.datetime(2015, 1, 1, 12, 0)
+        i2.deprovisioned_at = datetime.datetime(2015, 1, 1, 12, 10)
+        db.session.add(i1)
+        db.session.add(i2)
+        db.session.commit()
+        credits_before = self.known_user.calculate_credits_spent()
+
+        i1.settle_credits()
+        db.session.commit()
+        user = User.query.filter_by(id=self.known_user.id).first()
+        expected_cost = (1.5 * 5 * 60 / 3600)
+        assert (expected_cost - 0.01) < user.credits_spent_settled < (expected_cost + 0.01)
+        assert (expected_cost - 0.01) < i1.credits_settled < (expected_cost + 0.01)
+        assert i2.credits_settled is None
+        self.assertAlmostEqual(credits_before, user.calculate_credits_spent())
+
+        # settling twice must not charge the user again
+        self.assertFalse(i1.settle_credits())
+        db.session.commit()
+        user = User.query.filter_by(id=self.known_user.id).first()
+        assert (expected_cost - 0.01) < user.credits_spent_settled < (expected_cost + 0.01)
+
+        # neither must a concurrent settlement, which the loaded instance does not see yet
+        Instance.query.filter_by(id=i2.id).update({Instance.credits_settled: 1.0}, synchronize_session=False)
+        self.assertIsNone(i2.credits_settled)
+        self.assertFalse(i2.settle_credits())
+        db.session.commit()
+        user = User.query.filter_by(id=self.known_user.id).first()
+        assert (expected_cost - 0.01) < user.credits_spent_settled < (expected_cost + 0.01)
+
+    def test_blueprint_config_cache(self):
+        from pebbles.utils import blueprint_config_cache, invalidate_blueprint_config_cache
+        invalidate_blueprint_config_cache()
+        b1 = self.known_blueprint
+        assert b1.cost_multiplier == 1.5
+        assert len(blueprint_config_cache) == 1
+        # callers get their own copy of the cached config
+        b1.full_config['cost_multiplier'] = '7'
+        assert b1.cost_multiplier == 1.5
+
+        # a changed config is never served from the cache
+        b1.config = {'cost_multiplier': '2.5', 'maximum_lifetime': '2h'}
+        assert b1.cost_multiplier == 2.5
+        assert b1.maximum_lifetime == 3600
+        assert len(blueprint_config_cache) == 2
+
+        invalidate_blueprint_config_cache(blueprint_id=b1.id)
+        assert len(blueprint_config_cache) == 0
+        assert b1.cost_multiplier == 2.5
+        invalidate_blueprint_config_cache(template_id=self.known_template_id)
+        assert len(blueprint_config_cache) == 0
+
+    def test_blueprint_config_cache_eviction(self):
+        from pebbles.utils import BlueprintConfigCache
+        cache = BlueprintConfigCache(max_size=2)
+        cache.put(('b1', '{}', 't1', '{}', '[]'), 1)
+        cache.put(('b2', '{}', 't1', '{}', '[]'), 2)
+        assert cache.get(('b1', '{}', 't1', '{}', '[]')) == 1
+        cache.put(('b3', '{}', 't2', '{}', '[]'), 3)
+        assert len(cache) == 2
+        assert cache.get(('b2', '{}', 't1', '{}', '[]')) is None
+        assert cache.get(('b1', '{}', 't1', '{}', '[]')) == 1
+        cache.invalidate(template_id='t2')
+        assert cache.get(('b3', '{}', 't2', '{}', '[]')) is None
+
     def test_instance_states(self):
         i1 = Instance(self.known_blueprint, self.known_user)
         for state in Instance.VALID_STATES:
@@ -84,6 +155,27 @@ class ModelsTestCase(BaseTestCase):
             except ValueError:
                 pass
 
+    def test_table_versions_bumped_after_commit(self):
+        version = get_table_versions(['blueprints'])[0]
+
+        # the counters are not touched within the transaction that changes the table
+        self.known_blueprint.name = 'RenamedBlueprint'
+        db.session.flush()
+        self.assertEqual(get_table_versions(['blueprints'])[0], version)
+        db.session.rollback()
+        self.assertEqual(get_table_versions(['blueprints'])[0], version)
+
+        self.known_blueprint.name = 'RenamedBlueprint'
+        db.session.commit()
+        self.assertEqual(get_table_versions(['blueprints'])[0], version + 1)
+
+        # the tables written on every instance change have no counter
+        instance = Instance(self.known_blueprint, self.known_user)
+        db.session.add(instance)
+        db.session.commit()
+        self.assertEqual(get_table_versions(['blueprints', 'instances']), [version + 1, 0])
+        self.assertIsNotNone(instance.updated_at)
+
     def test_schema_validation(self):
         schema = {
             'type': 'object',
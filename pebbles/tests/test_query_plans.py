@@ -0,0 +1,145 @@
+import datetime
+import re
+import time
+
+from sqlalchemy import event
+
+from pebbles.tests.base import db, BaseTestCase
+from pebbles.models import User, Group, GroupUserAssociation, Blueprint, Instance, InstanceLog, Notification
+from pebbles.rules import apply_rules_blueprints, apply_rules_instances
+from pebbles.utils import keyset_query, encode_cursor
+from pebbles.views.instances import get_logs_query, INSTANCE_SORT_KEYS
+
+# tables that grow with usage, a full scan on these is a regression
+HOT_TABLES = ('instances', 'instance_logs', 'groups_users_association', 'notifications', 'blueprints')
+
+
+class QueryPlanTestCase(BaseTestCase):
+    """Checks with EXPLAIN QUERY PLAN that the hot queries are served by an index.
+    The tests run on SQLite, the plans on PostgreSQL may differ but use the same indexes."""
+
+    def setUp(self):
+        db.create_all()
+        u1 = User("user@example.org", "user", is_admin=False)
+        u2 = User("manager@example.org", "manager", is_admin=False)
+        db.session.add(u1)
+        db.session.add(u2)
+        self.known_user = u1
+        self.known_manager = u2
+
+        g1 = Group('Group1')
+        g1.owner_id = u2.id
+        db.session.add(g1)
+        db.session.add(GroupUserAssociation(user=u1, group=g1))
+        db.session.add(GroupUserAssociation(user=u2, group=g1, manager=True, owner=True))
+        self.known_group = g1
+
+        b1 = Blueprint()
+        b1.name = "TestBlueprint"
+        b1.group_id = g1.id
+        db.session.add(b1)
+
+        i1 = Instance(b1, u1)
+        i1.provisioned_at = datetime.datetime.utcnow()
+        db.session.add(i1)
+        self.known_instance_id = i1.id
+        db.session.commit()
+
+    def explain(self, query):
+        statement = getattr(query, 'statement', query)
+        compiled = statement.compile(dialect=db.engine.dialect)
+        params = [compiled.params[name] for name in compiled.positiontup]
+        cursor = db.session.connection().connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN %s' % compiled, params)
+        return [row[-1] for row in cursor.fetchall()]
+
+    def count_statements(self, func):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            func()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        return len(statements)
+
+    def assert_no_full_scans(self, query):
+        plan = self.explain(query)
+        for detail in plan:
+            for table in HOT_TABLES:
+                if re.match(r'^SCAN (TABLE )?%s\b' % table, detail) and 'INDEX' not in detail:
+                    self.fail('full scan of %s in query plan %s' % (table, plan))
+
+    def test_instances_of_user(self):
+        self.assert_no_full_scans(apply_rules_instances(self.known_user))
+
+    def test_instances_of_group_manager(self):
+        self.assert_no_full_scans(apply_rules_instances(self.known_manager))
+
+    def assert_no_sort(self, query):
+        plan = self.explain(query)
+        if any('TEMP B-TREE' in detail for detail in plan):
+            self.fail('sort in query plan %s' % plan)
+
+    def test_paginated_instances(self):
+        admin = User("admin@example.org", "admin", is_admin=True)
+        db.session.add(admin)
+        db.session.commit()
+        instance = Instance.query.filter_by(id=self.known_instance_id).first()
+        cursor = encode_cursor([instance.created_at, instance.id])
+        for cursor in (None, cursor):
+            query = keyset_query(apply_rules_instances(admin), INSTANCE_SORT_KEYS, cursor).limit(100)
+            self.assert_no_full_scans(query)
+            self.assert_no_sort(query)
+
+    def test_instance_logs(self):
+        self.assert_no_full_scans(get_logs_query(self.known_instance_id))
+        self.assert_no_full_scans(get_logs_query(self.known_instance_id, log_type='provisioning'))
+
+    def test_instance_logs_retention(self):
+        query = InstanceLog.query\
+            .filter(InstanceLog.log_type == 'provisioning')\
+            .filter(InstanceLog.timestamp < time.time() - 86400)
+        self.assert_no_full_scans(query)
+
+    def test_managed_groups(self):
+        query = GroupUserAssociation.query.filter_by(user_id=self.known_manager.id, manager=True)
+        self.assert_no_full_scans(query)
+
+    def test_unseen_notifications(self):
+        query = Notification.query.filter(Notification.broadcasted > datetime.datetime.utcnow())
+        self.assert_no_full_scans(query)
+
+    def test_blueprints_of_group(self):
+        query = Blueprint.query.filter_by(group_id=self.known_group.id)
+        self.assert_no_full_scans(query)
+
+    def test_visible_blueprints(self):
+        self.assert_no_full_scans(apply_rules_blueprints(self.known_user))
+        self.assert_no_full_scans(apply_rules_blueprints(self.known_manager))
+
+    def test_group_count_does_not_add_queries(self):
+        def list_visible():
+            for user in (self.known_user, self.known_manager):
+                apply_rules_blueprints(user).all()
+                apply_rules_instances(user).all()
+
+        num_statements = self.count_statements(list_visible)
+        for i in range(5):
+            group = Group('Group%d' % (i + 2))
+            db.session.add(group)
+            db.session.add(GroupUserAssociation(user=self.known_user, group=group))
+            db.session.add(GroupUserAssociation(user=self.known_manager, group=group, manager=True))
+            blueprint = Blueprint()
+            blueprint.name = 'Blueprint%d' % (i + 2)
+            blueprint.group_id = group.id
+            blueprint.is_enabled = True
+            db.session.add(blueprint)
+        db.session.commit()
+
+        self.assertEqual(self.count_statements(list_visible), num_statements)
+        self.assertEqual(apply_rules_blueprints(self.known_user).count(), 5)
+        self.assertEqual(apply_rules_blueprints(self.known_manager).count(), 6)
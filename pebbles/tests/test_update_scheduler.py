@@ -0,0 +1,88 @@
+from unittest import TestCase
+
+from pebbles.models import Instance
+from pebbles.tasks.celery_app import TaskRouter
+from pebbles.tasks.misc_tasks import UpdateScheduler, ACTION_DEPROVISION, ACTION_UPDATE
+
+
+class ResultMock(object):
+    def __init__(self, ready=False):
+        self._ready = ready
+
+    def ready(self):
+        return self._ready
+
+
+def make_instance(instance_id, state, lifetime_left=3600, maximum_lifetime=3600):
+    return {
+        'id': instance_id,
+        'state': state,
+        'lifetime_left': lifetime_left,
+        'maximum_lifetime': maximum_lifetime,
+    }
+
+
+class UpdateSchedulerTestCase(TestCase):
+    def test_select_actions(self):
+        scheduler = UpdateScheduler(capacity=10)
+        instances = [
+            make_instance('expired', Instance.STATE_RUNNING, lifetime_left=0),
+            make_instance('running', Instance.STATE_RUNNING),
+            make_instance('failed', Instance.STATE_FAILED),
+            make_instance('queueing', Instance.STATE_QUEUEING),
+        ]
+        work = scheduler.schedule(instances, now=1000)
+        self.assertEqual(
+            [(action, instance['id']) for action, instance in work],
+            [(ACTION_DEPROVISION, 'expired'), (ACTION_UPDATE, 'queueing')]
+        )
+
+    def test_capacity_and_priority(self):
+        scheduler = UpdateScheduler(capacity=2)
+        old = [make_instance('old-%d' % i, Instance.STATE_QUEUEING) for i in range(3)]
+        scheduler.schedule(old, now=1000)
+
+        new = [make_instance('new-%d' % i, Instance.STATE_QUEUEING) for i in range(3)]
+        expired = make_instance('expired', Instance.STATE_RUNNING, lifetime_left=0)
+        work = scheduler.schedule(new + old + [expired], now=1060)
+        # out of lifetime first, then the ones that have waited the longest
+        self.assertEqual([instance['id'] for _, instance in work], ['expired', 'old-0'])
+        self.assertEqual(scheduler.metrics['queue_depth'], 5)
+        self.assertEqual(scheduler.metrics['lag'], 60)
+
+    def test_in_flight_deduplication(self):
+        scheduler = UpdateScheduler(capacity=2, in_flight_timeout=300)
+        instances = [make_instance('i-%d' % i, Instance.STATE_PROVISIONING) for i in range(3)]
+
+        work = scheduler.schedule(instances, now=1000)
+        results = {}
+        for _, instance in work:
+            results[instance['id']] = ResultMock()
+            scheduler.mark_dispatched(instance['id'], results[instance['id']], now=1000)
+        self.assertEqual(sorted(results.keys()), ['i-0', 'i-1'])
+
+        # nothing is dispatched twice and there is no room for more
+        self.assertEqual(scheduler.schedule(instances, now=1060), [])
+        self.assertEqual(scheduler.metrics['in_flight'], 2)
+        self.assertEqual(scheduler.metrics['queue_depth'], 1)
+
+        # a finished task frees its slot
+        results['i-0']._ready = True
+        work = scheduler.schedule(instances, now=1120)
+        self.assertEqual([instance['id'] for _, instance in work], ['i-0'])
+
+        # stuck tasks time out
+        work = scheduler.schedule(instances, now=1400)
+        self.assertEqual(len(work), 2)
+
+    def test_forget_finished_instances(self):
+        scheduler = UpdateScheduler(capacity=10)
+        scheduler.schedule([make_instance('i-0', Instance.STATE_QUEUEING)], now=1000)
+        self.assertIn('i-0', scheduler.due_since)
+        scheduler.schedule([make_instance('i-0', Instance.STATE_RUNNING)], now=1060)
+        self.assertNotIn('i-0', scheduler.due_since)
+
+    def test_single_process_queue(self):
+        # the scheduler state is per process, see the UpdateScheduler docstring
+        route = TaskRouter().route_for_task('pebbles.tasks.periodic_update')
+        self.assertEqual(route, {'queue': 'update_scheduling_tasks'})
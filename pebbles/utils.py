@@ -1,9 +1,14 @@
 from Crypto.PublicKey import RSA
 import base64
+import datetime
+import json
 import struct
 import six
 from functools import wraps
 from flask import abort, g
+from collections import OrderedDict
+from sqlalchemy import and_, or_, literal, DateTime
+import threading
 import re
 
 
@@ -131,23 +136,189 @@ def parse_port_range(port_range):
         raise ValueError('No port range found')
 
 
-def get_full_blueprint_config(blueprint):
-    """Get the full config for blueprint from blueprint template for allowed attributes"""
+BLUEPRINT_CONFIG_CACHE_SIZE = 1024
+
+
+# response header carrying the cursor of the next page of a list
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+CURSOR_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(values):
+    """Encode the sort key values of the last row of a page into an opaque cursor"""
+    values = [value.strftime(CURSOR_DATETIME_FORMAT) if isinstance(value, datetime.datetime) else value
+              for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, sort_keys):
+    """Decode a cursor made by encode_cursor(), raises ValueError if it does not fit the sort keys"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)).decode('utf-8'))
+    except Exception:
+        raise ValueError('invalid cursor %s' % cursor)
+    if not isinstance(values, list) or len(values) != len(sort_keys):
+        raise ValueError('invalid cursor %s' % cursor)
+    for i, (column, _) in enumerate(sort_keys):
+        if values[i] is not None and isinstance(column.property.columns[0].type, DateTime):
+            values[i] = datetime.datetime.strptime(values[i], CURSOR_DATETIME_FORMAT)
+    return values
+
+
+def keyset_query(query, sort_keys, cursor=None):
+    """
+    Orders the query by sort_keys, a list of (column, descending) pairs ending with a unique
+    column, and filters it to the rows after the cursor, see paginate_by_keyset(). NULLs sort
+    last in both directions so that the order is the same on all databases.
+
+    Sorting on nullable columns adds IS NULL terms no index can serve, so on large tables
+    use non-nullable sort keys with a matching composite index.
+    """
+    nullable = [column.property.columns[0].nullable for column, _ in sort_keys]
+    order_by = []
+    for (column, descending), column_nullable in zip(sort_keys, nullable):
+        if column_nullable:
+            order_by.append(column.is_(None))
+        order_by.append(column.desc() if descending else column)
+    query = query.order_by(*order_by)
+
+    if cursor is not None:
+        values = decode_cursor(cursor, sort_keys)
+        conditions = []
+        equal_so_far = []
+        for (column, descending), column_nullable, value in zip(sort_keys, nullable, values):
+            if value is None:
+                # nothing sorts after NULL in this column
+                equal_so_far.append(column.is_(None))
+                continue
+            # bound as a typed literal, plain booleans only support equality comparisons
+            value = literal(value, type_=column.property.columns[0].type)
+            after = column < value if descending else column > value
+            if column_nullable:
+                after = or_(after, column.is_(None))
+            conditions.append(and_(*(equal_so_far + [after])))
+            equal_so_far.append(column == value)
+        query = query.filter(or_(*conditions))
+
+        first_column, descending = sort_keys[0]
+        if not nullable[0] and values[0] is not None:
+            # implied by the conditions above, a plain range lets the index seek to the cursor
+            value = literal(values[0], type_=first_column.property.columns[0].type)
+            query = query.filter(first_column <= value if descending else first_column >= value)
+    return query
+
+
+def paginate_by_keyset(query, sort_keys, cursor=None, limit=None):
+    """
+    Keyset pagination: orders the query by sort_keys and returns the rows after the cursor
+    together with the cursor of the next page, or None on the last page, see keyset_query().
+    Unlike offsets, the cost of fetching a page does not grow with its position.
+    """
+    query = keyset_query(query, sort_keys, cursor)
+
+    if limit is None:
+        return query.all(), None
+    rows = query.limit(limit + 1).all()
+    if len(rows) <= limit or not limit:
+        return rows[:limit], None
+    rows = rows[:limit]
+    return rows, encode_cursor([getattr(rows[-1], column.key) for column, _ in sort_keys])
+
+
+class BlueprintConfigCache(object):
+    """
+    Process-wide LRU cache of merged and parsed blueprint configs.
+
+    Entries are keyed by the ids and the raw config columns of the blueprint and its
+    template, so a changed config never hits a stale entry, even when it was
+    modified by another process. Views modifying configs also invalidate
+    the old entries to free the space early.
+    """
+
+    def __init__(self, max_size=BLUEPRINT_CONFIG_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, blueprint_id=None, template_id=None):
+        with self._lock:
+            if not blueprint_id and not template_id:
+                self._entries.clear()
+                return
+            for key in list(self._entries.keys()):
+                if key[0] == blueprint_id or key[2] == template_id:
+                    del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+blueprint_config_cache = BlueprintConfigCache()
+
+
+def invalidate_blueprint_config_cache(blueprint_id=None, template_id=None):
+    """Drop the cached configs of a blueprint or of all blueprints using a template, or everything"""
+    blueprint_config_cache.invalidate(blueprint_id=blueprint_id, template_id=template_id)
+
+
+def _get_blueprint_config_cache_entry(blueprint):
     template = blueprint.template
-    allowed_attrs = template.allowed_attrs
-    allowed_attrs = ['name', 'description'] + allowed_attrs
-    full_config = template.config
-    bp_config = blueprint.config
-    for attr in allowed_attrs:
-        if attr in bp_config:
-            full_config[attr] = bp_config[attr]
-    return full_config
+    key = (blueprint.id, blueprint._config, template.id, template._config, template._allowed_attrs)
+    entry = blueprint_config_cache.get(key)
+    if entry is None:
+        allowed_attrs = template.allowed_attrs
+        allowed_attrs = ['name', 'description'] + allowed_attrs
+        full_config = template.config
+        bp_config = blueprint.config
+        for attr in allowed_attrs:
+            if attr in bp_config:
+                full_config[attr] = bp_config[attr]
+        entry = {'full_config': full_config, 'config': bp_config, 'fields': {}}
+        blueprint_config_cache.put(key, entry)
+    return entry
 
 
-def get_blueprint_fields_from_config(blueprint, field_name):
-    """Hybrid fields for Blueprint model which need processing"""
-    full_config = get_full_blueprint_config(blueprint)
+def get_blueprint_config(blueprint):
+    """Get the parsed config of the blueprint itself"""
+    return dict(_get_blueprint_config_cache_entry(blueprint)['config'])
+
+
+# parsed blueprint schemas and forms of the templates, keyed by the raw columns like the configs
+blueprint_template_schema_cache = BlueprintConfigCache()
 
+
+def get_blueprint_template_schema_and_form(template):
+    """Get the parsed blueprint schema and form of a template. They are large and identical for all
+    the blueprints of the template, so the parsed dicts are shared and must not be modified."""
+    key = (template.id, template._blueprint_schema, template._blueprint_form)
+    entry = blueprint_template_schema_cache.get(key)
+    if entry is None:
+        entry = (template.blueprint_schema, template.blueprint_form)
+        blueprint_template_schema_cache.put(key, entry)
+    return entry
+
+
+def get_full_blueprint_config(blueprint):
+    """Get the full config for blueprint from blueprint template for allowed attributes"""
+    # hand out a copy, the cached dict is shared by all the callers
+    return dict(_get_blueprint_config_cache_entry(blueprint)['full_config'])
+
+
+def _parse_blueprint_field(full_config, field_name):
     if field_name == 'preallocated_credits':
         preallocated_credits = False  # Default value
         if 'preallocated_credits' in full_config:
@@ -173,3 +344,12 @@ def get_blueprint_fields_from_config(blueprint, field_name):
             except:
                 pass
         return cost_multiplier
+
+
+def get_blueprint_fields_from_config(blueprint, field_name):
+    """Hybrid fields for Blueprint model which need processing"""
+    entry = _get_blueprint_config_cache_entry(blueprint)
+    fields = entry['fields']
+    if field_name not in fields:
+        fields[field_name] = _parse_blueprint_field(entry['full_config'], field_name)
+    return fields[field_name]
@@ -11,7 +11,7 @@ from pebbles.models import db, BlueprintTemplate, Plugin
 from pebbles.forms import BlueprintTemplateForm
 from pebbles.server import restful
 from pebbles.views.commons import auth, requires_group_manager_or_admin
-from pebbles.utils import requires_admin, parse_maximum_lifetime
+from pebbles.utils import requires_admin, parse_maximum_lifetime, invalidate_blueprint_config_cache
 from pebbles.rules import apply_rules_blueprint_templates
 
 blueprint_templates = FlaskBlueprint('blueprint_templates', __name__)
@@ -127,6 +127,7 @@ class BlueprintTemplateView(restful.Resource):
 
         db.session.add(blueprint_template)
         db.session.commit()
+        invalidate_blueprint_config_cache(template_id=blueprint_template.id)
 
 
 class BlueprintTemplateCopy(restful.Resource):
@@ -1,6 +1,7 @@
 from flask.ext.restful import marshal_with, fields, reqparse
 from flask import abort, g
 from flask import Blueprint as FlaskBlueprint
+from sqlalchemy.orm import contains_eager, joinedload
 from sqlalchemy.orm.session import make_transient
 
 import logging
@@ -9,9 +10,10 @@ import uuid
 from pebbles.models import db, Blueprint, BlueprintTemplate, Group, Instance
 from pebbles.forms import BlueprintForm
 from pebbles.server import restful
-from pebbles.views.commons import auth, requires_group_manager_or_admin, is_group_manager
-from pebbles.utils import parse_maximum_lifetime, requires_group_owner_or_admin, requires_admin
-from pebbles.rules import apply_rules_blueprints
+from pebbles.views.commons import auth, requires_group_manager_or_admin, is_group_manager, conditional_get
+from pebbles.utils import parse_maximum_lifetime, requires_group_owner_or_admin, requires_admin, \
+    invalidate_blueprint_config_cache, get_blueprint_config, get_blueprint_template_schema_and_form
+from pebbles.rules import apply_rules_blueprints, get_manager_group_ids
 
 blueprints = FlaskBlueprint('blueprints', __name__)
 
@@ -25,7 +27,7 @@ blueprint_fields = {
     'template_name': fields.String,
     'is_enabled': fields.Boolean,
     'plugin': fields.String,
-    'config': fields.Raw,
+    'config': fields.Raw(attribute='config_with_name'),
     'full_config': fields.Raw,
     'schema': fields.Raw,
     'form': fields.Raw,
@@ -36,18 +38,29 @@ blueprint_fields = {
 }
 
 
+BLUEPRINT_LIST_TABLES = (
+    'blueprints', 'blueprint_templates', 'groups', 'groups_users_association', 'groups_banned_users'
+)
+
+
 class BlueprintList(restful.Resource):
     @auth.login_required
+    @conditional_get(BLUEPRINT_LIST_TABLES)
     @marshal_with(blueprint_fields)
     def get(self):
         user = g.user
         query = apply_rules_blueprints(user)
         # sort the results based on the group name first and then by blueprint name
         query = query.join(Group, Blueprint.group).order_by(Group.name).order_by(Blueprint.name)
+        # the groups come with the join above and the templates with another one
+        query = query.options(contains_eager(Blueprint.group), joinedload(Blueprint.template))
+        manager_group_ids = set()
+        if not user.is_admin:
+            manager_group_ids = set(get_manager_group_ids(user))
         results = []
         for blueprint in query.all():
             if blueprint.current_status != 'archived':
-                blueprint = process_blueprint(blueprint)
+                blueprint = process_blueprint(blueprint, manager_group_ids)
                 results.append(blueprint)
         return results
 
@@ -84,6 +97,7 @@ class BlueprintList(restful.Resource):
             return timeformat_error, 422
         db.session.add(blueprint)
         db.session.commit()
+        invalidate_blueprint_config_cache(blueprint_id=blueprint.id)
 
 
 class BlueprintView(restful.Resource):
@@ -141,6 +155,7 @@ class BlueprintView(restful.Resource):
             return timeformat_error, 422
         db.session.add(blueprint)
         db.session.commit()
+        invalidate_blueprint_config_cache(blueprint_id=blueprint.id)
 
     @auth.login_required
     @requires_admin
@@ -154,6 +169,7 @@ class BlueprintView(restful.Resource):
             blueprint.current_status = args['current_status']
             blueprint.is_enabled = False
             db.session.commit()
+            invalidate_blueprint_config_cache(blueprint_id=blueprint.id)
 
     @auth.login_required
     @requires_group_owner_or_admin
@@ -168,6 +184,7 @@ class BlueprintView(restful.Resource):
         elif blueprint_instance is None:
             db.session.delete(blueprint)
             db.session.commit()
+            invalidate_blueprint_config_cache(blueprint_id=blueprint_id)
         else:
             logging.warn("trying to delete used blueprint")
             abort(422)
@@ -195,22 +212,25 @@ class BlueprintCopy(restful.Resource):
         db.session.commit()
 
 
-def process_blueprint(blueprint):
+def process_blueprint(blueprint, manager_group_ids=None):
+    """Set the attributes serialized with blueprint_fields. The manager status is looked up from
+    manager_group_ids when given, so that listings do not query it for each blueprint."""
     user = g.user
     template = blueprint.template
-    blueprint.schema = template.blueprint_schema
-    blueprint.form = template.blueprint_form
-    # Due to immutable nature of config field, whole dict needs to be reassigned.
-    # Issue #444 in github
-    blueprint_config = blueprint.config
-    blueprint_config['name'] = blueprint.name
-    blueprint.config = blueprint_config
+    blueprint.schema, blueprint.form = get_blueprint_template_schema_and_form(template)
+    # the name is edited as a part of the config in the blueprint forms
+    blueprint.config_with_name = get_blueprint_config(blueprint)
+    blueprint.config_with_name['name'] = blueprint.name
 
     blueprint.template_name = template.name
     blueprint.group_name = blueprint.group.name
     # rest of the code taken for refactoring from single blueprint GET query
     blueprint.plugin = blueprint.template.plugin
-    if user.is_admin or is_group_manager(user, blueprint.group):
+    if user.is_admin:
+        blueprint.manager = True
+    elif manager_group_ids is not None:
+        blueprint.manager = blueprint.group_id in manager_group_ids
+    elif is_group_manager(user, blueprint.group):
         blueprint.manager = True
     return blueprint
 
@@ -1,13 +1,26 @@
 from flask.ext.restful import fields
+from flask.ext.restful.utils import unpack
 from flask.ext.httpauth import HTTPBasicAuth
-from flask import g, render_template, abort
+from flask import g, render_template, abort, request, Response
+from sqlalchemy import event
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.session import make_transient_to_detached
+from collections import OrderedDict, defaultdict
+import hashlib
+import json
 import logging
-from pebbles.models import db, ActivationToken, User, Group, GroupUserAssociation
+import threading
+import time
+from pebbles.models import db, ActivationToken, User, Group, GroupUserAssociation, get_table_versions
 from pebbles.server import app
 from pebbles.tasks import send_mails
 from functools import wraps
 import re
 
+AUTH_TOKEN_CACHE_SIZE = 10000
+# the user attributes kept in the cache, the rest are loaded from the database when accessed
+AUTH_TOKEN_CACHE_USER_ATTRIBUTES = ('id', '_email', 'is_admin', 'is_group_owner', 'is_active', 'is_deleted', 'is_blocked')
+
 
 user_fields = {
     'id': fields.String,
@@ -36,9 +49,116 @@ auth = HTTPBasicAuth()
 auth.authenticate_header = lambda: "Authentication Required"
 
 
+class AuthTokenCache(object):
+    """
+    Process-wide cache of verified auth tokens to the identity and the access flags of
+    their users, so that the polling clients do not verify the token signature and load
+    the user from the database on every request.
+
+    The entries of a user are dropped when the user is updated or deleted through the
+    ORM. Other API processes notice those changes after the ttl at the latest.
+    """
+
+    def __init__(self, max_size=AUTH_TOKEN_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._tokens_by_user = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def get(self, token, now=None):
+        """Return the cached user attributes of a token or None"""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            expires_at, attributes = entry
+            if expires_at < now:
+                self._remove(token)
+                return None
+            return attributes
+
+    def put(self, token, user, ttl, now=None):
+        if now is None:
+            now = time.time()
+        attributes = dict((key, getattr(user, key)) for key in AUTH_TOKEN_CACHE_USER_ATTRIBUTES)
+        with self._lock:
+            self._remove(token)
+            self._entries[token] = (now + ttl, attributes)
+            self._tokens_by_user[user.id].add(token)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if not user_id:
+                self._entries.clear()
+                self._tokens_by_user.clear()
+                return
+            for token in self._tokens_by_user.pop(user_id, ()):
+                self._entries.pop(token, None)
+
+    def _remove(self, token):
+        entry = self._entries.pop(token, None)
+        if entry is not None:
+            user_tokens = self._tokens_by_user.get(entry[1]['id'])
+            if user_tokens is not None:
+                user_tokens.discard(token)
+                if not user_tokens:
+                    del self._tokens_by_user[entry[1]['id']]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+auth_token_cache = AuthTokenCache()
+
+
+def invalidate_auth_token_cache(user_id=None):
+    """Drop the cached tokens of a user, or of everyone"""
+    auth_token_cache.invalidate(user_id)
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _invalidate_auth_token_cache_for_user(mapper, connection, user):
+    invalidate_auth_token_cache(user.id)
+
+
+@event.listens_for(User.__table__, 'after_drop')
+def _invalidate_auth_token_cache(target, connection, **kw):
+    invalidate_auth_token_cache()
+
+
+def get_cached_token_user(token):
+    """Return the user of a token verified within the ttl, attached to the session without
+    querying the database. Attributes outside the cached ones are loaded when accessed."""
+    attributes = auth_token_cache.get(token)
+    if attributes is None:
+        return None
+    user = User.__mapper__.class_manager.new_instance()
+    for key, value in attributes.items():
+        set_committed_value(user, key, value)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+def verify_auth_token(token):
+    ttl = app.dynamic_config.get('AUTH_TOKEN_CACHE_TTL')
+    if ttl:
+        user = get_cached_token_user(token)
+        if user:
+            return user
+    user = User.verify_auth_token(token, app.config['SECRET_KEY'])
+    if user and ttl:
+        auth_token_cache.put(token, user, ttl)
+    return user
+
+
 @auth.verify_password
 def verify_password(userid_or_token, password):
-    g.user = User.verify_auth_token(userid_or_token, app.config['SECRET_KEY'])
+    g.user = verify_auth_token(userid_or_token)
     if not g.user:
         g.user = User.query.filter_by(email=userid_or_token).first()
         if not g.user:
@@ -130,3 +250,48 @@ def is_group_manager(user, group=None):
     if match:
         return True
     return False
+
+
+def conditional_get(table_names, time_bucket=None, key=None):
+    """
+    Decorator for polled GET views that sends an ETag and answers 304 Not Modified, without
+    running the view, when If-None-Match has the current one.
+
+    The ETag is derived from the change counters of table_names, the user and its access
+    flags, the request arguments and the return value of key, if given. Views listing rows
+    of the tables that change all the time version them in key instead, for example by the
+    latest update of the rows. Views with time dependent fields give
+    time_bucket, a function returning a period in seconds: the ETag then changes at least
+    that often and is weak, as the fields drift within the period.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            user = getattr(g, 'user', None)
+            etag_key = [
+                request.path,
+                sorted(request.args.items(multi=True)),
+                [user.id, user.is_admin, user.is_group_owner] if user else None,
+                get_table_versions(table_names),
+                key() if key else None,
+            ]
+            period = time_bucket() if time_bucket else None
+            if period:
+                etag_key.append(int(time.time() // period))
+            etag = hashlib.sha1(json.dumps(etag_key).encode('utf-8')).hexdigest()
+            etag_headers = {
+                'ETag': ('W/"%s"' if period else '"%s"') % etag,
+                'Cache-Control': 'private, no-cache',
+            }
+            if request.if_none_match.contains_weak(etag):
+                return Response(status=304, headers=etag_headers)
+
+            data, code, headers = unpack(f(*args, **kwargs))
+            if code == 200:
+                headers = dict(headers)
+                headers.update(etag_headers)
+            return data, code, headers
+
+        return decorated
+
+    return decorator
@@ -1,8 +1,10 @@
-from flask.ext.restful import marshal_with, reqparse
+from flask.ext.restful import marshal, marshal_with, reqparse
 from flask import abort, g
 from flask import Blueprint as FlaskBlueprint
+from sqlalchemy.sql.expression import true
+from collections import defaultdict
 import logging
-from pebbles.models import db, Group, User, GroupUserAssociation
+from pebbles.models import db, Group, User, GroupUserAssociation, group_banned_user
 from pebbles.forms import GroupForm
 from pebbles.server import restful
 from pebbles.views.commons import auth, group_fields, user_fields, requires_group_manager_or_admin, is_group_manager
@@ -13,30 +15,48 @@ groups = FlaskBlueprint('groups', __name__)
 
 
 class GroupList(restful.Resource):
+    parser = reqparse.RequestParser()
+    parser.add_argument('fields', type=str, location='args')
+
     @auth.login_required
     @requires_group_manager_or_admin
-    @marshal_with(group_fields)
     def get(self):
         user = g.user
-        group_user_query = GroupUserAssociation.query
-        results = []
+        args = self.parser.parse_args()
+        response_fields = group_fields
+        if args.fields:
+            field_names = [field_name.strip() for field_name in args.fields.split(',')]
+            if not set(field_names) <= set(group_fields.keys()):
+                abort(422)
+            response_fields = dict((field_name, group_fields[field_name]) for field_name in field_names)
+
+        # the owners, managers and banned users of all the listed groups are loaded with one query
+        # each, instead of a few per group
+        group_ids = db.session.query(Group.id)
         if not user.is_admin:
-            group_manager_objs = group_user_query.filter_by(user_id=user.id, manager=True).all()
-            manager_groups = [group_manager_obj.group for group_manager_obj in group_manager_objs]
-            groups = manager_groups
-        else:
-            query = Group.query
-            groups = query.all()
+            group_ids = db.session.query(GroupUserAssociation.group_id)\
+                .filter_by(user_id=user.id, manager=True)
+        group_ids = group_ids.subquery()
+        groups = Group.query.filter(Group.id.in_(group_ids)).all()
+        owners = dict(
+            db.session.query(GroupUserAssociation.group_id, User)
+            .join(User, User.id == GroupUserAssociation.user_id)
+            .filter(GroupUserAssociation.group_id.in_(group_ids))
+            .filter(GroupUserAssociation.owner == true())
+        )
+        user_configs = {}
+        if 'user_config' in response_fields:
+            user_configs = generate_user_configs(group_ids)
 
+        results = []
         for group in groups:
-            group_owner_obj = group_user_query.filter_by(group_id=group.id, owner=True).first()
-            owner = User.query.filter_by(id=group_owner_obj.user_id).first()
+            owner = owners.get(group.id)
             # config and user_config dicts are required by schemaform and multiselect in the groups modify ui modal
-            if user.is_admin or user.id == owner.id:
+            if user.is_admin or (owner and user.id == owner.id):
                 group.config = {"name": group.name, "join_code": group.join_code, "description": group.description}
-                group.user_config = generate_user_config(group)
-                group.owner_email = owner.email
-                group.admin_group = owner.is_admin
+                group.user_config = user_configs.get(group.id, {'banned_users': [], 'managers': []})
+                group.owner_email = owner.email if owner else None
+                group.admin_group = owner.is_admin if owner else False
             else:
                 group.config = {}
                 group.user_config = {}
@@ -45,8 +65,8 @@ class GroupList(restful.Resource):
         if not user.is_admin:
             results = sorted(results, key=lambda group: group.name)
         else:  # For admins, the admin groups should be first
-            results = sorted(results, key=lambda group: (-group.admin_group, group.owner_email, group.name))
-        return results
+            results = sorted(results, key=lambda group: (-group.admin_group, group.owner_email or '', group.name))
+        return marshal(results, response_fields)
 
     @auth.login_required
     @requires_group_owner_or_admin
@@ -167,18 +187,20 @@ def group_users_add(group, user_config, owner):
     return group
 
 
-def generate_user_config(group):
-    """Generates the user_config object used in multiselect ui component on groups modify modal"""
-    user_config = {'banned_users': [], 'managers': []}
-    if group.banned_users:
-        for banned_user in group.banned_users:
-            user_config['banned_users'].append({'id': banned_user.id})
-    group_manager_objs = GroupUserAssociation.query.filter_by(group_id=group.id, manager=True, owner=False).all()
-    if group_manager_objs:
-        for group_manager_obj in group_manager_objs:
-            manager = group_manager_obj.user
-            user_config['managers'].append({'id': manager.id})
-    return user_config
+def generate_user_configs(group_ids):
+    """Generates the user_config objects used in multiselect ui component on groups modify modal
+    for the groups in the group id subquery, keyed by group id"""
+    user_configs = defaultdict(lambda: {'banned_users': [], 'managers': []})
+    banned_rows = db.session.query(group_banned_user.c.group_id, group_banned_user.c.user_id)\
+        .filter(group_banned_user.c.group_id.in_(group_ids))
+    for group_id, user_id in banned_rows:
+        user_configs[group_id]['banned_users'].append({'id': user_id})
+    manager_rows = db.session.query(GroupUserAssociation.group_id, GroupUserAssociation.user_id)\
+        .filter(GroupUserAssociation.group_id.in_(group_ids))\
+        .filter_by(manager=True, owner=False)
+    for group_id, user_id in manager_rows:
+        user_configs[group_id]['managers'].append({'id': user_id})
+    return user_configs
 
 
 class GroupJoin(restful.Resource):
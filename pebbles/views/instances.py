@@ -2,22 +2,50 @@ from flask.ext.restful import marshal, marshal_with, fields, reqparse
 from flask import abort, g
 from flask import Blueprint as FlaskBlueprint
 
+from sqlalchemy import and_, or_, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+
 import datetime
 import logging
 import json
+from collections import defaultdict
 
-from pebbles.models import db, Blueprint, Instance, InstanceLog, User
+from pebbles.models import db, Blueprint, BlueprintTemplate, Instance, InstanceLog, Plugin, User
 from pebbles.forms import InstanceForm, UserIPForm
 from pebbles.server import app, restful
-from pebbles.utils import requires_admin, memoize
+from pebbles.utils import requires_admin, memoize, paginate_by_keyset, NEXT_CURSOR_HEADER
 from pebbles.tasks import run_update, update_user_connectivity, fetch_running_instance_logs
-from pebbles.views.commons import auth, is_group_manager
+from pebbles.views.commons import auth, is_group_manager, conditional_get
 from pebbles.rules import apply_rules_instances, get_group_blueprint_ids_for_instances
+from pebbles.log_retention import apply_instance_log_retention, expand_instance_logs, LOG_TYPE_COMPACTED
 
 instances = FlaskBlueprint('instances', __name__)
 
 USER_INSTANCE_LIMIT = 5
 
+# keep the IN clauses of the batched log queries within the bind parameter limits of the database
+LOG_QUERY_BATCH_SIZE = 500
+
+# instance names generated and checked against the database per round trip
+INSTANCE_NAME_CANDIDATES = 10
+# inserts retried when a concurrent launch takes the chosen name first
+INSTANCE_NAME_ATTEMPTS = 5
+
+# stable order of the instance listings, served by ix_instances_created_at_id, see paginate_by_keyset()
+INSTANCE_SORT_KEYS = ((Instance.created_at, False), (Instance.id, False))
+
+# tables the instance listing is built from besides the instances and their logs, see conditional_get()
+INSTANCE_LIST_TABLES = ('blueprints', 'groups', 'groups_users_association')
+
+# the launch history of the instances the demand of a plugin is learned from, see InstanceDemand
+DEMAND_HISTORY_WEEKS = 4
+HOURS_IN_WEEK = 7 * 24
+
+INCLUDE_LOGS_NONE = 'false'
+INCLUDE_LOGS_SUMMARY = 'summary'
+INCLUDE_LOGS_FULL = 'full'
+
 instance_fields = {
     'id': fields.String,
     'name': fields.String,
@@ -40,6 +68,14 @@ instance_fields = {
     'logs': fields.Raw,
 }
 
+due_instance_fields = {
+    'id': fields.String,
+    'state': fields.String,
+    'to_be_deleted': fields.Boolean,
+    'lifetime_left': fields.Integer,
+    'maximum_lifetime': fields.Integer,
+}
+
 instance_log_fields = {
     'id': fields.String,
     'instance_id': fields.String,
@@ -70,26 +106,80 @@ def positive_integer(input_value):
         raise ValueError('{} is not a positive integer'.format(input_value))
 
 
+def choose_instance_name(prefix):
+    """Return a generated instance name that is not in use. Only the candidate names are
+    looked up, through the unique index on the name column."""
+    while True:
+        candidates = set(Instance.generate_name(prefix=prefix) for _ in range(INSTANCE_NAME_CANDIDATES))
+        taken_names = set(row.name for row in db.session.query(Instance.name).filter(Instance.name.in_(candidates)))
+        free_names = candidates - taken_names
+        if free_names:
+            return free_names.pop()
+
+
+def get_instance_list_version():
+    """The version of the instances an instance listing request shows: their number and latest
+    update, and the same for their logs when those are included"""
+    args = InstanceList.parser.parse_args()
+    for paging_arg in ('offset', 'limit', 'cursor'):
+        args.pop(paging_arg)
+    instance_query = apply_rules_instances(g.user, args).order_by(None)
+    version = list(instance_query.with_entities(func.count(Instance.id), func.max(Instance.updated_at)).one())
+    if args.get('include_logs') != INCLUDE_LOGS_NONE:
+        instance_ids = instance_query.with_entities(Instance.id).subquery()
+        version += db.session.query(func.count(InstanceLog.id), func.max(InstanceLog.timestamp))\
+            .filter(InstanceLog.instance_id.in_(instance_ids)).one()
+    return [str(x) for x in version]
+
+
 class InstanceList(restful.Resource):
     parser = reqparse.RequestParser()
     parser.add_argument('show_deleted', type=bool, default=False, location='args')
     parser.add_argument('show_only_mine', type=bool, default=False, location='args')
     parser.add_argument('offset', type=positive_integer, location='args')
     parser.add_argument('limit', type=positive_integer, location='args')
+    parser.add_argument('cursor', type=str, location='args')
+    parser.add_argument(
+        'include_logs',
+        type=str,
+        default=INCLUDE_LOGS_FULL,
+        choices=(INCLUDE_LOGS_NONE, INCLUDE_LOGS_SUMMARY, INCLUDE_LOGS_FULL),
+        location='args'
+    )
 
     @auth.login_required
+    @conditional_get(INSTANCE_LIST_TABLES, time_bucket=lambda: app.dynamic_config.get('ETAG_TIME_BUCKET'),
+                     key=get_instance_list_version)
     @marshal_with(instance_fields)
     def get(self):
         user = g.user
         args = self.parser.parse_args()
+        offset, limit = args.pop('offset'), args.pop('limit')
         q = apply_rules_instances(user, args)
-        q = q.order_by(Instance.provisioned_at)
-        instances = q.all()
+        next_cursor = None
+        if offset is not None:
+            q = q.order_by(Instance.provisioned_at).offset(offset)
+            if limit is not None:
+                q = q.limit(limit)
+            instances = q.all()
+        else:
+            try:
+                instances, next_cursor = paginate_by_keyset(q, INSTANCE_SORT_KEYS, args.get('cursor'), limit)
+            except ValueError:
+                abort(422)
+
+        include_logs = args.get('include_logs')
+        logs_by_instance = {}
+        if include_logs != INCLUDE_LOGS_NONE:
+            instance_ids = [instance.id for instance in instances]
+            latest_only = include_logs == INCLUDE_LOGS_SUMMARY
+            logs_by_instance = get_logs_for_instances_from_db(instance_ids, latest_only=latest_only)
 
         get_blueprint = memoize(query_blueprint)
         get_user = memoize(query_user)
         for instance in instances:
-            instance_logs = get_logs_from_db(instance.id)
+            instance_logs = expand_instance_logs(logs_by_instance.get(instance.id, []),
+                                                 latest_only=include_logs == INCLUDE_LOGS_SUMMARY)
             instance.logs = marshal(instance_logs, instance_log_fields)
 
             user = get_user(instance.user_id)
@@ -111,6 +201,8 @@ class InstanceList(restful.Resource):
             if instance.to_be_deleted:
                 instance.state = Instance.STATE_DELETING
 
+        if next_cursor:
+            return instances, 200, {NEXT_CURSOR_HEADER: next_cursor}
         return instances
 
     @auth.login_required
@@ -129,36 +221,39 @@ class InstanceList(restful.Resource):
         blueprint = Blueprint.query.filter_by(id=blueprint_id, is_enabled=True).first()
         if not blueprint:
             abort(404)
-        if user.quota_exceeded():
+        credits_spent = user.calculate_credits_spent()
+        if credits_spent >= user.credits_quota:
             return {'error': 'USER_OVER_QUOTA'}, 409
 
         if blueprint.preallocated_credits:
             preconsumed_amount = blueprint.cost()
-            total_credits_spent = preconsumed_amount + user.credits_spent
+            total_credits_spent = preconsumed_amount + credits_spent
             if user.credits_quota < total_credits_spent:
                 return {'error': 'USER_OVER_QUOTA'}, 409
 
-        instances_for_user = Instance.query.filter_by(
+        num_instances_for_user = Instance.query.filter_by(
             blueprint_id=blueprint.id,
             user_id=user.id
-        ).filter(Instance.state != 'deleted').all()
+        ).filter(Instance.state != 'deleted').count()
 
         user_instance_limit = blueprint.full_config.get('maximum_instances_per_user', USER_INSTANCE_LIMIT)
-        if instances_for_user and len(instances_for_user) >= user_instance_limit:
+        if num_instances_for_user >= user_instance_limit:
             return {'error': 'BLUEPRINT_INSTANCE_LIMIT_REACHED'}, 409
 
-        instance = Instance(blueprint, user)
-        # XXX: Choosing the name should be done in the model's constructor method
-        # decide on a name that is not used currently
-        existing_names = set(x.name for x in Instance.query.all())
-        # Note: the potential race is solved by unique constraint in database
-        while True:
-            c_name = Instance.generate_name(prefix=app.dynamic_config.get('INSTANCE_NAME_PREFIX'))
-            if c_name not in existing_names:
-                instance.name = c_name
+        name_prefix = app.dynamic_config.get('INSTANCE_NAME_PREFIX')
+        # the race between choosing a free name and inserting it is solved by the unique constraint
+        for attempt in range(INSTANCE_NAME_ATTEMPTS):
+            instance = Instance(blueprint, user)
+            instance.name = choose_instance_name(name_prefix)
+            db.session.add(instance)
+            try:
+                db.session.commit()
                 break
-        db.session.add(instance)
-        db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                if attempt == INSTANCE_NAME_ATTEMPTS - 1:
+                    raise
+                logging.warn("instance name %s was taken concurrently, retrying" % instance.name)
 
         if not app.dynamic_config.get('SKIP_TASK_QUEUE'):
             run_update.delay(instance.id)
@@ -166,6 +261,109 @@ class InstanceList(restful.Resource):
         return marshal(instance, instance_fields), 200
 
 
+class InstanceDueWork(restful.Resource):
+    """The instances the periodic scheduler has to act on: running instances past their
+    maximum lifetime and the ones in a transitional state."""
+
+    @auth.login_required
+    @requires_admin
+    @marshal_with(due_instance_fields)
+    def get(self):
+        now = datetime.datetime.utcnow()
+        active_query = db.session.query(Instance.blueprint_id)\
+            .filter(Instance.state.notin_([Instance.STATE_DELETED, Instance.STATE_FAILED]))\
+            .distinct()
+        # maximum lifetimes live in the JSON configs, so they are resolved once per blueprint and
+        # the expiry of the instances is then computed in SQL with a cutoff time per blueprint
+        maximum_lifetimes = {}
+        blueprint_ids = [row.blueprint_id for row in active_query]
+        if blueprint_ids:
+            blueprints = Blueprint.query.options(joinedload('template'))\
+                .filter(Blueprint.id.in_(blueprint_ids)).all()
+            maximum_lifetimes = dict((blueprint.id, blueprint.maximum_lifetime) for blueprint in blueprints)
+
+        expired = [
+            and_(Instance.blueprint_id == blueprint_id,
+                 Instance.provisioned_at <= now - datetime.timedelta(seconds=maximum_lifetime))
+            for blueprint_id, maximum_lifetime in maximum_lifetimes.items()
+        ]
+        due_conditions = [Instance.state != Instance.STATE_RUNNING, Instance.to_be_deleted.is_(True)]
+        due_query = db.session.query(
+            Instance.id,
+            Instance.state.label('state'),
+            Instance.to_be_deleted,
+            Instance.provisioned_at,
+            Instance.blueprint_id
+        ).filter(Instance.state.notin_([Instance.STATE_DELETED, Instance.STATE_FAILED]))\
+            .filter(or_(*(due_conditions + expired)))\
+            .order_by(Instance.provisioned_at)
+
+        results = []
+        for row in due_query:
+            maximum_lifetime = maximum_lifetimes.get(row.blueprint_id, 0)
+            age = 0
+            if row.provisioned_at:
+                age = (now - row.provisioned_at).total_seconds()
+            results.append({
+                'id': row.id,
+                'state': Instance.STATE_DELETING if row.to_be_deleted else row.state,
+                'to_be_deleted': row.to_be_deleted,
+                'lifetime_left': max(maximum_lifetime - age, 0),
+                'maximum_lifetime': maximum_lifetime,
+            })
+        return results
+
+
+class InstanceDemand(restful.Resource):
+    """The demand for the instances of a provisioning plugin, in the slots the blueprints consume:
+    the queueing instances and the launches by hour of the week (monday 00-01 UTC first),
+    averaged over the past weeks. Drivers with a pool of hosts use this to scale ahead of the load."""
+    parser = reqparse.RequestParser()
+    parser.add_argument('plugin', type=str, location='args')
+    parser.add_argument('weeks', type=int, default=DEMAND_HISTORY_WEEKS, location='args')
+
+    @auth.login_required
+    @requires_admin
+    def get(self):
+        args = self.parser.parse_args()
+        if args.weeks < 0:
+            abort(422)
+
+        blueprint_query = Blueprint.query.options(joinedload('template'))
+        if args.plugin:
+            blueprint_query = blueprint_query\
+                .join(BlueprintTemplate, BlueprintTemplate.id == Blueprint.template_id)\
+                .join(Plugin, Plugin.id == BlueprintTemplate.plugin)\
+                .filter(Plugin.name == args.plugin)
+        consumed_slots = dict(
+            (blueprint.id, int(blueprint.full_config.get('consumed_slots', 1))) for blueprint in blueprint_query
+        )
+
+        queueing_slots = 0
+        hourly_launch_slots = [0.0] * HOURS_IN_WEEK
+        if consumed_slots:
+            queueing_query = db.session.query(Instance.blueprint_id, func.count(Instance.id))\
+                .filter(Instance.blueprint_id.in_(consumed_slots.keys()))\
+                .filter(Instance.state == Instance.STATE_QUEUEING)\
+                .group_by(Instance.blueprint_id)
+            queueing_slots = sum(consumed_slots[blueprint_id] * count for blueprint_id, count in queueing_query)
+
+        if consumed_slots and args.weeks:
+            since = datetime.datetime.utcnow() - datetime.timedelta(weeks=args.weeks)
+            launch_query = db.session.query(Instance.blueprint_id, Instance.provisioned_at)\
+                .filter(Instance.blueprint_id.in_(consumed_slots.keys()))\
+                .filter(Instance.provisioned_at >= since)
+            for blueprint_id, provisioned_at in launch_query:
+                hour_of_week = provisioned_at.weekday() * 24 + provisioned_at.hour
+                hourly_launch_slots[hour_of_week] += float(consumed_slots[blueprint_id]) / args.weeks
+
+        return {
+            'queueing_slots': queueing_slots,
+            'hourly_launch_slots': hourly_launch_slots if args.weeks else [],
+            'weeks': args.weeks,
+        }
+
+
 class InstanceView(restful.Resource):
     parser = reqparse.RequestParser()
     parser.add_argument('state', type=str)
@@ -188,7 +386,7 @@ class InstanceView(restful.Resource):
         blueprint = Blueprint.query.filter_by(id=instance.blueprint_id).first()
         instance.blueprint_id = blueprint.id
         instance.username = instance.user
-        instance_logs = get_logs_from_db(instance.id)
+        instance_logs = expand_instance_logs(get_logs_from_db(instance.id))
         instance.logs = marshal(instance_logs, instance_log_fields)
 
         if 'allow_update_client_connectivity' in blueprint.full_config \
@@ -261,6 +459,13 @@ class InstanceView(restful.Resource):
                     instance.provisioned_at = datetime.datetime.utcnow()
             if args['state'] == Instance.STATE_FAILED:
                 instance.errored = True
+                # failed instances cost nothing, settling them keeps them out of the unsettled credits
+                instance.settle_credits()
+            if instance.state == Instance.STATE_DELETED:
+                # instances expiring through their lifetime never got the end time set by the user delete
+                if not instance.deprovisioned_at:
+                    instance.deprovisioned_at = datetime.datetime.utcnow()
+                instance.settle_credits()
 
             db.session.commit()
 
@@ -287,6 +492,7 @@ class InstanceView(restful.Resource):
 class InstanceLogs(restful.Resource):
     parser = reqparse.RequestParser()
     parser.add_argument('log_record', type=dict)
+    parser.add_argument('log_records', type=dict, action='append')
     parser.add_argument('log_type', type=str)
     parser.add_argument('send_log_fetch_task', type=bool)
 
@@ -297,10 +503,8 @@ class InstanceLogs(restful.Resource):
         instance = Instance.query.filter_by(id=instance_id).first()
         if not instance:
             abort(404)
-        if args.get('log_type'):
-            log_type = args['log_type']
-        instance_logs = get_logs_from_db(instance_id, log_type)
-        return instance_logs
+        instance_logs = get_logs_from_db(instance_id, args.get('log_type'))
+        return expand_instance_logs(instance_logs)
 
     @auth.login_required
     @requires_admin
@@ -312,10 +516,13 @@ class InstanceLogs(restful.Resource):
         if args.get('send_log_fetch_task'):
             if not app.dynamic_config.get('SKIP_TASK_QUEUE'):
                 fetch_running_instance_logs.delay(instance_id)
+        log_records = args.get('log_records') or []
         if args.get('log_record'):
-            log_record = args['log_record']
-            instance_log = process_logs(instance_id, log_record)
-            db.session.add(instance_log)
+            log_records.append(args['log_record'])
+        if log_records:
+            # a batch of records is stored in one transaction
+            for instance_log in process_log_records(instance_id, log_records):
+                db.session.add(instance_log)
             db.session.commit()
 
         return 'ok'
@@ -337,31 +544,90 @@ class InstanceLogs(restful.Resource):
         db.session.commit()
 
 
-def get_logs_from_db(instance_id, log_type=None):
+class InstanceLogRetention(restful.Resource):
+    @auth.login_required
+    @requires_admin
+    def post(self):
+        # one batch per request to stay within the client timeouts, the caller repeats while 'more' is set
+        return apply_instance_log_retention(
+            app.dynamic_config.get('INSTANCE_LOG_RETENTION'),
+            compaction_age_days=app.dynamic_config.get('INSTANCE_LOG_COMPACTION_AGE_DAYS')
+        )
+
+
+def get_logs_query(instance_id, log_type=None):
     logs_query = InstanceLog.query\
         .filter_by(instance_id=instance_id)
-    if log_type:
+    if log_type == 'provisioning':
+        # the compacted rows hold the provisioning logs of deleted instances
+        logs_query = logs_query.filter(InstanceLog.log_type.in_((log_type, LOG_TYPE_COMPACTED)))
+    elif log_type:
         logs_query = logs_query.filter_by(log_type=log_type)
-    logs_query = logs_query.order_by(InstanceLog.timestamp)
-    logs = logs_query.all()
+    return logs_query.order_by(InstanceLog.timestamp)
+
+
+def get_logs_from_db(instance_id, log_type=None):
+    logs = get_logs_query(instance_id, log_type).all()
     return logs
 
 
-def process_logs(instance_id, log_record):
+def get_logs_for_instances_from_db(instance_ids, log_type=None, latest_only=False):
+    """Fetch the logs of several instances in batches instead of one query per instance.
 
-    check_running_log = get_logs_from_db(instance_id, "running")
+    Returns a dict of instance id -> list of logs ordered by timestamp. With latest_only set,
+    only the most recent log entry of each log type is returned for every instance.
+    """
+    logs_by_instance = defaultdict(list)
+    for batch_start in range(0, len(instance_ids), LOG_QUERY_BATCH_SIZE):
+        batch_ids = instance_ids[batch_start:batch_start + LOG_QUERY_BATCH_SIZE]
+        logs_query = InstanceLog.query.filter(InstanceLog.instance_id.in_(batch_ids))
+        if log_type:
+            logs_query = logs_query.filter_by(log_type=log_type)
+        if latest_only:
+            latest_logs = db.session.query(
+                InstanceLog.instance_id,
+                InstanceLog.log_type,
+                func.max(InstanceLog.timestamp).label('timestamp')
+            ).filter(InstanceLog.instance_id.in_(batch_ids))\
+                .group_by(InstanceLog.instance_id, InstanceLog.log_type)\
+                .subquery()
+            logs_query = logs_query.join(latest_logs, and_(
+                InstanceLog.instance_id == latest_logs.c.instance_id,
+                InstanceLog.log_type == latest_logs.c.log_type,
+                InstanceLog.timestamp == latest_logs.c.timestamp
+            ))
+        logs_query = logs_query.order_by(InstanceLog.timestamp)
+        for log in logs_query.all():
+            logs_by_instance[log.instance_id].append(log)
+    return logs_by_instance
 
-    if check_running_log:
-        instance_log = check_running_log[0]
-        if log_record['log_type'] == "running":
-            instance_log.timestamp = float(log_record['timestamp'])
-            instance_log.message = log_record['message']
-            return instance_log
 
-    instance_log = InstanceLog(instance_id)
-    instance_log.log_type = log_record['log_type']
-    instance_log.log_level = log_record['log_level']
-    instance_log.timestamp = float(log_record['timestamp'])
-    instance_log.message = log_record['message']
+def process_logs(instance_id, log_record):
+    return process_log_records(instance_id, [log_record])[0]
+
 
-    return instance_log
+def process_log_records(instance_id, log_records):
+    """Turn uploaded log records into InstanceLog objects. There is only one "running"
+    log per instance, which is updated in place instead of adding a new row."""
+    check_running_log = get_logs_from_db(instance_id, "running")
+    running_log = check_running_log[0] if check_running_log else None
+
+    instance_logs = []
+    for log_record in log_records:
+        if running_log and log_record['log_type'] == "running":
+            running_log.timestamp = float(log_record['timestamp'])
+            running_log.message = log_record['message']
+            if running_log not in instance_logs:
+                instance_logs.append(running_log)
+            continue
+
+        instance_log = InstanceLog(instance_id)
+        instance_log.log_type = log_record['log_type']
+        instance_log.log_level = log_record['log_level']
+        instance_log.timestamp = float(log_record['timestamp'])
+        instance_log.message = log_record['message']
+        if instance_log.log_type == "running":
+            running_log = instance_log
+        instance_logs.append(instance_log)
+
+    return instance_logs
@@ -1,14 +1,15 @@
-from flask.ext.restful import fields, marshal_with, reqparse
+from flask.ext.restful import fields, marshal_with, reqparse, inputs
 from flask import abort, Blueprint
 
 import logging
 import time
+from sqlalchemy.exc import OperationalError
 
 from pebbles.models import db, NamespacedKeyValue
 from pebbles.forms import NamespacedKeyValueForm
 from pebbles.server import restful
 from pebbles.views.commons import auth
-from pebbles.utils import requires_admin
+from pebbles.utils import requires_admin, paginate_by_keyset, NEXT_CURSOR_HEADER
 
 namespaced_keyvalues = Blueprint('namespaced_keyvalues', __name__)
 
@@ -27,6 +28,10 @@ class NamespacedKeyValueList(restful.Resource):
     parser = reqparse.RequestParser()
     parser.add_argument('namespace', type=str)
     parser.add_argument('key', type=str)
+    parser.add_argument('limit', type=inputs.natural, location='args')
+    parser.add_argument('cursor', type=str, location='args')
+
+    sort_keys = ((NamespacedKeyValue.namespace, False), (NamespacedKeyValue.key, False))
 
     @auth.login_required
     @requires_admin
@@ -39,7 +44,14 @@ class NamespacedKeyValueList(restful.Resource):
         if args.get('key'):
             namespaced_query = namespaced_query.filter(NamespacedKeyValue.key.like("{0}%".format(args.key)))
 
-        return namespaced_query.all()
+        try:
+            namespaced_keyvalues, next_cursor = paginate_by_keyset(
+                namespaced_query, self.sort_keys, args.cursor, args.limit)
+        except ValueError:
+            abort(422)
+        if next_cursor:
+            return namespaced_keyvalues, 200, {NEXT_CURSOR_HEADER: next_cursor}
+        return namespaced_keyvalues
 
     @auth.login_required
     @requires_admin
@@ -107,7 +119,12 @@ class NamespacedKeyValueView(restful.Resource):
         updated_version_ts = float(form.updated_version_ts.data)
 
         namespaced_keyvalue_query = NamespacedKeyValue.query.filter_by(namespace=namespace, key=key)
-        namespaced_keyvalue = namespaced_keyvalue_query.with_for_update(nowait=True).first()  # FOR UPDATE , for really close race conditions
+        try:
+            namespaced_keyvalue = namespaced_keyvalue_query.with_for_update(nowait=True).first()  # FOR UPDATE , for really close race conditions
+        except OperationalError:
+            db.session.rollback()
+            logging.warn("trying to modify a record locked by a concurrent modification")
+            return {'error': 'CONCURRENT_MODIFICATION_EXCEPTION'}, 409
         if not namespaced_keyvalue:
             logging.warn("no NamespacedKeyValue object found for namespace %s with key %s" % (namespace, key))
             abort(404)
@@ -117,7 +134,8 @@ class NamespacedKeyValueView(restful.Resource):
             logging.warn("trying to modify an outdated record")
             return {'error': 'CONCURRENT_MODIFICATION_EXCEPTION'}, 409
 
-        curr_ts = round(time.time(), 2)
+        # the version must change even if the previous update was within the same 10 ms
+        curr_ts = max(round(time.time(), 2), round((namespaced_keyvalue.updated_ts or 0) + 0.01, 2))
         namespaced_keyvalue.updated_ts = curr_ts
         # If schema changes, assign it first
         namespaced_keyvalue.schema = schema
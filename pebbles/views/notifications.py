@@ -1,12 +1,12 @@
 from flask.ext.restful import fields, marshal_with, reqparse
-from flask import abort, g, Blueprint
+from flask import abort, g, request, Blueprint
 
 import logging
 
 from pebbles.models import db, Notification, User
 from pebbles.forms import NotificationForm
-from pebbles.server import restful
-from pebbles.views.commons import auth
+from pebbles.server import app, restful
+from pebbles.views.commons import auth, conditional_get
 from pebbles.utils import requires_admin
 import datetime
 
@@ -32,12 +32,25 @@ def get_current_user():
     return current_user
 
 
+def recent_notifications_time_bucket():
+    # the recent notifications are the ones broadcasted within a minute
+    if request.args.get('show_recent'):
+        return app.dynamic_config.get('ETAG_TIME_BUCKET')
+
+
+def get_latest_seen_notification_ts():
+    # the unseen notifications depend on the user's last seen one
+    return str(g.user.latest_seen_notification_ts)
+
+
 class NotificationList(restful.Resource):
     parser = reqparse.RequestParser()
     parser.add_argument('show_all', type=bool, default=False, location='args')
     parser.add_argument('show_recent', type=bool, default=False, location='args')
 
     @auth.login_required
+    @conditional_get(('notifications',), time_bucket=recent_notifications_time_bucket,
+                     key=get_latest_seen_notification_ts)
     @marshal_with(notification_fields)
     def get(self):
         args = self.parser.parse_args()
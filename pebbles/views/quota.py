@@ -1,14 +1,19 @@
-from flask import abort, g
+from flask import abort, g, Response, stream_with_context
 from flask import Blueprint as FlaskBlueprint
-from flask.ext.restful import marshal_with, fields, reqparse
+from flask.ext.restful import marshal_with, marshal, fields, reqparse, inputs
+from sqlalchemy.orm import joinedload
+from collections import defaultdict
+import datetime
 
 from pebbles.server import restful
 from pebbles.views.commons import auth
 from pebbles.utils import requires_admin
-from pebbles.models import db, User
+from pebbles.models import db, User, Instance, Blueprint
 
 quota = FlaskBlueprint('quota', __name__)
 
+QUOTA_REPORT_BATCH_SIZE = 500
+
 parser = reqparse.RequestParser()
 quota_update_functions = {
     'absolute': lambda user, value: value,
@@ -35,6 +40,85 @@ def parse_arguments():
     return args
 
 
+def get_blueprint_costs(blueprint_ids):
+    """Resolve the cost parameters of the given blueprints, parsing each config only once"""
+    blueprint_costs = {}
+    if not blueprint_ids:
+        return blueprint_costs
+    blueprints = Blueprint.query.options(joinedload('template'))\
+        .filter(Blueprint.id.in_(blueprint_ids)).all()
+    for blueprint in blueprints:
+        blueprint_costs[blueprint.id] = (
+            blueprint.preallocated_credits,
+            blueprint.maximum_lifetime,
+            blueprint.cost_multiplier
+        )
+    return blueprint_costs
+
+
+def calculate_credits_spent_for_users(users):
+    """Calculate the credits spent by a batch of users with one query for their unsettled
+    instances and one for the blueprints involved, instead of lazy loading per user and
+    instance. The pricing follows Instance.credits_spent."""
+    credits_spent = dict((user.id, user.credits_spent_settled or 0.0) for user in users)
+    if not credits_spent:
+        return credits_spent
+
+    instance_rows = db.session.query(
+        Instance.user_id,
+        Instance.blueprint_id,
+        Instance.provisioned_at,
+        Instance.deprovisioned_at,
+        Instance.errored
+    ).filter(Instance.user_id.in_(credits_spent.keys()))\
+        .filter(Instance.credits_settled.is_(None)).all()
+
+    blueprint_costs = get_blueprint_costs(set(row.blueprint_id for row in instance_rows))
+    now = datetime.datetime.utcnow()
+    unsettled_credits = defaultdict(float)
+    for row in instance_rows:
+        if row.errored:
+            continue
+        preallocated_credits, maximum_lifetime, cost_multiplier = \
+            blueprint_costs.get(row.blueprint_id, (False, 0, 1.0))
+        if preallocated_credits:
+            duration = maximum_lifetime
+        elif row.provisioned_at:
+            duration = ((row.deprovisioned_at or now) - row.provisioned_at).total_seconds()
+        else:
+            duration = 0.0
+        unsettled_credits[row.user_id] += cost_multiplier * duration / 3600
+
+    for user_id, credits in unsettled_credits.items():
+        credits_spent[user_id] += credits
+    return credits_spent
+
+
+def generate_quota_report(users_query):
+    """Yield the quota report rows of the users in the query batch by batch"""
+    offset = 0
+    while True:
+        users = users_query.offset(offset).limit(QUOTA_REPORT_BATCH_SIZE).all()
+        if not users:
+            break
+        credits_spent = calculate_credits_spent_for_users(users)
+        for user in users:
+            yield {
+                'id': user.id,
+                'credits_quota': user.credits_quota,
+                'credits_spent': credits_spent[user.id]
+            }
+        if len(users) < QUOTA_REPORT_BATCH_SIZE:
+            break
+        offset += QUOTA_REPORT_BATCH_SIZE
+
+
+def generate_quota_report_csv(users_query):
+    yield 'id,credits_quota,credits_spent\n'
+    for row in generate_quota_report(users_query):
+        yield '%s,%s,%s\n' % (row['id'], row['credits_quota'], row['credits_spent'])
+
+
 def update_user_quota(user, update_type, value):
     try:
         fun = quota_update_functions[update_type]
@@ -44,33 +128,54 @@ def update_user_quota(user, update_type, value):
 
 
 class Quota(restful.Resource):
+    report_parser = reqparse.RequestParser()
+    report_parser.add_argument('page', type=inputs.natural, location='args')
+    report_parser.add_argument('page_size', type=inputs.positive, default=100, location='args')
+    report_parser.add_argument('format', choices=('json', 'csv'), default='json', location='args')
+
     @auth.login_required
     @requires_admin
     @marshal_with(quota_fields)
     def put(self):
         args = parse_arguments()
-        results = []
 
-        for user in User.query.all():
-            update_user_quota(user, args['type'], args['value'])
-            results.append({'id': user.id, 'credits_quota': user.credits_quota})
+        # the update functions work on the column expressions as well, so all users are updated in one statement
+        fun = quota_update_functions[args['type']]
+        try:
+            User.query.update({User.credits_quota: fun(User, args['value'])}, synchronize_session=False)
+            db.session.commit()
+        except:
+            db.session.rollback()
+            abort(422)
 
-        db.session.commit()
-        return results
+        return [{'id': row.id, 'credits_quota': row.credits_quota}
+                for row in db.session.query(User.id, User.credits_quota)]
 
     @auth.login_required
     @requires_admin
-    @marshal_with(quota_fields)
     def get(self):
-        results = []
-        for user in User.query.all():
-            results.append({
+        args = self.report_parser.parse_args()
+        users_query = User.query.order_by(User.id)
+
+        if args['format'] == 'csv':
+            return Response(
+                stream_with_context(generate_quota_report_csv(users_query)),
+                mimetype='text/csv',
+                headers={'Content-Disposition': 'attachment; filename=quota.csv'}
+            )
+
+        if args.get('page') is not None:
+            page_users = users_query.offset(args['page'] * args['page_size']).limit(args['page_size']).all()
+            credits_spent = calculate_credits_spent_for_users(page_users)
+            results = [{
                 'id': user.id,
                 'credits_quota': user.credits_quota,
-                'credits_spent': user.calculate_credits_spent()
-            })
+                'credits_spent': credits_spent[user.id]
+            } for user in page_users]
+        else:
+            results = list(generate_quota_report(users_query))
 
-        return results
+        return marshal(results, quota_fields)
 
 
 class UserQuota(restful.Resource):
@@ -1,23 +1,18 @@
-from flask.ext.restful import marshal_with, fields
+from flask.ext.restful import marshal_with, fields, reqparse, inputs
 from flask import Blueprint as FlaskBlueprint
+from sqlalchemy import func, distinct, case
 
-import logging
+import pytz
 
-from pebbles.models import Blueprint, Instance
+from pebbles.models import db, Blueprint, Instance
 from pebbles.server import restful
 from pebbles.views.commons import auth
-from pebbles.utils import requires_admin, memoize
-
-from collections import defaultdict
+from pebbles.utils import requires_admin
 
 
 stats = FlaskBlueprint('stats', __name__)
 
 
-def query_blueprint(blueprint_id):
-    return Blueprint.query.filter_by(id=blueprint_id).first()
-
-
 blueprint_fields = {
 
     'name': fields.String,
@@ -34,43 +29,64 @@ result_fields = {
 }
 
 
-class StatsList(restful.Resource):
-    @auth.login_required
-    @requires_admin
-    @marshal_with(result_fields)
-    def get(self):
-        instances = Instance.query.all()
-        overall_running_instances = Instance.query.filter(Instance.state != Instance.STATE_DELETED).count()
-
-        get_blueprint = memoize(query_blueprint)
-        per_blueprint_results = defaultdict(lambda: {'users': 0, 'launched_instances': 0, 'running_instances': 0})
-        unique_users = defaultdict(set)
-
-        for instance in instances:
+def utc_datetime(input_value):
+    """Parse an ISO 8601 timestamp into a naive UTC datetime, as stored in the database"""
+    try:
+        value = inputs.datetime_from_iso8601(input_value)
+    except Exception:
+        raise ValueError('{} is not a valid ISO 8601 timestamp'.format(input_value))
+    if value.tzinfo:
+        value = value.astimezone(pytz.utc).replace(tzinfo=None)
+    return value
 
-            user_id = instance.user_id
 
-            blueprint = get_blueprint(instance.blueprint_id)
-            if not blueprint:
-                logging.warn("instance %s has a reference to non-existing blueprint" % instance.id)
-                continue
+def apply_stats_filters(query, args):
+    """Limit the instances taken into account to the given time window and group"""
+    if args.get('start'):
+        query = query.filter(Instance.provisioned_at >= args['start'])
+    if args.get('end'):
+        query = query.filter(Instance.provisioned_at < args['end'])
+    if args.get('group_id'):
+        group_blueprint_ids = db.session.query(Blueprint.id).filter(Blueprint.group_id == args['group_id'])
+        query = query.filter(Instance.blueprint_id.in_(group_blueprint_ids.subquery()))
+    return query
 
-            if 'name' not in per_blueprint_results[blueprint.id]:
-                per_blueprint_results[blueprint.id]['name'] = blueprint.name
 
-            if user_id not in unique_users[blueprint.id]:
-                unique_users[blueprint.id].add(user_id)
-                per_blueprint_results[blueprint.id]['users'] += 1
-
-            if(instance.state != Instance.STATE_DELETED):
-                per_blueprint_results[blueprint.id]['running_instances'] += 1
+class StatsList(restful.Resource):
+    parser = reqparse.RequestParser()
+    parser.add_argument('start', type=utc_datetime, location='args')
+    parser.add_argument('end', type=utc_datetime, location='args')
+    parser.add_argument('group_id', type=str, location='args')
 
-            per_blueprint_results[blueprint.id]['launched_instances'] += 1
-            # per_blueprint_results[blueprint.id]['overall_running_instances'] = overall_running_instances
+    @auth.login_required
+    @requires_admin
+    @marshal_with(result_fields)
+    def get(self):
+        args = self.parser.parse_args()
+
+        overall_query = db.session.query(func.count(Instance.id))\
+            .filter(Instance.state != Instance.STATE_DELETED)
+        overall_running_instances = apply_stats_filters(overall_query, args).scalar()
+
+        # let the database do the counting, instances referring to non-existing blueprints drop out in the join
+        running = case([(Instance.state != Instance.STATE_DELETED, 1)], else_=0)
+        per_blueprint_query = db.session.query(
+            Blueprint.name,
+            func.count(distinct(Instance.user_id)).label('users'),
+            func.count(Instance.id).label('launched_instances'),
+            func.sum(running).label('running_instances'),
+        ).join(Instance, Instance.blueprint_id == Blueprint.id)\
+            .group_by(Blueprint.id, Blueprint.name)
+        per_blueprint_query = apply_stats_filters(per_blueprint_query, args)
 
         results = []
-        for blueprint_id in per_blueprint_results:
-            results.append(per_blueprint_results[blueprint_id])
+        for row in per_blueprint_query.all():
+            results.append({
+                'name': row.name,
+                'users': row.users,
+                'launched_instances': row.launched_instances,
+                'running_instances': row.running_instances or 0,
+            })
 
         results.sort(key=lambda results_entry: (results_entry["launched_instances"], results_entry["users"]), reverse=True)
         final = {"blueprints": results, "overall_running_instances": overall_running_instances}
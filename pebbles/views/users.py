@@ -1,4 +1,4 @@
-from flask.ext.restful import marshal_with, fields, reqparse
+from flask.ext.restful import marshal_with, fields, reqparse, inputs
 from flask import abort, g
 from flask import Blueprint as FlaskBlueprint
 from sqlalchemy import desc
@@ -10,7 +10,7 @@ import werkzeug
 from pebbles.models import db, Keypair, User, ActivationToken
 from pebbles.forms import ChangePasswordForm, UserForm
 from pebbles.server import restful, app
-from pebbles.utils import generate_ssh_keypair, requires_admin
+from pebbles.utils import generate_ssh_keypair, requires_admin, paginate_by_keyset, NEXT_CURSOR_HEADER
 from pebbles.views.commons import user_fields, auth, invite_user
 
 users = FlaskBlueprint('users', __name__)
@@ -24,6 +24,20 @@ class UserList(restful.Resource):
     parser = reqparse.RequestParser()
     parser.add_argument('addresses')
 
+    list_parser = reqparse.RequestParser()
+    list_parser.add_argument('limit', type=inputs.natural, location='args')
+    list_parser.add_argument('cursor', type=str, location='args')
+    list_parser.add_argument('filter', type=str, location='args')
+
+    # admins first, then group owners, active and unblocked users, see paginate_by_keyset()
+    sort_keys = (
+        (User.is_admin, True),
+        (User.is_group_owner, True),
+        (User.is_active, False),
+        (User.is_blocked, False),
+        (User.id, False),
+    )
+
     @auth.login_required
     @requires_admin
     @marshal_with(user_fields)
@@ -39,15 +53,20 @@ class UserList(restful.Resource):
     @marshal_with(user_fields)
     def get(self):
         if g.user.is_admin:
-            user_query = (
-                User.query
-                .order_by(User.is_admin.desc())
-                .order_by(User.is_group_owner.desc())
-                .order_by(User.is_active)
-                .order_by(User.is_blocked)
-                .order_by(User.is_blocked)
-            )
-            return user_query.all()
+            args = self.list_parser.parse_args()
+            try:
+                user_query = User.query
+                if args.filter:
+                    # filtered here and not in the browser, which only has the loaded pages,
+                    # the wildcards typed in the filter are matched literally
+                    email_filter = re.sub(r'([\\%_])', r'\\\1', args.filter)
+                    user_query = user_query.filter(User._email.ilike('%{0}%'.format(email_filter), escape='\\'))
+                users, next_cursor = paginate_by_keyset(user_query, self.sort_keys, args.cursor, args.limit)
+            except ValueError:
+                abort(422)
+            if next_cursor:
+                return users, 200, {NEXT_CURSOR_HEADER: next_cursor}
+            return users
         return [g.user]
 
     @auth.login_required
@@ -5,6 +5,7 @@ import logging
 
 from pebbles.server import restful
 from pebbles.config import BaseConfig
+from pebbles.views.commons import conditional_get
 
 # Point to be noted, there will be driver specific configs later on
 # how about the readonly vars now?
@@ -23,6 +24,19 @@ PUBLIC_CONFIG_VARIABLES = (
 )
 
 
+def get_public_variables():
+    try:
+        dynamic_config = BaseConfig()
+        public_vars = []
+        for public_var in PUBLIC_CONFIG_VARIABLES:
+            public_vars.append({'key': public_var, 'value': dynamic_config[public_var]})
+        return public_vars
+
+    except Exception as ex:
+        logging.error("error in retrieving variables" + str(ex))
+        return []
+
+
 class PublicVariableList(restful.Resource):
     """The list of variables that are needed for the frontend to construct a branded page.
     Installation name, logo url etc.
@@ -31,15 +45,7 @@ class PublicVariableList(restful.Resource):
     monitor that the back-end (and database connection) are healthy.
     """
 
+    @conditional_get((), key=get_public_variables)
     @marshal_with(variable_fields)
     def get(self):
-        try:
-            dynamic_config = BaseConfig()
-            public_vars = []
-            for public_var in PUBLIC_CONFIG_VARIABLES:
-                public_vars.append({'key': public_var, 'value': dynamic_config[public_var]})
-            return public_vars
-
-        except Exception as ex:
-            logging.error("error in retrieving variables" + str(ex))
-            return []
+        return get_public_variables()
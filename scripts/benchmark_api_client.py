@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark for the internal API client: compares calls per second of
+one-off requests against the pooled keep-alive session PBClient uses.
+
+A local stand-in API answering every GET with a small JSON document is
+started in a background thread, so no Pebbles server is needed:
+
+    python scripts/benchmark_api_client.py --calls 2000
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+import requests
+from six.moves import BaseHTTPServer, socketserver
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pebbles.client import PBClient, get_api_session  # NOQA
+
+RESPONSE_BODY = b'{"id": "0123456789abcdef", "state": "running"}'
+
+
+class StandInApiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps the connections open between requests, unbuffered writes
+    # with Nagle's algorithm would stall each keep-alive response on delayed ACKs
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(RESPONSE_BODY)))
+        self.end_headers()
+        self.wfile.write(RESPONSE_BODY)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInApiServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def run(label, call, num_calls):
+    start = time.time()
+    for _ in range(num_calls):
+        resp = call()
+        assert resp.status_code == 200
+    duration = time.time() - start
+    print('%-20s %8.1f calls/s' % (label, num_calls / duration))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=1000)
+    args = parser.parse_args()
+
+    server = StandInApiServer(('127.0.0.1', 0), StandInApiHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    api_base_url = 'http://127.0.0.1:%d/api/v1' % server.server_address[1]
+
+    url = '%s/instances/0123456789abcdef' % api_base_url
+    run('requests.get', lambda: requests.get(url), args.calls)
+
+    pbclient = PBClient('token', api_base_url, session=get_api_session(pool_size=1, retries=0, backoff_factor=0))
+    run('PBClient (pooled)', lambda: pbclient.do_get('instances/0123456789abcdef'), args.calls)
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+Benchmark for launching instances: measures the latency of POST /api/v1/instances
+as the history of deleted instances grows, and for comparison the time it takes
+to load the names of all the instances, which is what a launch used to cost.
+
+The API is exercised through the Flask test client on an in-memory database
+with the test configuration, so no server or workers are needed:
+
+    python scripts/benchmark_instance_launch.py --history 0 10000 50000 --launches 200
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+import uuid
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pebbles.config import TestConfig  # NOQA
+from pebbles.models import db, User, Group, Plugin, BlueprintTemplate, Blueprint, Instance  # NOQA
+from pebbles.server import app  # NOQA
+import pebbles.views  # NOQA
+
+
+def add_history(blueprint, users, count, offset):
+    db.session.bulk_insert_mappings(Instance, [{
+        'id': uuid.uuid4().hex,
+        'blueprint_id': blueprint.id,
+        'user_id': users[i % len(users)].id,
+        'name': 'pb-history-%d' % i,
+        '_state': Instance.STATE_DELETED,
+        'credits_settled': 0.0,
+    } for i in range(offset, offset + count)])
+    db.session.commit()
+
+
+def measure_launches(client, headers, blueprint, num_launches):
+    latencies = []
+    for _ in range(num_launches):
+        start = time.time()
+        response = client.post('/api/v1/instances', headers=headers, data=json.dumps({'blueprint': blueprint.id}),
+                               content_type='application/json')
+        latencies.append(time.time() - start)
+        assert response.status_code == 200, response.data
+        # keep the per user instance limit from kicking in
+        Instance.query.filter_by(id=json.loads(response.data.decode('utf-8'))['id'])\
+            .update({'_state': Instance.STATE_DELETED, 'credits_settled': 0.0})
+        db.session.commit()
+    latencies.sort()
+    return latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.95)]
+
+
+def measure_name_scan():
+    start = time.time()
+    set(x.name for x in Instance.query.all())
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--history', type=int, nargs='+', default=[0, 10000, 50000])
+    parser.add_argument('--launches', type=int, default=100)
+    parser.add_argument('--history-users', type=int, default=100, help='users owning the history instances')
+    args = parser.parse_args()
+
+    app.dynamic_config = TestConfig()
+    app.config.from_object(app.dynamic_config)
+    with app.app_context():
+        db.create_all()
+        user = User('admin@example.org', 'admin', is_admin=True)
+        user.credits_quota = 1e9
+        group = Group('Benchmark')
+        plugin = Plugin()
+        plugin.name = 'DummyDriver'
+        template = BlueprintTemplate()
+        template.name = 'Benchmark template'
+        template.plugin = plugin.id
+        template.is_enabled = True
+        template.allowed_attrs = []
+        blueprint = Blueprint()
+        blueprint.name = 'Benchmark blueprint'
+        blueprint.template_id = template.id
+        blueprint.group_id = group.id
+        blueprint.is_enabled = True
+        history_users = [User('user-%d@example.org' % i) for i in range(args.history_users)]
+        db.session.add_all([user, group, plugin, template, blueprint] + history_users)
+        db.session.commit()
+
+        token = user.generate_auth_token(app.config['SECRET_KEY'])
+        headers = {
+            'Accept': 'application/json',
+            'Authorization': 'Basic %s' % base64.b64encode(('%s:' % token).encode('utf-8')).decode('ascii')
+        }
+        client = app.test_client()
+
+        print('%10s %14s %14s %16s' % ('history', 'launch p50 ms', 'launch p95 ms', 'name scan ms'))
+        history = 0
+        for target in sorted(args.history):
+            add_history(blueprint, history_users, target - history, history)
+            history = target
+            p50, p95 = measure_launches(client, headers, blueprint, args.launches)
+            print('%10d %14.1f %14.1f %16.1f' % (history, p50 * 1000, p95 * 1000, measure_name_scan() * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+"""
+Simulator for the placement strategies of DockerDriver: replays a trace of
+provisioned and deprovisioned instances against a model of the host pool and
+reports the host-hours used with each strategy.
+
+The pool is housekept once a minute the way the driver does it, one action
+per run: spawned hosts are activated after the spawn delay, empty inactive
+hosts are removed, hosts are spawned to cover the free slot target and the
+queue, and empty hosts past their lifetime are inactivated. The containers
+are placed with DockerDriver.select_candidate_hosts() and the pool is sized
+with the calculate_*_slots helpers of the driver. Launches that find no room
+are queued and retried after every housekeeping run.
+
+A trace is a CSV file with one event per line, the timestamps in seconds:
+
+    timestamp,event,instance_id,slots
+    1517821200,provision,6f1c09a2,1
+    1517825000,deprovision,6f1c09a2,1
+
+Without a trace a synthetic one with daily course sessions is generated:
+
+    python scripts/simulate_docker_placement.py --trace launches.csv --max-hosts 20
+    python scripts/simulate_docker_placement.py --synthetic-days 10 --seed 1
+"""
+import argparse
+import csv
+import os
+import random
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pebbles.drivers.provisioning.docker_driver import (  # NOQA
+    DockerDriver, PLACEMENT_STRATEGIES, DD_HOST_LIFETIME, DD_MAX_SPAWN_PER_HOUSEKEEP,
+    DD_STATE_SPAWNED, DD_STATE_ACTIVE, DD_STATE_INACTIVE, DD_STATE_REMOVED
+)
+
+HOUSEKEEP_INTERVAL = 60  # seconds
+
+
+def read_trace(file_name):
+    trace = []
+    with open(file_name) as trace_file:
+        for row in csv.reader(trace_file):
+            if not row or row[0] == 'timestamp':
+                continue
+            trace.append((int(float(row[0])), row[1], row[2], int(row[3])))
+    # at the same second the deprovisions go first
+    return sorted(trace)
+
+
+def generate_trace(days, seed):
+    """ One to three course sessions of 30-120 students a day and a trickle of self-study launches,
+        the instances running from half an hour to three hours
+    """
+    rnd = random.Random(seed)
+    launches = []
+    for day in range(days):
+        day_ts = day * 86400
+        for _ in range(rnd.randint(1, 3)):
+            start_ts = day_ts + rnd.randint(8, 16) * 3600
+            launches += [(start_ts + rnd.randint(0, 900), rnd.randint(3600, 7200))
+                         for _ in range(rnd.randint(30, 120))]
+        launches += [(day_ts + rnd.randint(0, 86399), rnd.randint(1800, 10800))
+                     for _ in range(rnd.randint(20, 60))]
+
+    trace = []
+    for i, (start_ts, duration) in enumerate(launches):
+        slots = rnd.choice((1, 1, 1, 2, 4))
+        trace.append((start_ts, 'provision', 'sim-%d' % i, slots))
+        trace.append((start_ts + duration, 'deprovision', 'sim-%d' % i, slots))
+    return sorted(trace)
+
+
+class PoolSimulation(object):
+    def __init__(self, strategy, args):
+        self.strategy = strategy
+        self.args = args
+        self.hosts = []
+        self.placements = {}
+        self.queue = []
+        self.queue_waits = []
+        self.num_queued = 0
+        self.num_spawned = 0
+        self.max_hosts = 0
+        self.host_seconds = 0
+
+    def provision(self, ts, instance_id, slots):
+        active_hosts = DockerDriver.get_active_hosts(self.hosts)
+        candidates = DockerDriver.select_candidate_hosts(active_hosts, slots, self.strategy)
+        if not candidates:
+            return False
+        host = candidates[0]
+        host['num_reserved_slots'] += slots
+        if not host.get('lifetime_tick_ts', 0):
+            host['lifetime_tick_ts'] = ts
+        self.placements[instance_id] = (host, slots)
+        return True
+
+    def deprovision(self, instance_id):
+        # instances deleted while still queueing never got a host
+        self.queue = [x for x in self.queue if x[1] != instance_id]
+        if instance_id in self.placements:
+            host, slots = self.placements.pop(instance_id)
+            host['num_reserved_slots'] -= slots
+
+    def spawn(self, ts, large):
+        self.num_spawned += 1
+        self.hosts.append({
+            'id': 'host-%d' % self.num_spawned,
+            'spawn_ts': ts,
+            'state': DD_STATE_SPAWNED,
+            'num_slots': self.args.large_slots if large else self.args.small_slots,
+            'num_reserved_slots': 0,
+            'lifetime_left': DD_HOST_LIFETIME,
+        })
+
+    def remove(self, ts, host):
+        host['state'] = DD_STATE_REMOVED
+        self.host_seconds += ts - host['spawn_ts']
+        self.hosts.remove(host)
+
+    def housekeep(self, ts):
+        for host in self.hosts:
+            if host.get('lifetime_tick_ts', 0):
+                host['lifetime_left'] = max(DD_HOST_LIFETIME - (ts - host['lifetime_tick_ts']), 0)
+
+        spawned_hosts = [x for x in self.hosts if x['state'] == DD_STATE_SPAWNED]
+        removable_hosts = [x for x in self.hosts if x['state'] == DD_STATE_INACTIVE and x['num_reserved_slots'] == 0]
+        expired_hosts = [x for x in DockerDriver.get_active_hosts(self.hosts)
+                         if x['lifetime_left'] == 0 and x['num_reserved_slots'] == 0]
+        num_missing_slots = (
+            self.args.free_slot_target + sum(x[2] for x in self.queue) -
+            DockerDriver.calculate_projected_free_slots(self.hosts)
+        )
+
+        if spawned_hosts:
+            for host in spawned_hosts:
+                if ts - host['spawn_ts'] >= self.args.spawn_delay:
+                    host['state'] = DD_STATE_ACTIVE
+        elif removable_hosts:
+            self.remove(ts, removable_hosts[0])
+        elif num_missing_slots > 0 and len(self.hosts) < self.args.max_hosts:
+            num_allocated_slots = DockerDriver.calculate_allocated_slots(self.hosts)
+            for _ in range(DD_MAX_SPAWN_PER_HOUSEKEEP):
+                if num_missing_slots <= 0 or len(self.hosts) >= self.args.max_hosts:
+                    break
+                self.spawn(ts, num_allocated_slots > 0 or num_missing_slots > self.args.small_slots)
+                num_missing_slots -= self.hosts[-1]['num_slots']
+        elif expired_hosts:
+            expired_hosts[0]['state'] = DD_STATE_INACTIVE
+
+        queue = self.queue
+        self.queue = []
+        for queued_ts, instance_id, slots in queue:
+            if self.provision(ts, instance_id, slots):
+                self.queue_waits.append(ts - queued_ts)
+            else:
+                self.queue.append((queued_ts, instance_id, slots))
+        self.max_hosts = max(self.max_hosts, len(self.hosts))
+
+    def run(self, trace):
+        ts = trace[0][0] - trace[0][0] % HOUSEKEEP_INTERVAL
+        for event_ts, event, instance_id, slots in trace:
+            while ts <= event_ts:
+                self.housekeep(ts)
+                ts += HOUSEKEEP_INTERVAL
+            if event == 'provision':
+                if not self.provision(event_ts, instance_id, slots):
+                    self.queue.append((event_ts, instance_id, slots))
+                    self.num_queued += 1
+            else:
+                self.deprovision(instance_id)
+
+        # the hosts still in the pool are counted up to the end of the trace
+        end_ts = trace[-1][0]
+        for host in list(self.hosts):
+            self.remove(end_ts, host)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trace', help='CSV file of provision and deprovision events')
+    parser.add_argument('--synthetic-days', type=int, default=5, help='days of synthetic trace without --trace')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--strategies', nargs='+', default=sorted(PLACEMENT_STRATEGIES.keys()),
+                        choices=sorted(PLACEMENT_STRATEGIES.keys()))
+    parser.add_argument('--free-slot-target', type=int, default=4)
+    parser.add_argument('--max-hosts', type=int, default=20)
+    parser.add_argument('--small-slots', type=int, default=6)
+    parser.add_argument('--large-slots', type=int, default=24)
+    parser.add_argument('--spawn-delay', type=int, default=300, help='seconds from spawning a host to activating it')
+    args = parser.parse_args()
+
+    if args.trace:
+        trace = read_trace(args.trace)
+    else:
+        trace = generate_trace(args.synthetic_days, args.seed)
+    if not trace:
+        parser.error('empty trace')
+
+    num_launches = sum(1 for event in trace if event[1] == 'provision')
+    print('%d launches over %.1f hours' % (num_launches, (trace[-1][0] - trace[0][0]) / 3600.0))
+    print('%18s %12s %10s %12s %10s %16s' % (
+        'strategy', 'host-hours', 'max hosts', 'hosts used', 'queued', 'mean wait s'))
+    for strategy in args.strategies:
+        simulation = PoolSimulation(strategy, args)
+        simulation.run(trace)
+        waits = simulation.queue_waits
+        print('%18s %12.1f %10d %12d %10d %16.1f' % (
+            strategy,
+            simulation.host_seconds / 3600.0,
+            simulation.max_hosts,
+            simulation.num_spawned,
+            simulation.num_queued,
+            float(sum(waits)) / len(waits) if waits else 0.0,
+        ))
+
+
+if __name__ == '__main__':
+    main()